@@ -4,8 +4,11 @@ import h5py
 import glob
 import copy
 import itertools
+import json
+import time
 from six import string_types,reraise
 from CMS_Deep_Learning.storage.archiving import DataProcedure,KerasTrial
+from CMS_Deep_Learning.storage.columnar import COLUMNAR_EXTENSION
 
 #-----------------------------IO Utils----------------------------------------
 def load_hdf5_dataset(data):
@@ -83,7 +86,7 @@ def retrieve_data(data, data_keys, just_length=False, assert_list=False, prep_fu
 
 # --------------------------SIZE UTILS-------------------------------
 def nb_samples_from_h5(file_path):
-    '''Get the number of samples contained in any .h5 file; numpy or pandas.
+    '''Get the number of samples contained in any .h5 file; numpy, pandas or columnar pandas.
 
     :param file_path: The file_path
     :returns: The number of samples.
@@ -93,9 +96,17 @@ def nb_samples_from_h5(file_path):
     except IOError as e:
         raise IOError(str(e) + " at %r" % file_path)
     try:
+        #Columnar pandas files record their number of entries
+        if ('entries' in f.attrs):
+            return int(f.attrs['entries'])
+        #Pandas files of delphes_parser have a row per entry in NumValues
+        if ('NumValues' in f):
+            d = f['NumValues']
+        #Tables (format='table') keep their rows in 'table' next to a PyTables index '_i_table', fixed format
+        #   frames keep their index in 'axis1'
         while not isinstance(d, h5py.Dataset):
-            keys = list(d.keys())
-            d = d['axis1' if 'axis1' in keys else keys[0]]
+            keys = [key for key in d.keys() if not key.startswith('_i_')]
+            d = d['table' if 'table' in keys else 'axis1' if 'axis1' in keys else keys[0]]
         out = d.len()
     except IOError as e:
         raise IOError(str(e) + " at %r" % file_path)
@@ -118,14 +129,70 @@ def get_sizes_meta_dict(directory, verbose=0):
     return sizesDict
 
 
+DATASET_MANIFEST = "manifest.json"
+DATASET_FORMAT = "cms-dl-dataset"
+_manifest_cache = {}
+
+
+def read_dataset_manifest(directory):
+    '''Returns the manifest.json that make_datasets keeps in a directory of shards, or None if it has none.
+
+    :param directory: The directory of the shards
+    :returns: A dictionary with the build "params" and the "shards" that are complete, keyed by file name, and
+              whether the whole dataset is "complete"
+    '''
+    path = os.path.join(os.path.abspath(directory), DATASET_MANIFEST)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    #The manifest is replaced (not changed in place) when a shard is added, so a new inode means a new manifest
+    modtime = (stat.st_mtime, stat.st_ino)
+    if (not path in _manifest_cache or _manifest_cache[path][0] != modtime):
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+        except ValueError:
+            return None
+        #manifest.json files of other tools (i.e. delphes_parser) are not dataset manifests
+        if (not isinstance(manifest, dict) or manifest.get("format", None) != DATASET_FORMAT):
+            manifest = None
+        _manifest_cache[path] = (modtime, manifest)
+    return _manifest_cache[path][1]
+
+
+def shards_from_manifest(directory):
+    '''Returns the sorted paths of the complete shards listed in the manifest of a directory, or None if it has none'''
+    manifest = read_dataset_manifest(directory)
+    if (manifest == None):
+        return None
+    return [os.path.join(os.path.abspath(directory), name) for name in sorted(manifest["shards"].keys())]
+
+
+def nb_samples_from_manifest(file_path):
+    '''Returns the number of samples that the manifest of its directory records for a shard, or None if it does not
+
+    :param file_path: The path of the shard
+    '''
+    directory, name = os.path.split(os.path.abspath(file_path))
+    manifest = read_dataset_manifest(directory)
+    if (manifest == None or not name in manifest["shards"]):
+        return None
+    return manifest["shards"][name]["samples"]
+
+
 def size_from_meta(filename, sizesDict=None, zero_errors=True, verbose=0):
-    '''Quickly resolves the number of entries in a file from metadata, making sure to update the metadata if necessary
+    '''Quickly resolves the number of entries in a file from metadata, making sure to update the metadata if necessary.
+       Shards listed in a dataset manifest (see make_datasets) are looked up there.
 
     :param filename: The path the the file.
     :param sizesDict: (optional) the sizes dictionary gotten from get_sizes_meta_dict, if not passed will find it anyway.
     :returns: The number of samples in the file
      '''
     from CMS_Deep_Learning.storage.archiving import write_json_obj
+    from_manifest = nb_samples_from_manifest(filename)
+    if (from_manifest != None):
+        return from_manifest
     if (sizesDict == None):
         sizesDict = get_sizes_meta_dict(filename)
     modtime = os.path.getmtime(filename)
@@ -145,6 +212,99 @@ def size_from_meta(filename, sizesDict=None, zero_errors=True, verbose=0):
     return sizesDict[filename][0]
 
 
+def nb_entries(file_path):
+    '''Get the number of samples (or entries) in a .h5 file, see nb_samples_from_h5, or in a pandas .msg file
+
+    :param file_path: The file_path
+    :returns: The number of samples.
+    '''
+    if (file_path.endswith(".msg")):
+        from CMS_Deep_Learning.storage.indexed_msgpack import IndexedMsgpackFile, is_indexed_msgpack, \
+            read_legacy_msgpack
+        if (not is_indexed_msgpack(file_path)):
+            return len(read_legacy_msgpack(file_path)["NumValues"].index)
+        f = IndexedMsgpackFile(file_path)
+        f.close()
+        return f.n_entries
+    return nb_samples_from_h5(file_path)
+
+
+class SampleIndex(object):
+    '''The cumulative number of samples of a sorted list of files, which are read as if they were one long list.
+
+    :param files: The sorted list of files
+    :param counts: The number of samples in each file
+    :param directory: The directory of the files, for error messages
+    '''
+
+    def __init__(self, files, counts, directory=None):
+        self.files = list(files)
+        self.counts = np.asarray(counts, dtype='int64')
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts)])
+        self.total = int(self.offsets[-1])
+        self.directory = directory
+
+    def slices(self, start, count):
+        '''Locates the samples [start, start+count) in the files
+
+        :param start: The index of the first sample
+        :param count: The number of samples
+        :returns: A list of (file, file_start, n), reading n samples from file_start of each file gives the samples in order
+        :raises IOError: if there are not enough samples
+        '''
+        if (start + count > self.total):
+            raise IOError("Not enough data in %r to read in range(%r, %r), it only has %r samples" %
+                          (self.directory, start, start + count, self.total))
+        out = []
+        i = int(np.searchsorted(self.offsets, start, side='right')) - 1
+        while (count > 0):
+            file_start = start - int(self.offsets[i])
+            n = min(count, int(self.counts[i]) - file_start)
+            if (n > 0):
+                out.append((self.files[i], file_start, n))
+                start, count = start + n, count - n
+            i += 1
+        return out
+
+
+_index_cache = {}
+
+
+def sample_index(directory, files=None, verbose=0):
+    '''Returns the SampleIndex of the pandas files in a directory. The number of samples in each file is kept in
+       sizesMetaData.json, along with the file's modification time, and only files that changed are opened again.
+
+    :param directory: The directory of the files
+    :param files: The files to index, if None all the .h5, columnar and .msg files in the directory
+    :returns: The SampleIndex of the sorted files
+    '''
+    from CMS_Deep_Learning.storage.archiving import read_json_obj, write_json_obj
+    directory = os.path.abspath(directory)
+    if (files == None):
+        files = [f for ext in ["*.h5", "*" + COLUMNAR_EXTENSION, "*.msg"] for f in glob.glob(os.path.join(directory, ext))]
+    files = sorted([os.path.abspath(f) for f in files])
+    modtimes = [os.path.getmtime(f) for f in files]
+    key = (directory, tuple(files), tuple(modtimes))
+    if (key in _index_cache):
+        return _index_cache[key]
+
+    sizesDict = read_json_obj(directory, "sizesMetaData.json")
+    changed = False
+    for f, modtime in zip(files, modtimes):
+        if (not f in sizesDict or sizesDict[f][1] != modtime):
+            try:
+                sizesDict[f] = (nb_entries(f), modtime)
+            except (IOError, KeyError) as e:
+                if (verbose >= 1): print("Skipping %r: %s" % (f, e))
+                sizesDict[f] = (0, modtime)
+            changed = True
+    if (changed):
+        write_json_obj(sizesDict, directory, "sizesMetaData.json")
+    index = SampleIndex(files, [sizesDict[f][0] for f in files], directory)
+    _index_cache[key] = index
+    return index
+
+
 # -------------------------------------------------------------
 
 #-----------------------------GENERATOR------------------------
@@ -180,7 +340,9 @@ def gen_from_data(lst, batch_size, data_keys=["Particles", "Labels"],prep_func=N
         :returns: a generator that runs through the given data
     '''
     if (isinstance(lst, string_types) and os.path.isdir(lst)):
-        lst = glob.glob(os.path.abspath(lst) + "/*.h5")
+        #Only the shards that the manifest lists are complete
+        shards = shards_from_manifest(lst)
+        lst = glob.glob(os.path.abspath(lst) + "/*.h5") if shards == None else shards
     if (isinstance(lst, DataProcedure) or isinstance(lst, string_types)): lst = [lst]
     for d in lst:
         if (not (isinstance(d, DataProcedure) or (isinstance(d, string_types) and os.path.exists(d))) ):
@@ -201,6 +363,84 @@ def gen_from_data(lst, batch_size, data_keys=["Particles", "Labels"],prep_func=N
                 # yield tuple([[x[start:end] for x in X] for X in out])
                 yield restructure([x[start:end] for x in flat_out], data_keys)
                 
+
+
+def _tail_manifest(directory, order, sizes):
+    '''Helper Function - Appends the shards newly published to the manifest of directory to order (and their number
+        of samples to sizes), in the order they are published.
+        :returns: True if the dataset is complete, so no more shards will be published'''
+    manifest = read_dataset_manifest(directory)
+    if (manifest == None):
+        return False
+    seen = set(order)
+    for name in sorted(manifest["shards"].keys()):
+        if (not name in seen):
+            order.append(name)
+            sizes.append(manifest["shards"][name]["samples"])
+    # Manifests written in one go (i.e. by shuffle_shards) are complete
+    return manifest.get("complete", True)
+
+
+def gen_from_tail(directory, batch_size, samples_per_epoch, data_keys=["Particles", "Labels"], prep_func=None,
+                  poll_interval=1.0, timeout=None, verbose=1):
+    '''Gets a generator like gen_from_data for a directory of shards that make_datasets may still be writing, so that
+        training can start before the dataset is complete. Shards are read in the order they are published to the
+        manifest of the directory. Before each shard the generator blocks, polling the manifest, until the rest of
+        the current epoch of samples_per_epoch samples has been published. Once the dataset is complete it starts
+        again from the first shard, like gen_from_data.
+
+        :param directory: a directory of shards written by make_datasets
+        :type directory: str
+        :param batch_size: The number of samples to grab at each call to next()
+        :type batch_size: int
+        :param samples_per_epoch: The number of samples in an epoch, i.e. KerasTrial.samples_per_epoch
+        :type samples_per_epoch: int
+        :param data_keys: The keys to draw from in the .h5 files. (order matters)
+        :type data_keys: list of str
+        :param prep_func: a function that takes in the tuple of outputs and returns some light transformation
+                        on them, for example reshaping or padding.
+        :param poll_interval: the number of seconds to wait between reads of the manifest
+        :type poll_interval: float
+        :param timeout: the number of seconds to wait for shards before raising an IOError, or None to wait forever
+        :type timeout: float
+        :param verbose: whether or not to print out info to the user.
+        :type verbose: int
+        :returns: a generator that runs through the shards as they are published
+    '''
+    order, sizes = [], []
+    cursor = 0
+    epoch_left = samples_per_epoch
+    while True:
+        waited = 0.0
+        complete = _tail_manifest(directory, order, sizes)
+        while (not complete and sum(sizes[cursor:]) < epoch_left):
+            if (timeout != None and waited >= timeout):
+                raise IOError("Only %r of %r samples were published to %r in %r seconds" %
+                              (sum(sizes[cursor:]), epoch_left, directory, timeout))
+            if (verbose >= 1 and waited == 0.0):
+                print("Waiting for %r more samples in %r" % (epoch_left - sum(sizes[cursor:]), directory))
+            time.sleep(poll_interval)
+            waited += poll_interval
+            complete = _tail_manifest(directory, order, sizes)
+        if (cursor == len(order)):
+            if (len(order) == 0):
+                raise IOError("The dataset %r is complete but has no shards" % directory)
+            cursor = 0
+
+        path = os.path.join(os.path.abspath(directory), order[cursor])
+        flat_out = flatten(assert_list(retrieve_data(path, data_keys=data_keys, prep_func=prep_func, verbose=verbose)),
+                           inplace=True)
+        tot_set = _size_set(flat_out)
+        assert len(tot_set) == 1, "datasets (i.e Particle,Labels,HLF) to not have same number of elements"
+        tot = list(tot_set)[0]
+        cursor += 1
+        for start in range(0, tot, batch_size):
+            end = start + min(batch_size, tot - start)
+            yield restructure([x[start:end] for x in flat_out], data_keys)
+            epoch_left -= end - start
+            while (epoch_left <= 0):
+                epoch_left += samples_per_epoch
+
 #--------------------------------------------------------------
 
 #---------------------UTILS-------------------------------
@@ -299,7 +539,8 @@ class DataIterator:
         # Make sure the data is some kind of list 
         if (not isinstance(data, list)):
             if (os.path.exists(os.path.abspath(data)) and os.path.isdir(os.path.abspath(data))):
-                data = sorted(glob.glob(os.path.abspath(data) + "/*.h5"))
+                shards = shards_from_manifest(data)
+                data = sorted(glob.glob(os.path.abspath(data) + "/*.h5")) if shards == None else shards
             else:
                 data = [data]
 
@@ -353,6 +594,10 @@ class DataIterator:
         if (self.num_samples == None):
             num_samples = 0
             for d in self.data:
+                from_manifest = nb_samples_from_manifest(d) if isinstance(d, string_types) else None
+                if (from_manifest != None):
+                    num_samples += from_manifest
+                    continue
                 lengths = flatten(self._retrieve_data(d, self.union_keys, just_length=True, verbose=verbose),inplace=True)
                 assert len(set(lengths)) == 1, "Collection lengths mismatch %r, with lengths %r" % \
                                                (flatten(self.union_keys), flatten(self.union_keys))
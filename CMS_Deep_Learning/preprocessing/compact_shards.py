@@ -0,0 +1,239 @@
+'''
+compact_shards.py
+Merges the many small pandas files that delphes_parser writes for a sample (one per ROOT file) into a few
+large shards of about the same size, so that readers open a handful of files instead of thousands. Input
+files are taken in sorted order (the order every reader uses) and each shard holds a run of consecutive
+whole files, so the order of the events does not change. Every collection of every shard is merged by its
+own process, then the merged tables are copied into the shard as they are.
+
+    python compact_shards.py <data_dir> -o <output_dir> [-n num_shards | -s 500MB] [-p num_processes]
+'''
+import os
+import sys
+if __package__ is None:
+    sys.path.append(os.path.realpath(__file__+"/../../../"))
+import argparse
+import numpy as np
+import pandas as pd
+import h5py
+from multiprocessing import Pool
+from CMS_Deep_Learning.preprocessing.preprocessing import getFiles_StoreType, getNumValFrame, _getStore
+from CMS_Deep_Learning.preprocessing.delphes_parser import write_json_atomic, read_fingerprint, write_fingerprint, \
+    read_columnar_fingerprint
+from CMS_Deep_Learning.storage.columnar import ColumnarWriter, ColumnarFile, COLUMNAR_FORMAT, COLUMNAR_VERSION, \
+    COLUMNAR_EXTENSION, PER_ENTRY_TABLES
+from CMS_Deep_Learning.storage.indexed_msgpack import IndexedMsgpackFile, is_indexed_msgpack, read_legacy_msgpack
+from CMS_Deep_Learning.preprocessing.pandas_to_numpy import parse_megabytes
+
+SIZES_META = "sizesMetaData.json"
+
+
+def plan_shards(weights, num_shards):
+    '''Splits a list of file weights (i.e. sizes) into at most num_shards runs of consecutive files with about the
+        same total weight
+        #Returns
+            A list of (start, stop) file indicies
+    '''
+    n = len(weights)
+    num_shards = max(min(num_shards, n), 1)
+    cumulative = np.cumsum(weights, dtype='float64')
+    targets = cumulative[-1] * np.arange(1, num_shards) / num_shards
+    #Cut after the file that brings each shard closest to its target
+    cuts = np.searchsorted(cumulative, targets, side='left')
+    below = np.where(cuts > 0, cumulative[np.maximum(cuts-1, 0)], 0.0)
+    cuts = np.where(np.abs(below - targets) < np.abs(cumulative[cuts] - targets), cuts, cuts+1)
+    bounds = sorted(set([0] + [int(c) for c in cuts if 0 < c < n] + [n]))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _num_shards(total_bytes, num_shards=None, size=None):
+    if(num_shards != None):
+        return int(num_shards)
+    return int(np.ceil(total_bytes / (parse_megabytes(size) * 1000.0 * 1000.0)))
+
+
+def _read_table(f, storeType, key):
+    store, frames = _getStore(f, storeType)
+    try:
+        if(storeType == "hdf5"):
+            return store.get(key)
+        elif(store != None):
+            return store.read(key)
+        return frames[key.strip("/")]
+    finally:
+        if(store != None): store.close()
+
+
+def _merge_table(args):
+    '''Worker - Merges one table of the files of a shard into a file of its own. The number of entries of each file,
+        and (for tables that are not per entry) the number of rows of each entry, come from the NumValues that
+        compact() already read.
+        #Returns
+            The number of rows written
+    '''
+    files, entries, counts_by_file, storeType, key, part = args
+    key = key.strip("/")
+    per_entry = counts_by_file == None
+    offset, rows = 0, 0
+    if(storeType == "columnar"):
+        writer = ColumnarWriter(part)
+    else:
+        writer = pd.HDFStore(part, mode='w')
+    try:
+        for i, (f, n) in enumerate(zip(files, entries)):
+            frame = _read_table(f, storeType, key)
+            counts = None if per_entry else counts_by_file[i]
+            if("Entry" in frame.columns):
+                frame["Entry"] += offset
+            frame.index = pd.RangeIndex(offset, offset+len(frame)) if per_entry else pd.RangeIndex(rows, rows+len(frame))
+            if(storeType == "columnar"):
+                writer.append_table(key, frame, counts)
+            elif(len(frame) > 0):
+                writer.append(key, frame, format='table')
+            offset += n
+            rows += len(frame)
+    finally:
+        writer.close()
+    return rows
+
+
+def _assemble(shard, parts, storeType, n_entries, fingerprint):
+    '''Copies the merged tables into the shard, which is written under a temporary name and then renamed'''
+    tmp = shard + ".tmp"
+    with h5py.File(tmp, 'w') as out:
+        for key, part in parts:
+            with h5py.File(part, 'r') as src:
+                if(key in src):
+                    src.copy(key, out, name=key)
+            os.remove(part)
+        #Readers (see io.nb_samples_from_h5) take the number of entries from here instead of counting NumValues
+        out.attrs["entries"] = n_entries
+        if(storeType == "columnar"):
+            out.attrs["format"] = COLUMNAR_FORMAT
+            out.attrs["version"] = COLUMNAR_VERSION
+            if(fingerprint != None): out.attrs["schema"] = fingerprint
+    if(storeType == "hdf5" and fingerprint != None):
+        store = pd.HDFStore(tmp)
+        write_fingerprint(store, fingerprint)
+        store.close()
+    os.rename(tmp, shard)
+
+
+def _fingerprint(f, storeType):
+    if(storeType == "columnar"):
+        return read_columnar_fingerprint(f)
+    elif(storeType == "hdf5"):
+        store = pd.HDFStore(f, mode='r')
+        try:
+            return read_fingerprint(store)
+        finally:
+            store.close()
+    return None
+
+
+def compact(data_dir, output_dir, num_shards=None, size="500MB", num_processes=1, verbose=1):
+    '''Merges the pandas files of a directory into shards of about the same size.
+        #Arguments
+            data_dir -- The directory of pandas files (.h5, .msg or .h5col) to compact
+            output_dir -- The directory to write the shards to. It must not be data_dir, or readers would see
+                            every event twice.
+            num_shards -- The number of shards to write. If None it follows from size.
+            size -- The target size of each shard like "500MB" or "2GB", used when num_shards is None
+            num_processes -- The number of tables to merge at the same time
+        #Returns
+            A list of (shard path, number of entries)
+    '''
+    data_dir = os.path.join(os.path.abspath(data_dir), "")
+    output_dir = os.path.join(os.path.abspath(output_dir), "")
+    if(data_dir == output_dir):
+        raise ValueError("output_dir must be different from data_dir %r" % data_dir)
+    files, storeType = getFiles_StoreType(data_dir)
+    files.sort()
+    #NumValues is read once per file, for legacy .msg files that means decoding the whole file
+    num_values = [getNumValFrame(f, storeType) for f in files]
+    entries = [len(frame.index) for frame in num_values]
+    weights = [os.path.getsize(f) for f in files]
+    keys = _keys(files[0], storeType)
+    fingerprints = set([_fingerprint(f, storeType) for f in files])
+    if(len(fingerprints) > 1):
+        raise ValueError("The files of %r were parsed with different schemas" % data_dir)
+    fingerprint = fingerprints.pop()
+    for f in files:
+        #Old .msg files are only read in full, so they are not checked up front
+        if((storeType != "msgpack" or is_indexed_msgpack(f)) and set(_keys(f, storeType)) != set(keys)):
+            raise ValueError("%r does not have the tables %r" % (f, keys))
+
+    #msgpack files are compacted into HDFStores
+    out_type = "hdf5" if storeType == "msgpack" else storeType
+    extension = COLUMNAR_EXTENSION if out_type == "columnar" else ".h5"
+    ranges = plan_shards(weights, _num_shards(sum(weights), num_shards, size))
+    if(not os.path.exists(output_dir)):
+        os.makedirs(output_dir)
+    order_of_mag = max(len(str(len(ranges)-1)), 3)
+    shards = [output_dir + ("%0" + str(order_of_mag) + "d") % i + extension for i in range(len(ranges))]
+
+    jobs = []
+    for shard, (start, stop) in zip(shards, ranges):
+        for key in keys:
+            key = key.strip("/")
+            part = "%s.%s.part" % (shard, key)
+            counts_by_file = None
+            if(not key in PER_ENTRY_TABLES):
+                counts_by_file = [frame[key].values for frame in num_values[start:stop]]
+            jobs.append((files[start:stop], entries[start:stop], counts_by_file, storeType, key, part))
+    if(verbose >= 1): print("Compacting %r files into %r shards" % (len(files), len(shards)))
+    if(num_processes > 1):
+        pool = Pool(num_processes)
+        try:
+            pool.map(_merge_table, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for job in jobs:
+            _merge_table(job)
+
+    out = []
+    for shard, (start, stop) in zip(shards, ranges):
+        parts = [(key.strip("/"), "%s.%s.part" % (shard, key.strip("/"))) for key in keys]
+        n_entries = sum(entries[start:stop])
+        _assemble(shard, parts, out_type, n_entries, fingerprint)
+        out.append((shard, n_entries))
+        if(verbose >= 1): print("Wrote %r: %r entries from %r files" % (shard, n_entries, stop-start))
+
+    sizesDict = {shard: (n, os.path.getmtime(shard)) for shard, n in out}
+    write_json_atomic(sizesDict, output_dir + SIZES_META)
+    return out
+
+
+def _keys(f, storeType):
+    if(storeType == "columnar"):
+        store = ColumnarFile(f)
+    elif(storeType == "msgpack" and is_indexed_msgpack(f)):
+        store = IndexedMsgpackFile(f)
+    elif(storeType == "msgpack"):
+        return sorted(["/" + key for key in read_legacy_msgpack(f).keys()])
+    else:
+        store = pd.HDFStore(f, mode='r')
+    try:
+        return sorted(store.keys())
+    finally:
+        store.close()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Merge the pandas files of a directory into a few large shards.')
+    parser.add_argument('data_dir', type=str)
+    parser.add_argument('-o', '--output_dir', type=str, dest='output_dir', required=True)
+    parser.add_argument('-n', '--num_shards', metavar='N', type=int, dest='num_shards', default=None,
+                        help='The number of shards to write.')
+    parser.add_argument('-s', '--size', type=str, default='500MB',
+                        help='The target size of each shard (i.e 500MB), used if --num_shards is not given.')
+    parser.add_argument('-p', '--num_processes', metavar='N', type=int, dest='num_processes', default=1,
+                        help='How many tables to merge concurrently.')
+    args = parser.parse_args(argv)
+    compact(args.data_dir, args.output_dir, num_shards=args.num_shards, size=args.size,
+            num_processes=args.num_processes)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -4,7 +4,11 @@ if __package__ is None:
     #sys.path.append(os.path.realpath("../"))
     sys.path.append(os.path.realpath(__file__+"/../../../"))
     #print(os.path.realpath(__file__+"/../../../"))
-import ROOT 
+try:
+    import ROOT
+except ImportError:
+    #Only SyntheticTrees can be parsed
+    ROOT = None
 import numpy as np
 import math
 import time
@@ -13,7 +17,16 @@ from itertools import islice
 import glob
 import ntpath
 import getopt
+import json
+import hashlib
+import signal
 from CMS_Deep_Learning.storage.meta import msgpack_assertMeta
+from CMS_Deep_Learning.storage.indexed_msgpack import write_indexed_msgpack
+from CMS_Deep_Learning.storage.columnar import ColumnarWriter, ColumnarFile, COLUMNAR_EXTENSION
+from CMS_Deep_Learning.preprocessing.kinematics import four_momentum, relative_observables, per_entry, leading, segment_sum
+from CMS_Deep_Learning.preprocessing.isolation import EtaPhiGrid, nearest, isolation
+from CMS_Deep_Learning.preprocessing.kinematics import LorentzVector
+from six import string_types
 
 
 def DeltaRsq(A_Eta, A_Phi, B_Eta, B_Phi):
@@ -174,7 +187,7 @@ def fill_object(dicts_by_object,leaves_by_object,entry,new_entry, start_index,ob
     # print(obj,n_values)
 
     #start_index = index_by_objects[obj]
-    lv = ROOT.TLorentzVector()
+    lv = _lorentz_vector()
     l_PT = d[PT_ET_MET][0]
     l_Eta = d["Eta"][0]
     l_Phi = d["Phi"][0]
@@ -256,7 +269,7 @@ def fill_jet(dicts_by_object, leaves_by_object, entry, new_entry, start_index):
         branch.GetEntry(entry)
     n_values = d["Phi"][0].GetLen()
 
-    lv = ROOT.TLorentzVector()
+    lv = _lorentz_vector()
     l_PT = d['PT'][0]
     l_Eta = d["Eta"][0]
     l_Phi = d["Phi"][0]
@@ -287,7 +300,7 @@ def fillTrackMatch(dicts_by_object,obj, trackIndicies, prtStart, trackStart):
                                 zeros
             obj -- The type of object we are matching with a track
             trackIndicies -- The result of trackMatch(). A numpy array of indicies corresponding to
-                            tracks being matched to particles
+                            tracks being matched to particles. Negative indicies (no track) are skipped.
             prtStart -- Where to start filling in X,Y,Z, and Dxy values for paricles matched to tracks
             trackStart -- Where to start reading track values from.
                 #Note: We need to know where to start because we may not be filling or reading from
@@ -298,22 +311,12 @@ def fillTrackMatch(dicts_by_object,obj, trackIndicies, prtStart, trackStart):
     '''
     l = dicts_by_object[obj]
     t = dicts_by_object["EFlowTrack"]
-    lX = l["X"]
-    lY = l["Y"]
-    lZ = l["Z"]
-    lDxy = l["Dxy"]
-    tX = t["X"]
-    tY = t["Y"]
-    tZ = t["Z"]
-    tDxy = t["Dxy"]
-    for lepI, trkI in enumerate(trackIndicies):
-        lepIndex = lepI + prtStart
-        trkIndex = trkI + trackStart
-        # print(obj, lepIndex, trkIndex, tX[trkIndex], tY[trkIndex], tZ[trkIndex])
-        lX[lepIndex] = tX[trkIndex]
-        lY[lepIndex] = tY[trkIndex]
-        lZ[lepIndex] = tZ[trkIndex]
-        lDxy[lepIndex] = tDxy[trkIndex]
+    trackIndicies = np.asarray(trackIndicies, dtype='int64')
+    ok = trackIndicies >= 0
+    lepIndex = (prtStart + np.arange(len(trackIndicies)))[ok]
+    trkIndex = trackIndicies[ok] + trackStart
+    for key in ["X", "Y", "Z", "Dxy"]:
+        l[key][lepIndex] = t[key][trkIndex]
 
     
 def fillIso(dicts_by_object,obj, isoType,  obj_start,iso):
@@ -332,8 +335,7 @@ def fillIso(dicts_by_object,obj, isoType,  obj_start,iso):
     '''
     isoArr = dicts_by_object[obj][isoType]
     # print(type(iso), iso)
-    for i in range(len(iso)):
-        isoArr[obj_start+i] = iso[i]
+    isoArr[obj_start:obj_start+len(iso)] = iso
         
 def fillEventChars(entry, new_entry, leaves_by_object,dicts_by_object, METPT_Eta_Phi,maxLepPT_Eta_Phi,maxJetPT_Eta_Phi):
     d = dicts_by_object["EventChars"]
@@ -382,10 +384,254 @@ def getEtaPhiPTasNumpy(dicts_by_object,obj, start, n_vals):
     
     PT_ET = "PT_ET" if obj != "Jet" else "PT"
     d = dicts_by_object[obj]
-    Eta =  np.array( d["Eta"][start:start+n_vals] )
-    Phi =  np.array( d["Phi"][start:start+n_vals] )
-    Pt =  np.array( d[PT_ET][start:start+n_vals] )
-    return Eta, Phi, Pt 
+    Eta =  np.array( d["Eta"][start:start+n_vals], dtype='float64')
+    Phi =  np.array( d["Phi"][start:start+n_vals], dtype='float64')
+    Pt =  np.array( d[PT_ET][start:start+n_vals], dtype='float64')
+    return Eta, Phi, Pt
+
+
+#---------------------------SOURCES--------------------------------------
+def open_tree(source):
+    '''Opens the Delphes tree of a ROOT file.
+        #Arguments
+            source -- The path to a ROOT file, or a tree that is already open (i.e. a SyntheticTree)
+        #Returns (fileIN, tree)
+            fileIN -- The open TFile, which must be kept around while the tree is used, or None
+            tree -- The Delphes TTree
+    '''
+    if(not isinstance(source, string_types)):
+        return None, source
+    if(ROOT == None):
+        raise ImportError("ROOT is needed to read %r, only SyntheticTrees can be parsed without it" % source)
+    fileIN = ROOT.TFile.Open(source)
+    return fileIN, fileIN.Get("Delphes")
+
+def _is_leaf(leaf):
+    '''Whether or not GetLeaf found the leaf it was asked for. A missing leaf is None, or a null pointer
+        (which is falsy) in ROOT.'''
+    return bool(leaf) and hasattr(leaf, "GetValue")
+
+def _lorentz_vector():
+    '''Returns a ROOT.TLorentzVector, or an equivalent kinematics.LorentzVector without ROOT'''
+    return LorentzVector() if ROOT == None else ROOT.TLorentzVector()
+#------------------------------------------------------------------------
+
+
+#---------------------------COLUMNAR READING-----------------------------
+#TTree::Draw only reliably exposes four columns at a time through GetVal(i)
+MAX_DRAW_EXPRESSIONS = 4
+DEFAULT_BLOCK_SIZE = 1000
+
+def _as_numpy(buf, n):
+    '''Copies the first n values of a double* buffer (as returned by TTree.GetVal) into a numpy array'''
+    if(n <= 0):
+        return np.zeros(0, dtype='float64')
+    if(isinstance(buf, np.ndarray)):
+        return np.array(buf[:n], dtype='float64')
+    #Old PyROOT buffers need their size set, cppyy LowLevelViews need to be reshaped
+    if(hasattr(buf, 'SetSize')):
+        buf.SetSize(n)
+    else:
+        buf.reshape((n,))
+    return np.array(np.frombuffer(buf, dtype='float64', count=n))
+
+def draw_columns(tree, expressions, first, n_entries, n_rows=None):
+    '''Reads whole columns out of a TTree in compiled code using TTree::Draw, instead of
+        calling GetEntry/GetValue from python.
+        #Arguments
+            tree -- The TTree to read from
+            expressions -- A list of leaf names (i.e. ['Electron.PT', 'Electron.Eta']) which must
+                            all belong to the same collection, or a list of counter leaves (i.e. 'Electron_size')
+            first -- The first entry to read
+            n_entries -- How many entries to read
+            n_rows -- The number of values that will be read, if known. Used to size the draw buffers.
+        #Returns
+            A list of flat float64 numpy arrays, one per expression
+    '''
+    out = []
+    for i in range(0, len(expressions), MAX_DRAW_EXPRESSIONS):
+        group = expressions[i:i+MAX_DRAW_EXPRESSIONS]
+        tree.SetEstimate(int(n_rows if n_rows != None else n_entries) + 1)
+        ok = tree.Draw(":".join(group), "", "goff", int(n_entries), int(first))
+        if(ok < 0):
+            raise ValueError("TTree::Draw failed to read %r" % group)
+        rows = tree.GetSelectedRows()
+        out += [_as_numpy(tree.GetVal(j), rows) for j in range(len(group))]
+    return out
+
+def read_counts(tree, objects, first, n_entries):
+    '''Returns a dictionary keyed by object type of numpy arrays with the number of values
+        that each entry in range(first, first+n_entries) has for that object type'''
+    sizes = draw_columns(tree, [obj + "_size" for obj in objects], first, n_entries)
+    return {obj: s.astype('int64') for obj, s in zip(objects, sizes)}
+
+def build_offsets(counts_by_object):
+    '''Builds an offsets index from the output of read_counts. The values of entry i for
+        object type obj are at rows range(offsets[obj][i], offsets[obj][i+1]).'''
+    return {obj: np.concatenate([[0], np.cumsum(c)]).astype('int64') for obj, c in counts_by_object.items()}
+
+def read_block(tree, leaves_by_object, first, n_entries, counts_by_object=None):
+    '''Reads every leaf in leaves_by_object for a block of entries as flat numpy arrays (jagged layout).
+        #Arguments
+            tree -- The TTree to read from
+            leaves_by_object -- A dictionary keyed by object type, containing dictionaries of tuples
+                                like (leaf, branch) keyed by observable type. Only the keys are used.
+            first -- The first entry of the block
+            n_entries -- The number of entries in the block
+            counts_by_object -- (optional) The counts for this block if they are already known, 
+                                for example sliced from a file wide read_counts.
+        #Returns (counts_by_object, columns_by_object)
+            counts_by_object -- A dictionary keyed by object type of int64 arrays of shape (n_entries,)
+                                with the number of values of that object in each entry
+            columns_by_object -- A dictionary keyed by object type containing dictionaries of flat
+                                float64 arrays keyed by observable type. The values for entry i
+                                of the block start at counts_by_object[obj][:i].sum()
+    '''
+    objects = list(leaves_by_object.keys())
+    if(counts_by_object == None):
+        counts_by_object = read_counts(tree, objects, first, n_entries)
+    columns_by_object = {}
+    for obj in objects:
+        observs = list(leaves_by_object[obj].keys())
+        n_rows = int(counts_by_object[obj].sum())
+        cols = draw_columns(tree, [obj + '.' + o for o in observs], first, n_entries, n_rows=n_rows)
+        for o, col in zip(observs, cols):
+            if(len(col) != n_rows):
+                raise ValueError("Read %r values for %s.%s but expected %r" % (len(col), obj, o, n_rows))
+        columns_by_object[obj] = dict(zip(observs, cols))
+    return counts_by_object, columns_by_object
+
+def block_rows(counts, selected):
+    '''Returns the indicies into the flat arrays of a block of the values that belong to the
+        selected entries of the block, in order.
+        #Arguments
+            counts -- The number of values in each entry of the block
+            selected -- A sorted numpy array of entry indicies relative to the start of the block
+    '''
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype('int64')
+    n = np.asarray(counts, dtype='int64')[selected]
+    shift = offsets[:-1][selected] - np.concatenate([[0], np.cumsum(n)[:-1]]).astype('int64')
+    return np.repeat(shift, n) + np.arange(n.sum(), dtype='int64')
+
+#------------------------------------------------------------------------
+
+
+#---------------------------PRESELECTION---------------------------------
+def cut_mask(counts_by_object, columns_by_object, requireLepton=True, num_leptons=1, lepton_PT_threshold=20.0,
+             num_jets=2, jet_PT_threshold=40.0):
+    '''Vectorized passLeptonCuts and passJetCuts for a block of entries read by read_block
+        #Arguments
+            counts_by_object -- The counts returned by read_block, for Electron, MuonTight and Jet
+            columns_by_object -- The columns returned by read_block, with at least the PT of Electron, MuonTight and Jet
+            requireLepton -- Whether or not each entry must pass the lepton cuts
+            num_leptons -- The number of electrons and muons that must pass lepton_PT_threshold
+            num_jets -- The number of jets that must pass jet_PT_threshold
+        #Returns
+            A boolean numpy array with one value per entry, True for entries that pass the cuts
+    '''
+    n_jets = segment_sum(columns_by_object["Jet"]["PT"] > jet_PT_threshold, counts_by_object["Jet"])
+    mask = n_jets >= num_jets
+    if(requireLepton):
+        n_leptons = sum([segment_sum(columns_by_object[obj]["PT"] > lepton_PT_threshold, counts_by_object[obj])
+                         for obj in LEPTON_TYPES])
+        mask &= n_leptons >= num_leptons
+    return mask
+
+def preselect(tree, n_entries, counts_by_object=None, block_size=10*DEFAULT_BLOCK_SIZE, first=0, **cuts):
+    '''Computes the event cuts for n_entries entries of a tree starting at first, only reading the PT leaves of
+        the leptons and the jets.
+        #Arguments
+            tree -- The TTree to read from
+            n_entries -- The number of entries to check
+            counts_by_object -- (optional) The output of read_counts for these entries
+            block_size -- The number of entries to read at a time
+            first -- The first entry to check
+            **cuts -- Passed on to cut_mask, i.e. requireLepton, num_leptons, lepton_PT_threshold,
+                        num_jets, jet_PT_threshold
+        #Returns
+            A boolean numpy array of shape (n_entries,), True for entries that pass the cuts
+    '''
+    leaves = {obj: {"PT": None} for obj in LEPTON_TYPES + ["Jet"]}
+    mask = np.zeros(n_entries, dtype=bool)
+    for start in range(0, n_entries, block_size):
+        n = min(block_size, n_entries-start)
+        counts = None if counts_by_object == None else {obj: counts_by_object[obj][start:start+n] for obj in leaves}
+        counts, columns = read_block(tree, leaves, first+start, n, counts_by_object=counts)
+        mask[start:start+n] = cut_mask(counts, columns, **cuts)
+    return mask
+
+def _entry_list(tree, entries):
+    '''Builds a TEntryList for the given entries of a tree, so that TTree::Draw only reads those entries.
+        Trees that are not TTrees (i.e. SyntheticTrees) build their own with make_entry_list.'''
+    make_entry_list = getattr(tree, "make_entry_list", None)
+    if(make_entry_list != None):
+        elist = make_entry_list("preselection", "preselection")
+    else:
+        elist = ROOT.TEntryList("preselection", "preselection", tree)
+    for entry in entries:
+        elist.Enter(int(entry))
+    return elist
+#------------------------------------------------------------------------
+
+
+#---------------------------TABLE BUFFERS--------------------------------
+class TableBuffer(object):
+    '''Preallocated typed column storage for one output table. Columns that share a dtype are
+        stored as the rows of a single 2D array, so that the DataFrame returned by to_frame is built
+        on top of the buffer without copying. Each column is a numpy array that can be filled by index
+        just like the lists it replaces. Rows are left out of the output by clearing them in the
+        boolean array keep while filling, so nothing has to be filtered afterwards.
+        #Arguments
+            columns -- The ordered column names of the table
+            n_rows -- The number of rows to allocate
+            dtypes -- A function mapping a column name to its dtype
+    '''
+    def __init__(self, columns, n_rows, dtypes=lambda column: 'float64'):
+        self.columns = list(columns)
+        self.n_rows = n_rows
+        self.blocks = []
+        self.arrays = {}
+        self.keep = np.ones(n_rows, dtype=bool)
+        for dtype in _unique([np.dtype(dtypes(c)) for c in self.columns]):
+            names = [c for c in self.columns if np.dtype(dtypes(c)) == dtype]
+            block = np.zeros((len(names), n_rows), dtype=dtype)
+            self.blocks.append((names, block))
+            for i, name in enumerate(names):
+                self.arrays[name] = block[i]
+
+    def __getitem__(self, column):
+        return self.arrays[column]
+
+    def __contains__(self, column):
+        return column in self.arrays
+
+    def to_frame(self, n_rows=None, columns=None):
+        '''Returns a DataFrame of the kept rows among the first n_rows rows, with the given columns (by default
+            all of them). If every row is kept it shares memory with the buffer, otherwise each block is compacted
+            with a single copy.'''
+        n = self.n_rows if n_rows == None else n_rows
+        columns = self.columns if columns == None else [c for c in self.columns if c in columns]
+        keep = self.keep[:n]
+        frames = []
+        for names, block in self.blocks:
+            index = [i for i, name in enumerate(names) if name in columns]
+            if(len(index) == 0): continue
+            #Slices of a block are views, picked out rows are not
+            rows = slice(index[0], index[-1]+1) if index == list(range(index[0], index[-1]+1)) else index
+            values = block[rows, :n] if keep.all() else np.compress(keep, block[rows, :n], axis=1)
+            frames.append(pd.DataFrame(values.T, columns=[names[i] for i in index], copy=False))
+        if(len(frames) == 1):
+            return frames[0][columns]
+        #Put the columns back in order, with Copy-on-Write the blocks are still shared
+        return pd.concat(frames, axis=1)[columns]
+
+def _unique(lst):
+    '''Returns the unique elements of lst in order of first appearance'''
+    out = []
+    for x in lst:
+        if(not x in out): out.append(x)
+    return out
+#------------------------------------------------------------------------
 
 
 #Masses for electrons and muons
@@ -413,163 +659,647 @@ JET_OBSERVS =  ['PT','Eta', 'Phi','Mass', 'Flavor', 'FlavorAlgo', 'FlavorPhys',
 EVENT_CHARS = ['Entry','MET','HT','MuonMul','ElectronMul','JetMul','MaxJetPT', 'MaxLepPT']
 
 JET_OUTPUT_OBSERVS = ['Entry','E/c', 'Px', 'Py', 'Pz'] + JET_OBSERVS
+
+#Columns copied straight from Float_t/Int_t leaves are stored as float32, counts as int64
+#   and everything that we compute as float64
+FLOAT32_OBSERVS = set(ROOT_OBSERVS + JET_OBSERVS + ['PT_ET'])
+INT_OBSERVS = set(['Entry', 'MuonMul', 'ElectronMul', 'JetMul'])
+
+def output_dtype(observ):
+    '''Returns the dtype used to store an output column'''
+    if(observ in INT_OBSERVS):
+        return 'int64'
+    elif(observ in FLOAT32_OBSERVS):
+        return 'float32'
+    return 'float64'
+ISO_MAXDIST = 0.3
 ISO_TYPES = [('MuIso', 'MuonTight'), ('EleIso','Electron'), ('ChHadIso','EFlowTrack') ,('NeuHadIso','EFlowNeutralHadron'),('GammaIso','EFlowPhoton')]
 
-def delphes_to_pandas(filepath, verbosity=1, fixedNum=None, requireLepton=True):
-    start_time = time.clock()
-    fileIN = ROOT.TFile.Open(filepath)
-    tree = fileIN.Get("Delphes")
-    if(fixedNum == None):
-        n_entries=tree.GetEntries()
-    else:
-        n_entries = fixedNum
-    # print(fileIN.summary())
-    tree.SetCacheSize(30*1024*1024)
 
-    #Get all the leaves that we need to read and their associated branches
+#---------------------------SCHEMA---------------------------------------
+#Collections that are always read, for the cuts and the event characteristics
+REQUIRED_OBJECTS = LEPTON_TYPES + ["MissingET", "Jet"]
+#Columns of track matched objects that are copied from their track
+TRACK_OBSERVS = ['X', 'Y', 'Z', 'Dxy']
+MAXLEP_OBSERVS = ["MaxLepDeltaEta", "MaxLepDeltaPhi",'MaxLepDeltaR', 'MaxLepKt', 'MaxLepAntiKt']
+MET_OBSERVS = ["METDeltaEta","METDeltaPhi",'METDeltaR', 'METKt', 'METAntiKt']
+SCHEMA_VERSION = 1
+#The TTree cache used when every leaf is read, it is scaled down with the number of active leaves
+MAX_CACHE_SIZE = 30*1024*1024
+MIN_CACHE_SIZE = 1024*1024
+
+class ParserSchema(object):
+    '''Chooses which collections and which of their columns the parser produces. Only the leaves that are
+        needed for them (and for the cuts and EventChars) are read, and derived columns whose inputs are not
+        read are left out: i.e. ChHadIso without EFlowTrack, or X,Y,Z,Dxy of leptons, which come from their track.
+        #Arguments
+            collections -- The object types to output, defaults to OBJECT_TYPES
+            columns -- (optional) A dictionary keyed by object type of the output columns to keep. Collections
+                        that are not in it keep every column. Entry is always kept.
+    '''
+    def __init__(self, collections=None, columns=None):
+        collections = OBJECT_TYPES if collections == None else list(collections)
+        columns = {} if columns == None else columns
+        for obj in set(collections) | set(columns.keys()):
+            if(not obj in OBJECT_TYPES):
+                raise ValueError("Unknown collection %r, should be one of %r" % (obj, OBJECT_TYPES))
+        self.collections = [obj for obj in OBJECT_TYPES if obj in collections]
+        self.read_collections = [obj for obj in OBJECT_TYPES if obj in self.collections or obj in REQUIRED_OBJECTS]
+
+        self.columns = {}
+        for obj in self.collections:
+            O_OBSERVS = OUTPUT_OBSERVS if obj != "Jet" else JET_OUTPUT_OBSERVS
+            wanted = columns.get(obj, O_OBSERVS)
+            unknown = [c for c in wanted if not c in O_OBSERVS]
+            if(len(unknown) > 0):
+                raise ValueError("Unknown columns %r for %r" % (unknown, obj))
+            self.columns[obj] = [c for c in O_OBSERVS if (c == "Entry" or c in wanted) and self._available(obj, c)]
+
+        self.iso_types = {}
+        for obj, ok in zip(OBJECT_TYPES, COMPUTE_ISO):
+            if(ok and obj in self.collections):
+                self.iso_types[obj] = [(iso_type, iso_obj) for iso_type, iso_obj in ISO_TYPES if iso_type in self.columns[obj]]
+
+        self.leaves = {}
+        for obj, PT_ET_type, extra_fills in zip(OBJECT_TYPES, PT_ET_TYPES, EXTRA_FILLS):
+            if(not obj in self.read_collections): continue
+            leaves = [PT_ET_type, "Eta", "Phi"] + (["Mass"] if obj == "Jet" else [])
+            wanted = set(self.columns.get(obj, []))
+            if(obj == "EFlowTrack"):
+                #Copied to the objects matched to tracks
+                for o, ok in zip(OBJECT_TYPES, TRACK_MATCH):
+                    if(ok): wanted |= set(self.columns.get(o, [])) & set(TRACK_OBSERVS)
+            candidates = JET_OBSERVS if obj == "Jet" else extra_fills
+            self.leaves[obj] = leaves + [l for l in candidates if l in wanted and not l in leaves]
+
+    def _available(self, obj, column):
+        '''Whether or not the inputs of a column are read'''
+        for iso_type, iso_obj in ISO_TYPES:
+            if(column == iso_type):
+                return iso_obj in self.read_collections
+        if(column in TRACK_OBSERVS and TRACK_MATCH[OBJECT_TYPES.index(obj)]):
+            return "EFlowTrack" in self.read_collections
+        return True
+
+    def wants(self, obj, columns):
+        '''Whether or not any of the columns are output for obj'''
+        return obj in self.columns and len(set(columns) & set(self.columns[obj])) > 0
+
+    def to_dict(self):
+        return {"version": SCHEMA_VERSION, "collections": self.collections, "columns": self.columns}
+
+    def fingerprint(self):
+        '''A SHA1 hash string of the collections and columns, stored with the output to detect stale files'''
+        h = hashlib.sha1()
+        h.update(json.dumps(self.to_dict(), sort_keys=True).encode("utf-8"))
+        return h.hexdigest()
+
+    def cache_size(self):
+        '''The size of the TTree cache for the active leaves'''
+        n_active = sum([len(leaves) for leaves in self.leaves.values()])
+        return max(int(MAX_CACHE_SIZE * n_active / float(DEFAULT_SCHEMA_LEAVES)), MIN_CACHE_SIZE)
+
+def load_schema(path):
+    '''Reads a ParserSchema from a json file like {"collections": [...], "columns": {"Electron": [...]}}'''
+    with open(path) as f:
+        d = json.load(f)
+    return ParserSchema(collections=d.get("collections", None), columns=d.get("columns", None))
+
+DEFAULT_SCHEMA = ParserSchema()
+DEFAULT_SCHEMA_LEAVES = sum([len(leaves) for leaves in DEFAULT_SCHEMA.leaves.values()])
+
+def activate_branches(tree, leaves_by_object, schema):
+    '''Disables every branch of the tree except those of the leaves that will be read, and sizes
+        the TTree cache for them'''
+    tree.SetBranchStatus("*", 0)
+    tree.SetCacheSize(schema.cache_size())
+    for obj, leaves in leaves_by_object.items():
+        #The counter leaf (obj_size) belongs to the collection's branch
+        tree.SetBranchStatus(obj, 1)
+        for observ in leaves:
+            tree.SetBranchStatus(obj + '.' + observ, 1)
+            tree.AddBranchToCache(obj + '.' + observ, True)
+#------------------------------------------------------------------------
+
+def _fill_entry(entry, new_entry, leaves_by_object, dicts_by_object, index_by_objects, schema=None):
+    '''Fills every object type, matches tracks and computes isolation for a single entry that passed the cuts,
+        reading it from ROOT with GetEntry/GetValue.
+        #Arguments
+            entry -- The entry to in the ROOT file to read from
+            new_entry -- The new entry number for the sample (Does not correspond to entry if samples are removed)
+            leaves_by_object -- A dictionary keyed by object type, containing dictionaries of tuples
+                                like (leaf, branch) keyed by observable type.
+            dicts_by_object -- A dictionary keyed by object type containing dictionaries of arrays
+                                keyed by observable type.
+            index_by_objects -- A dictionary keyed by object type of where to start filling each table.
+                                Updated in place.
+            schema -- The ParserSchema, defaults to DEFAULT_SCHEMA
+    '''
+    #Initialize some temporary helper variables
+    number_by_object = {}
+
+    # Find the PT,Eta, and Phi for the leption with the highest PT, and for the MET
+    maxLepPT_Eta_Phi = max([getMaxPt_Eta_Phi(leaves_by_object, entry, obj) for obj in LEPTON_TYPES], \
+                           key=lambda x: x[0])
+    METPT_Eta_Phi = getMaxPt_Eta_Phi(leaves_by_object, entry,"MissingET", "MET")
+    maxJetPT_Eta_Phi = getMaxPt_Eta_Phi(leaves_by_object, entry,"Jet", "PT")
+
+    fillEventChars(entry, new_entry, leaves_by_object, dicts_by_object, METPT_Eta_Phi,maxLepPT_Eta_Phi,maxJetPT_Eta_Phi)
+
+    #Fill each type of object with everything that is observable in the ROOT file for that object
+    #   in addition to Energy and the three components of momentum
+    for obj, PT_ET_type, mass, extra_fills in zip(OBJECT_TYPES, PT_ET_TYPES, MASSES, EXTRA_FILLS):
+        if(not obj in leaves_by_object): continue
+        start = index_by_objects[obj]
+        extra_fills = [other for other in extra_fills if other in leaves_by_object[obj]]
+        if obj != "Jet":
+            n = fill_object(dicts_by_object,leaves_by_object,entry,new_entry, start, obj, PT_ET_type, mass, extra_fills, maxLepPT_Eta_Phi, METPT_Eta_Phi)
+        else:
+            n = fill_jet(dicts_by_object,leaves_by_object,entry,new_entry, start)
+        dicts_by_object["NumValues"][obj][new_entry] = n
+        number_by_object[obj] = n
+
+    _match_and_isolate(dicts_by_object, index_by_objects, number_by_object, schema)
+
+class _Neighbours(object):
+    '''The particles of a run of consecutive entries that have already been filled. Each table is indexed
+        on an eta-phi grid (see isolation.py) the first time it is needed, and the neighbours within
+        ISO_MAXDIST of each particle are found once and shared by every isolation type and the track matching.
+        #Arguments
+            dicts_by_object -- A dictionary keyed by object type containing dictionaries of arrays
+                                keyed by observable type.
+            index_by_objects -- A dictionary keyed by object type of where the first entry starts in each table.
+            number_by_object -- A dictionary keyed by object type of the number of values in each entry,
+                                either an integer for a single entry or an array.
+    '''
+    def __init__(self, dicts_by_object, index_by_objects, number_by_object):
+        self.Eta_Phi_PT_by_object, self.event_by_object = {}, {}
+        self.grids, self.cache = {}, {}
+        for obj in number_by_object:
+            counts = np.atleast_1d(np.asarray(number_by_object[obj], dtype='int64'))
+            self.Eta_Phi_PT_by_object[obj] = getEtaPhiPTasNumpy(dicts_by_object,obj, index_by_objects[obj], int(counts.sum()))
+            self.event_by_object[obj] = np.repeat(np.arange(len(counts)), counts)
+
+    def grid(self, obj):
+        if(not obj in self.grids):
+            Eta, Phi, PT = self.Eta_Phi_PT_by_object[obj]
+            self.grids[obj] = EtaPhiGrid(Eta, Phi, self.event_by_object[obj], cell=ISO_MAXDIST)
+        return self.grids[obj]
+
+    def pairs(self, obj, iso_obj):
+        '''Returns (ia, ib, DRsq) like EtaPhiGrid.pairs for the particles of obj and iso_obj'''
+        if(not (obj, iso_obj) in self.cache):
+            if((iso_obj, obj) in self.cache):
+                #DeltaRsq is symmetric
+                ib, ia, DRsq = self.cache[(iso_obj, obj)]
+            else:
+                Eta, Phi, PT = self.Eta_Phi_PT_by_object[obj]
+                ia, ib, DRsq = self.grid(iso_obj).pairs(Eta, Phi, self.event_by_object[obj], maxdist=ISO_MAXDIST)
+            self.cache[(obj, iso_obj)] = (ia, ib, DRsq)
+        return self.cache[(obj, iso_obj)]
+
+def _match_tracks(dicts_by_object, index_by_objects, neighbours):
+    '''Does track matching for objects with TRACK_MATCH = True. Tracks matched to leptons are cleared from
+        the keep mask of the EFlowTrack table (see TableBuffer) and taken out of the EFlowTrack column of NumValues.
+        #Returns
+            A boolean numpy array with one value per track of the run, True for the tracks that were matched,
+            or None if the tracks are not read
+    '''
+    if(not "EFlowTrack" in neighbours.event_by_object):
+        return None
+    #A particle's closest track is almost always closer than ISO_MAXDIST, so it can be picked out of the isolation pairs.
+    trkEta, trkPhi, dummy = neighbours.Eta_Phi_PT_by_object["EFlowTrack"]
+    trk_event = neighbours.event_by_object["EFlowTrack"]
+    start_tracks = index_by_objects["EFlowTrack"]
+    omitted = np.zeros(len(trkEta), dtype=bool)
+    for obj, ok in zip(OBJECT_TYPES, TRACK_MATCH):
+        if(ok):
+            Eta, Phi, PT = neighbours.Eta_Phi_PT_by_object[obj]
+            ia, ib, DRsq = neighbours.pairs(obj, "EFlowTrack")
+            matches = nearest(ia, ib, DRsq, len(Eta))
+            #Otherwise fall back to comparing against every track in the entry
+            for i in np.nonzero(matches < 0)[0]:
+                candidates = np.nonzero(trk_event == neighbours.event_by_object[obj][i])[0]
+                if(len(candidates) > 0):
+                    matches[i] = candidates[trackMatch(Eta[i:i+1], Phi[i:i+1], trkEta[candidates], trkPhi[candidates])[0]]
+            found = np.nonzero(matches >= 0)[0]
+            omitted[matches[found]] = True
+            fillTrackMatch(dicts_by_object,obj, matches, index_by_objects[obj], start_tracks)
+
+    #Drop the tracks matched to a lepton from the output as they are found. A track matched by more
+    #   than one lepton is only dropped and subtracted once.
+    tracks = dicts_by_object["EFlowTrack"]
+    omit_rows = start_tracks + np.nonzero(omitted)[0]
+    tracks.keep[omit_rows] = False
+    np.subtract.at(dicts_by_object["NumValues"]["EFlowTrack"], tracks["Entry"][omit_rows], 1)
+    return omitted
+
+def _fill_isolation(dicts_by_object, index_by_objects, neighbours, omitted, schema=None):
+    '''Computes the isolation types of the schema for objects with COMPUTE_ISO = True, leaving out the omitted tracks'''
+    schema = DEFAULT_SCHEMA if schema == None else schema
+    for obj, ok in zip(OBJECT_TYPES, COMPUTE_ISO):
+        if(ok and obj in schema.iso_types):
+            objEta, objPhi, objPt = neighbours.Eta_Phi_PT_by_object[obj]
+            for iso_type, iso_obj in schema.iso_types[obj]:
+                ia, ib, DRsq = neighbours.pairs(obj, iso_obj)
+                weights = ~omitted[ib] if iso_obj == "EFlowTrack" else None
+                iso_val = isolation(ia, DRsq, objPt, weights)
+                iso_val = iso_val - 1.0 if obj == iso_obj else iso_val
+                fillIso(dicts_by_object,obj, iso_type, index_by_objects[obj], iso_val)
+
+def _record_nothing(stage, f, *args, **kwargs):
+    '''The default recorder of iter_delphes_tables, calls f(*args, **kwargs)'''
+    return f(*args, **kwargs)
+
+def _match_and_isolate(dicts_by_object, index_by_objects, number_by_object, schema=None, recorder=None):
+    '''Matches tracks and computes isolation for a run of consecutive entries that have already been filled,
+        then moves index_by_objects past them.
+        #Arguments
+            dicts_by_object -- A dictionary keyed by object type containing dictionaries of arrays
+                                keyed by observable type.
+            index_by_objects -- A dictionary keyed by object type of where the first entry starts in each table.
+                                Updated in place.
+            number_by_object -- A dictionary keyed by object type of the number of values in each entry,
+                                either an integer for a single entry or an array.
+            schema -- The ParserSchema, defaults to DEFAULT_SCHEMA
+            recorder -- (optional) The recorder of iter_delphes_tables
+    '''
+    record = _record_nothing if recorder == None else recorder
+    #Building the grids of the tracks and the pairs of leptons and tracks counts towards track matching
+    neighbours = record('track matching', _Neighbours, dicts_by_object, index_by_objects, number_by_object)
+    omitted = record('track matching', _match_tracks, dicts_by_object, index_by_objects, neighbours)
+    record('isolation', _fill_isolation, dicts_by_object, index_by_objects, neighbours, omitted, schema)
+    for obj in number_by_object:
+        index_by_objects[obj] += int(np.sum(number_by_object[obj]))
+
+def fill_block(selected, new_entry, counts_by_object, columns_by_object, dicts_by_object, index_by_objects, schema=None):
+    '''Fills every object type and the event characteristics for the selected entries of a block read by
+        read_block. The kinematics of all of their particles are computed at once (see kinematics.py)
+        instead of one TLorentzVector at a time like fill_object and fill_jet.
+        #Arguments
+            selected -- A sorted numpy array of the entries (relative to the start of the block) that passed the cuts
+            new_entry -- The new entry number of the first selected entry
+            counts_by_object -- The counts returned by read_block
+            columns_by_object -- The columns returned by read_block
+            dicts_by_object -- A dictionary keyed by object type containing dictionaries of arrays
+                                keyed by observable type.
+            index_by_objects -- A dictionary keyed by object type of where to start filling each table.
+                                Not updated, see _match_and_isolate.
+            schema -- The ParserSchema, defaults to DEFAULT_SCHEMA. Derived columns that it does not output
+                        are not computed.
+        #Returns
+            A dictionary keyed by object type of int64 arrays with the number of values filled for each selected entry
+    '''
+    schema = DEFAULT_SCHEMA if schema == None else schema
+    selected = np.asarray(selected, dtype='int64')
+    new_entries = np.arange(new_entry, new_entry+len(selected), dtype='int64')
+    number_by_object, rows_by_object = {}, {}
+    for obj in schema.read_collections:
+        number_by_object[obj] = counts_by_object[obj][selected]
+        rows_by_object[obj] = block_rows(counts_by_object[obj], selected)
+
+    def _leading(obj, PT_ET_MET="PT"):
+        cols, rows = columns_by_object[obj], rows_by_object[obj]
+        return leading(cols[PT_ET_MET][rows], cols["Eta"][rows], cols["Phi"][rows], number_by_object[obj])
+
+    # Find the PT,Eta, and Phi for the leption with the highest PT, and for the MET
+    #   (ties go to the electron like the max() in _fill_entry)
+    elec, muon = [_leading(obj) for obj in LEPTON_TYPES]
+    use_muon = muon[0] > elec[0]
+    maxLepPT, maxLepEta, maxLepPhi = [np.where(use_muon, m, e) for e, m in zip(elec, muon)]
+    METPT, METEta, METPhi = _leading("MissingET", "MET")
+    maxJetPT = _leading("Jet")[0]
+
+    d = dicts_by_object["EventChars"]
+    sl = slice(new_entry, new_entry+len(selected))
+    d['Entry'][sl] = new_entries
+    d['HT'][sl] = segment_sum(columns_by_object["Jet"]["PT"][rows_by_object["Jet"]], number_by_object["Jet"])
+    d['JetMul'][sl] = number_by_object["Jet"]
+    d['ElectronMul'][sl] = number_by_object["Electron"]
+    d['MuonMul'][sl] = number_by_object["MuonTight"]
+    d['MET'][sl] = METPT
+    d['MaxLepPT'][sl] = maxLepPT
+    d['MaxJetPT'][sl] = maxJetPT
+
+    for obj, PT_ET_type, mass, extra_fills in zip(OBJECT_TYPES, PT_ET_TYPES, MASSES, EXTRA_FILLS):
+        if(not obj in number_by_object): continue
+        counts, rows = number_by_object[obj], rows_by_object[obj]
+        cols = columns_by_object[obj]
+        fill_dict = dicts_by_object[obj]
+        start = index_by_objects[obj]
+        sl = slice(start, start+len(rows))
+        PT, Eta, Phi = cols[PT_ET_type][rows], cols["Eta"][rows], cols["Phi"][rows]
+        if obj == "Jet":
+            mass = cols["Mass"][rows]
+        fill_dict["Entry"][sl] = np.repeat(new_entries, counts)
+        if(schema.wants(obj, ["E/c", "Px", "Py", "Pz"])):
+            fill_dict["E/c"][sl], fill_dict["Px"][sl], fill_dict["Py"][sl], fill_dict["Pz"][sl] = four_momentum(PT, Eta, Phi, mass)
+        if obj != "Jet":
+            fill_dict["PT_ET"][sl] = PT
+            fill_dict["Eta"][sl] = Eta
+            fill_dict["Phi"][sl] = Phi
+            lepEta, lepPhi = per_entry(maxLepEta, counts), per_entry(maxLepPhi, counts)
+            if(schema.wants(obj, MAXLEP_OBSERVS)):
+                (fill_dict["MaxLepDeltaEta"][sl], fill_dict["MaxLepDeltaPhi"][sl], fill_dict["MaxLepDeltaR"][sl],
+                 fill_dict["MaxLepKt"][sl], fill_dict["MaxLepAntiKt"][sl]) = \
+                    relative_observables(PT, Eta, Phi, per_entry(maxLepPT, counts), lepEta, lepPhi)
+            #Like fill_object the MET deltas are taken w.r.t the direction of the leading lepton
+            if(schema.wants(obj, MET_OBSERVS)):
+                (fill_dict["METDeltaEta"][sl], fill_dict["METDeltaPhi"][sl], fill_dict["METDeltaR"][sl],
+                 fill_dict["METKt"][sl], fill_dict["METAntiKt"][sl]) = \
+                    relative_observables(PT, Eta, Phi, per_entry(METPT, counts), lepEta, lepPhi)
+            for other in extra_fills:
+                if(other in cols):
+                    fill_dict[other][sl] = cols[other][rows]
+        else:
+            for key, col in cols.items():
+                fill_dict[key][sl] = col[rows]
+        dicts_by_object["NumValues"][obj][new_entries] = counts
+    return number_by_object
+
+def delphes_to_pandas(filepath, verbosity=1, fixedNum=None, requireLepton=True, columnar=True, block_size=DEFAULT_BLOCK_SIZE,
+                      num_leptons=1, lepton_PT_threshold=20.0, num_jets=2, jet_PT_threshold=40.0, entry_range=None, fan_out=1,
+                      schema=None):
+    '''Parses a Delphes ROOT file into a dictionary of pandas DataFrames keyed by object type
+        #Arguments
+            filepath -- The path to the ROOT file, or an open tree like a SyntheticTree (see open_tree)
+            verbosity -- Whether or not to print out the progress
+            fixedNum -- If not None only parse this many entries
+            requireLepton -- Whether or not each entry must have a lepton passing the lepton cuts
+            columnar -- If True read the leaves in blocks of entries as numpy arrays with read_block,
+                        otherwise read each entry from ROOT with GetEntry/GetValue
+            block_size -- The number of entries to read at a time when columnar=True
+            num_leptons -- The number of electrons and muons above lepton_PT_threshold required by the lepton cuts
+            num_jets -- The number of jets above jet_PT_threshold required by the jet cuts
+            entry_range -- If not None, a tuple (first, stop) of the entries of the ROOT file to parse
+            fan_out -- The number of processes to split the entries between. Each one parses a disjoint
+                        range of entries and the results are put back together with merge_frames.
+            schema -- (optional) A ParserSchema choosing the collections and columns to output, defaults
+                        to every collection in OBJECT_TYPES with all of their columns
+        #Returns
+            A dictionary of DataFrames keyed by the object types of the schema plus "NumValues" and "EventChars"
+    '''
+    kwargs = dict(fixedNum=fixedNum, requireLepton=requireLepton, columnar=columnar, block_size=block_size,
+                  num_leptons=num_leptons, lepton_PT_threshold=lepton_PT_threshold,
+                  num_jets=num_jets, jet_PT_threshold=jet_PT_threshold, schema=schema)
+    if(fan_out > 1):
+        return parse_in_parallel(filepath, fan_out, entry_range=entry_range, verbosity=verbosity, **kwargs)
+    chunks = iter_delphes_to_pandas(filepath, chunk_size=None, verbosity=verbosity, entry_range=entry_range, **kwargs)
+    return list(chunks)[0]
+
+def split_entry_range(first, stop, fan_out):
+    '''Splits range(first, stop) into at most fan_out contiguous (first, stop) ranges of about the same size'''
+    bounds = np.linspace(first, stop, max(min(fan_out, stop-first), 1) + 1).astype('int64')
+    return [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:])]
+
+def merge_frames(parts):
+    '''Concatenates the outputs of delphes_to_pandas for consecutive entry ranges of the same file. Entry
+        numbers (and the index of NumValues and EventChars) of each part are shifted by the number of entries
+        in the parts before it.
+        #Arguments
+            parts -- A list of dictionaries of DataFrames in the order of their entry ranges
+        #Returns
+            A dictionary of DataFrames like delphes_to_pandas
+    '''
+    pandas_out = {}
+    offsets = np.cumsum([0] + [len(part["NumValues"].index) for part in parts])
+    for key in parts[0].keys():
+        frames = []
+        for offset, part in zip(offsets, parts):
+            df = part[key].copy()
+            if("Entry" in df.columns):
+                df["Entry"] += offset
+            if(key in ("NumValues", "EventChars")):
+                df.index = df.index + offset
+            frames.append(df)
+        pandas_out[key] = pd.concat(frames, ignore_index=not key in ("NumValues", "EventChars"))
+    return pandas_out
+
+def _parse_range_worker(filepath, entry_range, kwargs, conn):
+    '''Parses one entry range in a worker process and sends the frames (or the error) back through conn'''
+    try:
+        conn.send((delphes_to_pandas(filepath, verbosity=0, entry_range=entry_range, **kwargs), None))
+    except Exception as e:
+        conn.send((None, "%s: %s" % (type(e).__name__, e)))
+    conn.close()
+
+def parse_in_parallel(filepath, fan_out, entry_range=None, fixedNum=None, verbosity=1, **kwargs):
+    '''Parses disjoint entry ranges of a single ROOT file in fan_out worker processes and merges them.
+        Tracks matched to leptons are removed inside each range, so the result is the same as parsing
+        the whole range in one process.
+        #Arguments
+            filepath -- The path to the ROOT file
+            fan_out -- The number of worker processes
+            entry_range -- If not None, a tuple (first, stop) of the entries to parse
+            fixedNum -- If not None only parse this many entries
+            **kwargs -- Passed on to delphes_to_pandas
+        #Returns
+            A dictionary of DataFrames like delphes_to_pandas
+    '''
+    from multiprocessing import Process, Pipe
+    start_time = time.time()
+    fileIN, tree = open_tree(filepath)
+    n_entries = tree.GetEntries() if fixedNum == None else fixedNum
+    if(fileIN != None): fileIN.Close()
+    first, stop = (0, n_entries) if entry_range == None else (entry_range[0], min(entry_range[1], n_entries))
+
+    workers = []
+    for sub_range in split_entry_range(first, stop, fan_out):
+        recv, send = Pipe(duplex=False)
+        p = Process(target=_parse_range_worker, args=(filepath, sub_range, dict(kwargs, fixedNum=fixedNum), send))
+        p.start()
+        send.close()
+        workers.append((sub_range, p, recv))
+    parts, errors = [], []
+    for sub_range, p, recv in workers:
+        #Receive before joining so that large results do not block the pipe
+        try:
+            frames, error = recv.recv()
+        except EOFError:
+            frames, error = None, "Worker exited with code %r" % p.exitcode
+        p.join()
+        if(error != None):
+            errors.append("entries %r: %s" % (sub_range, error))
+        parts.append(frames)
+    if(len(errors) > 0):
+        raise ValueError("Failed to parse %r: %s" % (filepath, "; ".join(errors)))
+    pandas_out = merge_frames(parts)
+    if (verbosity > 0): print("ElapseTime: %.2f" % float(time.time()-start_time))
+    if (verbosity > 0): print("Converted: %r of %r Entries in %r processes" % (len(pandas_out["NumValues"].index), stop-first, len(parts)))
+    return pandas_out
+
+def find_leaves(tree, schema=None):
+    '''Gets all the leaves that we need to read for a ParserSchema (DEFAULT_SCHEMA by default) and their associated branches.
+        Leaves that are not in the tree are skipped.
+        #Returns
+            A dictionary keyed by object type, containing dictionaries of tuples like (leaf, branch)
+            keyed by observable type.
+    '''
+    schema = DEFAULT_SCHEMA if schema == None else schema
     leaves_by_object = {}
-    for obj in OBJECT_TYPES:
+    for obj in schema.read_collections:
         leaves_by_object[obj] = {}
-        OBSERVS = ROOT_OBSERVS if obj != "Jet" else JET_OBSERVS
-        for observ in OBSERVS:
+        for observ in schema.leaves[obj]:
             leaf = tree.GetLeaf(obj + '.' + observ)
-            if(isinstance(leaf,ROOT.TLeafElement)):
+            if(_is_leaf(leaf)):
                 leaves_by_object[obj][observ] = (leaf, leaf.GetBranch())
     # leaf = tree.GetLeaf('HepMCEvent.ProcessID')
     # leaves_by_object["HepMCEvent.ProcessID"] = (leaf, leaf.GetBranch())
+    return leaves_by_object
 
-    #Allocate the data for the tables by filling arrays with zeros
+def allocate_tables(counts_by_object, n_entries):
+    '''Preallocates zeroed typed buffers for the tables to avoid reallocating data later
+        #Arguments
+            counts_by_object -- A dictionary keyed by object type of the number of values in each entry,
+                                for every object type that is read
+            n_entries -- The number of entries
+        #Returns
+            A dictionary of TableBuffers keyed by object type plus "NumValues" and "EventChars"
+    '''
     dicts_by_object = {}
-    dicts_by_object["NumValues"] = {}
-    dicts_by_object["EventChars"] = {}
-    for obj in OBJECT_TYPES:
-        dicts_by_object[obj] = {}
-        (leaf, branch) = leaves_by_object[obj]['Phi']
-        total_values = 0
-
-        #Loop over all the Phi values (since everything has Phi) and accumulate
-        #   the total number of values for each object type
-        for entry in range(n_entries):
-            branch.GetEntry(entry)
-            total_values += leaf.GetLen()
-
-        #Fill arrays with zeros to avoid reallocating data later
+    objects = [obj for obj in OBJECT_TYPES if obj in counts_by_object]
+    for obj in objects:
         O_OBSERVS = OUTPUT_OBSERVS if obj != "Jet" else JET_OUTPUT_OBSERVS
-        # print(obj, len(OBSERVS), )
-        for observ in O_OBSERVS:
-            dicts_by_object[obj][observ] = [0] * total_values
-        dicts_by_object["NumValues"][obj] = [0] * n_entries
-    for char in EVENT_CHARS:
-        dicts_by_object["EventChars"][char] = [0]* n_entries
-        
-
-
-    index_by_objects = {o:0 for o in OBJECT_TYPES}
-    last_time = time.clock()
-    prev_entry = 0
-    to_ommit = []
-    cut_sample_count = 0
-    new_entry = 0
-    for entry in range(n_entries):
-
-        #Make a pretty progress bar in the terminal
-        if(verbosity > 0):
-            c = time.clock() 
-            if(c > last_time + .25):
-                percent = float(entry)/float(n_entries)
-                sys.stdout.write('\r')
-                sys.stdout.write("[%-20s] %r/%r  %r(Entry/sec)" % ('='*int(20*percent), entry, int(n_entries), 4 * (entry-prev_entry)))
-                sys.stdout.flush()
-                last_time = c
-                prev_entry = entry
-
-        #Initialize some temporary helper variables
-        number_by_object = {}
-        Eta_Phi_PT_by_object = {}
-
-        if((passLeptonCuts(entry,leaves_by_object) or not requireLepton) and passJetCuts(entry, leaves_by_object)):
-            # Find the PT,Eta, and Phi for the leption with the highest PT, and for the MET
-            maxLepPT_Eta_Phi = max([getMaxPt_Eta_Phi(leaves_by_object, entry, obj) for obj in LEPTON_TYPES], \
-                                   key=lambda x: x[0])
-            METPT_Eta_Phi = getMaxPt_Eta_Phi(leaves_by_object, entry,"MissingET", "MET")
-            maxJetPT_Eta_Phi = getMaxPt_Eta_Phi(leaves_by_object, entry,"Jet", "PT")
-            
-            fillEventChars(entry, new_entry, leaves_by_object, dicts_by_object, METPT_Eta_Phi,maxLepPT_Eta_Phi,maxJetPT_Eta_Phi)
-
-            #Fill each type of object with everything that is observable in the ROOT file for that object
-            #   in addition to Energy and the three components of momentum
-            for obj, PT_ET_type, mass, extra_fills in zip(OBJECT_TYPES, PT_ET_TYPES, MASSES, EXTRA_FILLS):
-                start = index_by_objects[obj]
-                if obj != "Jet":
-                    n = fill_object(dicts_by_object,leaves_by_object,entry,new_entry, start, obj, PT_ET_type, mass, extra_fills, maxLepPT_Eta_Phi, METPT_Eta_Phi)
-                else:
-                    n = fill_jet(dicts_by_object,leaves_by_object,entry,new_entry, start)
-                dicts_by_object["NumValues"][obj][new_entry] = n
-                number_by_object[obj] = n
-                Eta_Phi_PT_by_object[obj] = getEtaPhiPTasNumpy(dicts_by_object,obj, start, n)
-
-            #Do Track matching for objects with TRACK_MATCH = True
-            trkEta, trkPhi, dummy = Eta_Phi_PT_by_object["EFlowTrack"]
-            start_tracks = index_by_objects["EFlowTrack"]
-            for obj, ok in zip(OBJECT_TYPES, TRACK_MATCH):
-                if(ok):
-                    start = index_by_objects[obj]
-                    Phi, Eta, PT = Eta_Phi_PT_by_object[obj]
-                    matches = trackMatch(Phi, Eta, trkEta, trkPhi)
-                    track_ommitions = matches.tolist()
-                    to_ommit += [start_tracks + x for x in track_ommitions]
-                    isoEta, isoPhi, isoPt = Eta_Phi_PT_by_object["EFlowTrack"]
-
-                    #Omit info for repeat tracks, for Isolation calculation
-                    sel = np.arange(len(isoEta))
-                    sel = np.delete(sel, track_ommitions)
-                    Eta_Phi_PT_by_object["EFlowTrack"] = isoEta[sel], isoPhi[sel], isoPt[sel]
-                    fillTrackMatch(dicts_by_object,obj, matches, start, start_tracks)
-
-            #Compute isolation
-            for obj, ok in zip(OBJECT_TYPES, COMPUTE_ISO):
-                start = index_by_objects[obj]
-                if(ok):
-                    objEta, objPhi, objPt = Eta_Phi_PT_by_object[obj]
-                    for iso_type, iso_obj in ISO_TYPES:
-                        isoEta, isoPhi, isoPt = Eta_Phi_PT_by_object[iso_obj]
-                        iso_val = Iso(objEta, objPhi, objPt, isoEta, isoPhi)
-                        iso_val = iso_val - 1.0 if obj == iso_obj else iso_val
-                        fillIso(dicts_by_object,obj, iso_type,  start, iso_val)
-
-            for obj in OBJECT_TYPES:
-                index_by_objects[obj] += number_by_object[obj]
-            new_entry += 1
-        else:
-            cut_sample_count +=1
-    pandas_out = {}
-    for obj,d in dicts_by_object.items():
-        if(obj == "NumValues"):
-            df = pd.DataFrame(d, columns=OBJECT_TYPES)
-        elif(obj == "EventChars"):
-            df = pd.DataFrame(d, columns=EVENT_CHARS)
-        else:
-            O_OBSERVS = OUTPUT_OBSERVS if obj != "Jet" else JET_OUTPUT_OBSERVS
-            df = pd.DataFrame(d, columns=O_OBSERVS)
-        pandas_out[obj] = df.loc[(df!=0.0).any(axis=1)]
-    
-    #Remove Tracks that correspond to Electrons and Muons
-    df = pandas_out["EFlowTrack"]
-    to_drop = df.iloc[to_ommit]
-    to_subtract = to_drop[['Entry']].groupby('Entry').agg({'Entry':'count'})
-    to_subtract = to_subtract.rename(columns={'Entry':'EFlowTrack'})
-   
-    #Update the numValues so that they are correct
-    pandas_out["NumValues"] = pandas_out["NumValues"].sub(to_subtract,fill_value=0)
+        dicts_by_object[obj] = TableBuffer(O_OBSERVS, int(counts_by_object[obj].sum()), output_dtype)
+    dicts_by_object["NumValues"] = TableBuffer(objects, n_entries, lambda c: 'int64')
+    dicts_by_object["EventChars"] = TableBuffer(EVENT_CHARS, n_entries, output_dtype)
+    return dicts_by_object
+
+def iter_delphes_to_pandas(filepath, chunk_size=None, start=0, verbosity=1, schema=None, **kwargs):
+    '''Parses a Delphes ROOT file chunk_size entries at a time, so that only one chunk of the tables is in
+        memory at once. Yields a dictionary of DataFrames like delphes_to_pandas for each chunk. Entry numbers
+        and the index of NumValues and EventChars count from the beginning of the file, so that the chunks can
+        simply be appended to each other. See iter_delphes_tables for the arguments.
+    '''
+    for dicts_by_object, n_chunk, index_by_objects, chunk_start in iter_delphes_tables(filepath, chunk_size=chunk_size, start=start,
+                                                                                     verbosity=verbosity, schema=schema, **kwargs):
+        yield _to_frames(dicts_by_object, n_chunk, index_by_objects, chunk_start, schema)
+
+def iter_delphes_tables(filepath, chunk_size=None, start=0, verbosity=1, fixedNum=None, requireLepton=True, columnar=True,
+                        block_size=DEFAULT_BLOCK_SIZE, num_leptons=1, lepton_PT_threshold=20.0, num_jets=2, jet_PT_threshold=40.0,
+                        entry_range=None, schema=None, recorder=None):
+    '''Parses a Delphes ROOT file chunk_size entries at a time into TableBuffers, without building any DataFrames.
+        Entry numbers in the buffers count from the start of each chunk.
+        #Arguments
+            filepath -- The path to the ROOT file, or an open tree like a SyntheticTree (see open_tree)
+            chunk_size -- The number of entries (that pass the cuts) in each chunk. If None everything is one chunk.
+            start -- The number of entries (that pass the cuts) to skip, i.e. because they were already written
+                        by a previous run. If there is nothing left a single empty chunk is yielded.
+            entry_range -- If not None, a tuple (first, stop) of the entries of the ROOT file to parse. Entry
+                        numbers in the output still count from 0.
+            recorder -- (optional) A function like recorder(stage, f, *args, **kwargs) that returns f(*args, **kwargs),
+                        called for every stage of the parser ('preselection', 'read', 'fill', 'track matching' and
+                        'isolation') so that they can be timed, see parser_benchmark.py. Without columnar
+                        everything after the preselection is part of 'fill'.
+            (See delphes_to_pandas for the rest)
+        #Yields
+            (dicts_by_object, number of entries in the chunk, index_by_objects, first entry of the chunk) for each
+            chunk, where dicts_by_object holds the TableBuffers of allocate_tables and index_by_objects the number of
+            rows filled in each of them
+    '''
+    start_time = time.time()
+    schema = DEFAULT_SCHEMA if schema == None else schema
+    fileIN, tree = open_tree(filepath)
+    if(fixedNum == None):
+        n_entries=tree.GetEntries()
+    else:
+        n_entries = fixedNum
+    first_entry = 0
+    if(entry_range != None):
+        first_entry = entry_range[0]
+        n_entries = max(min(entry_range[1], n_entries) - first_entry, 0)
+    # print(fileIN.summary())
 
-    #assert pandas_out["NumValues"]['EFlowTrack'].dtype == int, "NumValues is wrong dtype, %r" %  pandas_out["EFlowTrack"]['Entry'].dtype
-    
-    cleaned = df.drop(df.index[to_ommit]).reset_index(drop=True)
-    pandas_out["EFlowTrack"] = cleaned
+    #Only the branches of the leaves in the schema are read from disk
+    leaves_by_object = find_leaves(tree, schema)
+    activate_branches(tree, leaves_by_object, schema)
+
+    #Count the number of values of every object type in every entry in a single pass
+    record = _record_nothing if recorder == None else recorder
+    counts_by_object = record('preselection', read_counts, tree, schema.read_collections, first_entry, n_entries)
+
+    #Apply the cuts to every entry at once, only the entries that pass are read any further
+    accepted = first_entry + np.nonzero(record('preselection', preselect, tree, n_entries, counts_by_object, first=first_entry,
+                                               requireLepton=requireLepton, num_leptons=num_leptons,
+                                               lepton_PT_threshold=lepton_PT_threshold, num_jets=num_jets,
+                                               jet_PT_threshold=jet_PT_threshold))[0]
+    n_accepted = len(accepted)
+    cut_sample_count = n_entries - n_accepted
+    counts_by_object = {obj: c[accepted-first_entry] for obj, c in counts_by_object.items()}
+    if(columnar):
+        #From now on TTree::Draw reads the accepted entries, and firstentry counts along them
+        previous_list = tree.GetEntryList()
+        tree.SetEntryList(_entry_list(tree, accepted))
 
-    if (verbosity > 0): print("ElapseTime: %.2f" % float(time.clock()-start_time))
+    try:
+        if(chunk_size == None):
+            chunk_size = max(n_accepted - start, 1)
+        chunk_starts = list(range(start, n_accepted, chunk_size)) or [n_accepted]
+        last_time = time.time()
+        prev_entry = start
+        for chunk_start in chunk_starts:
+            n_chunk = min(chunk_size, n_accepted-chunk_start)
+            chunk_counts = {obj: c[chunk_start:chunk_start+n_chunk] for obj, c in counts_by_object.items()}
+
+            dicts_by_object = allocate_tables(chunk_counts, n_chunk)
+
+            #Entries are numbered from the start of the chunk while filling
+            index_by_objects = {o:0 for o in schema.read_collections}
+            for new_entry in range(0, n_chunk, block_size if columnar else 1):
+
+                #Make a pretty progress bar in the terminal
+                if(verbosity > 0):
+                    c = time.time()
+                    entry = chunk_start + new_entry
+                    if(c > last_time + .25):
+                        percent = float(entry)/float(n_accepted)
+                        sys.stdout.write('\r')
+                        sys.stdout.write("[%-20s] %r/%r  %r(Entry/sec)" % ('='*int(20*percent), entry, int(n_accepted), 4 * (entry-prev_entry)))
+                        sys.stdout.flush()
+                        last_time = c
+                        prev_entry = entry
+
+                if(not columnar):
+                    record('fill', _fill_entry, int(accepted[chunk_start+new_entry]), new_entry, leaves_by_object,
+                           dicts_by_object, index_by_objects, schema)
+                    continue
+
+                #Read the next block of accepted entries into memory all at once and fill them
+                n_block = min(block_size, n_chunk-new_entry)
+                block_counts = {obj: chunk_counts[obj][new_entry:new_entry+n_block] for obj in leaves_by_object}
+                block_counts, block_columns = record('read', read_block, tree, leaves_by_object, chunk_start+new_entry,
+                                                     n_block, counts_by_object=block_counts)
+                number_by_object = record('fill', fill_block, np.arange(n_block), new_entry, block_counts, block_columns,
+                                          dicts_by_object, index_by_objects, schema)
+                _match_and_isolate(dicts_by_object, index_by_objects, number_by_object, schema, recorder)
+
+            yield dicts_by_object, n_chunk, index_by_objects, chunk_start
+    finally:
+        #Trees that stay open, like SyntheticTrees, can be parsed again, even if the chunks were not all read
+        if(columnar):
+            tree.SetEntryList(previous_list)
+    if (verbosity > 0): print("ElapseTime: %.2f" % float(time.time()-start_time))
     if (verbosity > 0): print("Converted: %r of %r Entries %0.3f%% ommited %0.3f%% retained" \
-                              % (n_entries-cut_sample_count, n_entries, 100*float(cut_sample_count)/float(n_entries),100*float(n_entries-cut_sample_count)/float(n_entries) ))
+                              % (n_entries-cut_sample_count, n_entries, 100*float(cut_sample_count)/float(max(n_entries, 1)),100*float(n_entries-cut_sample_count)/float(max(n_entries, 1)) ))
+
+def _to_frames(dicts_by_object, n_entries, index_by_objects, first_entry=0, schema=None):
+    '''Turns the filled table buffers of a chunk into DataFrames and shifts the entry numbers of the chunk
+        by first_entry. Rows that were dropped while filling (i.e. tracks matched to leptons) are left out, and
+        only the collections and columns of the schema are kept.'''
+    schema = DEFAULT_SCHEMA if schema == None else schema
+    pandas_out = {}
+    for obj in schema.collections:
+        #Only the rows that were actually filled
+        pandas_out[obj] = dicts_by_object[obj].to_frame(index_by_objects[obj], schema.columns[obj])
+    pandas_out["NumValues"] = dicts_by_object["NumValues"].to_frame(n_entries, schema.collections)
+    pandas_out["EventChars"] = dicts_by_object["EventChars"].to_frame(n_entries)
+
+    if(first_entry != 0):
+        for obj, df in pandas_out.items():
+            if("Entry" in df.columns):
+                df["Entry"] += first_entry
+        for obj in ("NumValues", "EventChars"):
+            pandas_out[obj].index = pandas_out[obj].index + first_entry
     return pandas_out
 
 
@@ -590,19 +1320,22 @@ def roundrobin(*iterables):
 
 def makeJobs(data_folder,
                 storeType,
-                pandas_folder ="/pandas/"):
+                pandas_folder ="/pandas/",
+                chunk_size=None,
+                fan_out=1,
+                schema=None):
     if(data_folder[-1] == "/"): data_folder = data_folder[0:-1]
     files = glob.glob(data_folder + "/*.root")
     store_dir = data_folder + pandas_folder
     print(store_dir)
     if not os.path.exists(store_dir): os.makedirs(store_dir)
-    jobs = [ (f,  store_dir, storeType) for f in files]
+    jobs = [ (f,  store_dir, storeType, chunk_size, fan_out, schema) for f in files]
     return jobs
 
 def doJob(job, redo=False):
-    f, store_dir, storeType = job
+    f, store_dir, storeType, chunk_size, fan_out, schema = job
     try:
-        return store(f, store_dir,rerun=redo,storeType=storeType)
+        return store(f, store_dir,rerun=redo,storeType=storeType, chunk_size=chunk_size, fan_out=fan_out, schema=schema)
     except Exception as e:
         print(e)
         print("Something weird happened when parsing %r." % f)
@@ -611,59 +1344,292 @@ def doJob(job, redo=False):
 
 
 
-def store(filepath, outputdir, rerun=False, storeType="hdf5"):
+#---------------------------STREAMING------------------------------------
+def progress_path(out_file):
+    '''The path of the progress marker written next to a streamed HDFStore'''
+    return out_file + ".progress.json"
+
+def read_progress(out_file):
+    '''Returns the progress marker of a streamed HDFStore or None if there is none'''
+    path = progress_path(out_file)
+    if(not os.path.exists(path)):
+        return None
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+def write_json_atomic(obj, path):
+    '''Writes a json object to path by writing a temporary file and renaming it, so that readers
+        never see a partially written file'''
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(obj, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+def write_progress(out_file, progress):
+    '''Atomically replaces the progress marker of a streamed HDFStore'''
+    write_json_atomic(progress, progress_path(out_file))
+
+def read_fingerprint(store):
+    '''Returns the fingerprint of the ParserSchema that an open HDFStore was written with, or None if it has
+        no tables. Stores written before fingerprints were recorded hold every column, like DEFAULT_SCHEMA.'''
+    if(not "/NumValues" in store.keys()):
+        return None
+    return getattr(store.get_storer("NumValues").attrs, "schema", DEFAULT_SCHEMA.fingerprint())
+
+def write_fingerprint(store, fingerprint):
+    '''Records the fingerprint of a ParserSchema with the tables of an open HDFStore'''
+    if("/NumValues" in store.keys()):
+        store.get_storer("NumValues").attrs.schema = fingerprint
+
+def schema_path(out_file):
+    '''Returns the path of the file recording the ParserSchema of a msgpack output'''
+    return out_file + ".schema.json"
+
+def read_schema_record(out_file):
+    '''Returns the fingerprint recorded next to a msgpack output, see read_fingerprint'''
+    if(not os.path.exists(schema_path(out_file))):
+        return DEFAULT_SCHEMA.fingerprint()
+    with open(schema_path(out_file)) as f:
+        return json.load(f)["fingerprint"]
+
+def read_columnar_fingerprint(out_file):
+    '''Returns the fingerprint recorded in a columnar output, or None if it cannot be read'''
+    try:
+        f = ColumnarFile(out_file)
+    except (IOError, OSError, KeyError):
+        return None
+    try:
+        return f.attrs().get("schema", None)
+    finally:
+        f.close()
+
+def write_columnar_output(filepath, out_file, chunk_size=None, fan_out=1, schema=None):
+    '''Parses a Delphes ROOT file into a columnar file (see storage.columnar). The file is written under a
+        temporary name and renamed once it is complete, so a killed job never leaves a partial file behind.
+        #Arguments
+            filepath -- The path to the ROOT file
+            out_file -- The path of the columnar file to write
+            chunk_size -- If not None parse and append chunk_size entries at a time, so that memory use does not
+                            grow with the size of the file
+            fan_out -- The number of processes to parse the file with when chunk_size is None
+            schema -- (optional) The ParserSchema to parse with
+        #Returns
+            The number of entries written
+    '''
+    schema = DEFAULT_SCHEMA if schema == None else schema
+    tmp = out_file + ".tmp"
+    writer = ColumnarWriter(tmp)
+    try:
+        if(chunk_size != None):
+            for frames in iter_delphes_to_pandas(filepath, chunk_size=chunk_size, schema=schema):
+                writer.append(frames)
+        else:
+            writer.append(delphes_to_pandas(filepath, fan_out=fan_out, schema=schema))
+    except Exception:
+        writer.close()
+        os.remove(tmp)
+        raise
+    num = writer.entries
+    writer.close(schema=schema.fingerprint())
+    os.rename(tmp, out_file)
+    return num
+
+def write_hdf5_output(out_file, frames, fingerprint):
+    '''Writes a dictionary of DataFrames to an HDFStore under a temporary name and renames it once it is
+        complete, so a killed job never leaves a partial file behind (or destroys a good one).
+        #Arguments
+            out_file -- The path of the HDFStore to write
+            frames -- A dictionary of DataFrames keyed by table, like the output of delphes_to_pandas
+            fingerprint -- The fingerprint of the ParserSchema the frames were parsed with
+    '''
+    tmp = out_file + ".tmp"
+    store = pd.HDFStore(tmp, mode='w')
+    try:
+        for key,frame in frames.items():
+            store.put(key, frame, format='table')
+        write_fingerprint(store, fingerprint)
+    except Exception:
+        store.close()
+        os.remove(tmp)
+        raise
+    store.close()
+    os.rename(tmp, out_file)
+
+def stream_to_hdf5(filepath, out_file, chunk_size, rerun=False, verbosity=1, **kwargs):
+    '''Parses a Delphes ROOT file chunk_size entries at a time with iter_delphes_to_pandas and appends each chunk to
+        an HDFStore, so that memory use does not grow with the size of the file. After each chunk is flushed a
+        progress marker (see progress_path) records how many entries and table rows have been committed. If the job
+        is killed, calling stream_to_hdf5 again removes any rows written after the last commit and resumes
+        from there. Output written with a different ParserSchema is stale and is parsed again.
+        #Arguments
+            filepath -- The path to the ROOT file
+            out_file -- The path of the HDFStore to write
+            chunk_size -- The number of entries to parse and write at a time
+            rerun -- If True start over even if the file was already (partially) written
+            **kwargs -- Passed on to iter_delphes_to_pandas
+        #Returns
+            The number of entries in the HDFStore
+    '''
+    schema = kwargs.get("schema", None) or DEFAULT_SCHEMA
+    fingerprint = schema.fingerprint()
+    required = set(["/"+key for key in schema.collections+["EventChars","NumValues"]])
+    progress = read_progress(out_file)
+    if(progress != None and progress.get("schema", DEFAULT_SCHEMA.fingerprint()) != fingerprint):
+        if(verbosity > 0): print("%r was written with a different schema, starting over" % out_file)
+        rerun = True
+    store = pd.HDFStore(out_file)
+    try:
+        if(not rerun and progress == None and set(store.keys()).issuperset(required) and read_fingerprint(store) == fingerprint):
+            #Written in one go by store()
+            return len(store.get('NumValues').index)
+        if(not rerun and progress != None and progress["complete"]):
+            return progress["entries"]
+        if(rerun or progress == None):
+            for key in store.keys():
+                store.remove(key)
+            progress = {"entries" : 0, "rows" : {}, "complete" : False, "schema" : fingerprint}
+        else:
+            #Throw away anything that was written after the last commit
+            for key in store.keys():
+                rows = progress["rows"].get(key.strip("/"), 0)
+                if(rows == 0):
+                    store.remove(key)
+                elif(store.get_storer(key).nrows > rows):
+                    store.remove(key, start=rows)
+            if(verbosity > 0): print("Resuming %r from entry %r" % (filepath, progress["entries"]))
+
+        for frames in iter_delphes_to_pandas(filepath, chunk_size=chunk_size, start=progress["entries"],
+                                             verbosity=verbosity, **kwargs):
+            rows = progress["rows"]
+            for key,frame in frames.items():
+                if(len(frame) == 0): continue
+                frame.index = pd.RangeIndex(rows.get(key, 0), rows.get(key, 0) + len(frame))
+                store.append(key, frame, format='table')
+                rows[key] = rows.get(key, 0) + len(frame)
+            store.flush(fsync=True)
+            progress["entries"] = progress["entries"] + len(frames["NumValues"].index)
+            write_progress(out_file, progress)
+        write_fingerprint(store, fingerprint)
+        progress["complete"] = True
+        write_progress(out_file, progress)
+        return progress["entries"]
+    finally:
+        store.close()
+#------------------------------------------------------------------------
+
+def output_path(filepath, outputdir, storeType="hdf5"):
+    '''Returns the path that store() writes the tables of a ROOT file to'''
     filename = os.path.splitext(ntpath.basename(filepath))[0]
     if(storeType == "hdf5"):
-        out_file = outputdir + filename + ".h5"
+        return outputdir + filename + ".h5"
+    elif(storeType == "msgpack"):
+        return outputdir + filename + ".msg"
+    elif(storeType == "columnar"):
+        return outputdir + filename + COLUMNAR_EXTENSION
+    raise ValueError("storeType %r not recognized" % storeType)
+
+def store(filepath, outputdir, rerun=False, storeType="hdf5", chunk_size=None, fan_out=1, schema=None):
+    '''Parses a Delphes ROOT file and writes the tables to outputdir, unless that was already done.
+        #Arguments
+            filepath -- The path to the ROOT file
+            outputdir -- The directory to write to
+            rerun -- Whether to parse the file again even if the output already exists
+            storeType -- Either "hdf5", "msgpack" or "columnar" (typed, compressed column datasets with per-entry
+                            offsets, see storage.columnar)
+            chunk_size -- (hdf5 and columnar only) If not None stream the file to disk chunk_size entries at a time
+                            with stream_to_hdf5 (so that an interrupted job can be resumed) or write_columnar_output.
+            fan_out -- The number of processes to parse the file with when chunk_size is None (see parse_in_parallel)
+            schema -- (optional) The ParserSchema to parse with. Its fingerprint is recorded with the output, and
+                        output written with a different schema is parsed again.
+        #Returns
+            (number of entries, output file) or 0 if the file could not be parsed
+    '''
+    schema = DEFAULT_SCHEMA if schema == None else schema
+    fingerprint = schema.fingerprint()
+    out_file = output_path(filepath, outputdir, storeType)
+    if(storeType == "hdf5" and chunk_size != None):
+        print(out_file)
+        try:
+            num = stream_to_hdf5(filepath, out_file, chunk_size, rerun=rerun, schema=schema)
+        except Exception as e:
+            print(e)
+            print("Failed to stream %r to HDFStore %r" % (filepath, out_file))
+            return 0
+    elif(storeType == "hdf5"):
         print(out_file)
-        store = pd.HDFStore(out_file)
-        keys = store.keys()
-        #print("KEYS:", set(keys))
-        # print("KEYS:", set(["/"+key for key in OBJECT_TYPES+["NumValues"]]))
-        #print("KEYS:", set(keys)==set(["/"+key for key in OBJECT_TYPES+["NumValues"]]))
-        existing,required  = set(keys),set(["/"+key for key in OBJECT_TYPES+["EventChars","NumValues"]])
-        if(not existing.issuperset(required) or rerun):
-            #print("OUT",out_file)
+        existing, stale, num = set(), True, None
+        if(os.path.exists(out_file)):
             try:
-                frames = delphes_to_pandas(filepath)
+                store = pd.HDFStore(out_file, mode='r')
             except Exception as e:
+                #Unreadable, i.e. written by an old version without a temporary file, so it is parsed again
                 print(e)
-                print("Failed to parse file %r. File may be corrupted." % filepath)
+            else:
+                existing = set(store.keys())
+                stale = read_fingerprint(store) != fingerprint
+                if("/NumValues" in existing):
+                    num = len(store.get('NumValues').index)
                 store.close()
+        required = set(["/"+key for key in schema.collections+["EventChars","NumValues"]])
+        progress = read_progress(out_file)
+        if(not existing.issuperset(required) or rerun or stale or (progress != None and not progress["complete"])):
+            try:
+                frames = delphes_to_pandas(filepath, fan_out=fan_out, schema=schema)
+            except Exception as e:
+                print(e)
+                print("Failed to parse file %r. File may be corrupted." % filepath)
                 return 0
             try:
-                for key,frame in frames.items():
-                    store.put(key, frame, format='table')
+                #Tables of collections that are not in the schema any more are left out
+                write_hdf5_output(out_file, frames, fingerprint)
             except Exception as e:
                 print(e)
                 print("Failed to write to HDFStore %r" % out_file)
-                store.close()
                 return 0
-        num = len(store.get('NumValues').index)
-        store.close()
+            if(progress != None): os.remove(progress_path(out_file))
+            num = len(frames['NumValues'].index)
     elif(storeType == "msgpack"):
-        out_file = outputdir + filename + ".msg"
         # meta_out_file = outputdir + filename + ".meta"
         print(out_file)
-        if(not os.path.exists(out_file) or rerun):
+        if(not os.path.exists(out_file) or rerun or read_schema_record(out_file) != fingerprint):
             try:
-                frames = delphes_to_pandas(filepath)
+                frames = delphes_to_pandas(filepath, fan_out=fan_out, schema=schema)
             except Exception as e:
                 print(e)
                 print("Failed to parse file %r. File may be corrupted." % filepath)
                 return 0
             try:
-                pd.to_msgpack(out_file, frames)
+                #Indexed so that readers can decode just the entries they need
+                write_indexed_msgpack(out_file, frames, schema=fingerprint)
             except Exception as e:
                 print(e)
                 print("Failed to write msgpack %r" % out_file)
                 return 0
             # pd.to_msgpack(meta_out_file, meta_frames)
+            write_json_atomic(dict(schema.to_dict(), fingerprint=fingerprint), schema_path(out_file))
             meta_frames = msgpack_assertMeta(out_file, frames)
         else:
             meta_frames = msgpack_assertMeta(out_file)
 
         num = len(meta_frames["NumValues"].index)
+    elif(storeType == "columnar"):
+        print(out_file)
+        if(not os.path.exists(out_file) or rerun or read_columnar_fingerprint(out_file) != fingerprint):
+            try:
+                num = write_columnar_output(filepath, out_file, chunk_size=chunk_size, fan_out=fan_out, schema=schema)
+            except Exception as e:
+                print(e)
+                print("Failed to write columnar file %r from %r" % (out_file, filepath))
+                return 0
+        else:
+            f = ColumnarFile(out_file)
+            num = f.n_entries
+            f.close()
         # elif(not os.path.exists(meta_out_file)):
         #     print(".meta file missing creating %r" % meta_out_file)
         #     frames = pd.read_msgpack(out_file)
@@ -673,110 +1639,305 @@ def store(filepath, outputdir, rerun=False, storeType="hdf5"):
         raise ValueError("storeType %r not recognized" % storeType)
     return num, out_file
 
+#---------------------------MANIFEST-------------------------------------
+MANIFEST_NAME = "manifest.json"
+#The number of bytes at the start and end of a ROOT file that its fingerprint is computed from
+FINGERPRINT_SAMPLE = 1024*1024
+
+def manifest_path(store_dir):
+    '''Returns the path of the manifest that run_jobs keeps in an output directory'''
+    return os.path.join(store_dir, MANIFEST_NAME)
+
+def read_manifest(path):
+    '''Returns the manifest at path as a dictionary keyed by ROOT file, or {} if there is none'''
+    if(path == None or not os.path.exists(path)):
+        return {}
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+def input_fingerprint(filepath, sample=FINGERPRINT_SAMPLE):
+    '''Returns a fingerprint of the content of a file from its size and its first and last sample bytes. ROOT
+        files are written at the end and their headers point to the end, so any rewrite changes one or the other.'''
+    h = hashlib.sha1()
+    size = os.path.getsize(filepath)
+    h.update(str(size).encode())
+    with open(filepath, "rb") as f:
+        h.update(f.read(sample))
+        if(size > sample):
+            f.seek(max(sample, size - sample))
+            h.update(f.read(sample))
+    return h.hexdigest()
+
+def input_record(filepath):
+    '''Returns the size, modification time and fingerprint of a ROOT file, as recorded in the manifest'''
+    try:
+        return {"size": os.path.getsize(filepath), "mtime": os.path.getmtime(filepath),
+                "fingerprint": input_fingerprint(filepath)}
+    except (IOError, OSError):
+        return {"size": 0, "mtime": None, "fingerprint": None}
+
+def _schema_fingerprint(schema):
+    return (DEFAULT_SCHEMA if schema == None else schema).fingerprint()
+
+def is_fresh(entry, job):
+    '''Returns True if the manifest entry of a job shows that its output is up to date. Only the ROOT file
+        and the output file are stat-ed, the output is never opened. If the modification time of the ROOT
+        file changed its fingerprint is compared instead, so touching a file does not make it stale.'''
+    f, store_dir, storeType = job[0], job[1], job[2]
+    if(entry == None or entry.get("status") != "ok"):
+        return False
+    if(entry.get("storeType", "hdf5") != storeType or entry.get("schema_version") != SCHEMA_VERSION or
+       entry.get("schema") != _schema_fingerprint(job[5])):
+        return False
+    out_file = output_path(f, store_dir, storeType)
+    if(entry.get("out_file") != out_file or not os.path.exists(out_file)):
+        return False
+    try:
+        if(os.path.getsize(f) != entry.get("size")):
+            return False
+        if(os.path.getmtime(f) != entry.get("mtime")):
+            if(input_fingerprint(f) != entry.get("fingerprint")):
+                return False
+            entry["mtime"] = os.path.getmtime(f)
+    except (IOError, OSError):
+        return False
+    return True
+
+def stale_jobs(jobs, manifest):
+    '''Splits jobs into those that need to run and those whose output is up to date according to the manifest
+        alone (see is_fresh). Manifest entries of touched but unchanged ROOT files get their new modification time.
+        #Arguments
+            jobs -- A list of jobs as returned by makeJobs
+            manifest -- The path of the manifest written by run_jobs
+        #Returns
+            (stale jobs, dictionary of the manifest entries of the fresh jobs keyed by ROOT file)
+    '''
+    entries = read_manifest(manifest)
+    mtimes = {f: entry.get("mtime") for f, entry in entries.items()}
+    stale, fresh = [], {}
+    for job in jobs:
+        entry = entries.get(job[0], None)
+        if(is_fresh(entry, job)):
+            fresh[job[0]] = entry
+        else:
+            stale.append(job)
+    if(True in [entry.get("mtime") != mtimes[f] for f, entry in fresh.items()]):
+        write_json_atomic(entries, manifest)
+    return stale, fresh
+#------------------------------------------------------------------------
+
+#---------------------------SCHEDULER------------------------------------
+def _job_worker(job, redo, conn):
+    '''Runs a single job in a worker process and sends (num, out_file, error) back through conn'''
+    #Start a new process group so that _kill_job also stops any processes started by fan_out
+    if(hasattr(os, "setpgrp")): os.setpgrp()
+    f, store_dir, storeType, chunk_size, fan_out, schema = job
+    try:
+        out = store(f, store_dir, rerun=redo, storeType=storeType, chunk_size=chunk_size, fan_out=fan_out, schema=schema)
+        if(isinstance(out, tuple)):
+            conn.send((out[0], out[1], None))
+        else:
+            conn.send((0, None, "store() could not parse or write %r" % f))
+    except Exception as e:
+        conn.send((0, None, "%s: %s" % (type(e).__name__, e)))
+    conn.close()
+
+def _kill_job(p):
+    '''Terminates a job worker and everything in its process group'''
+    if(hasattr(os, "killpg")):
+        try:
+            os.killpg(p.pid, signal.SIGTERM)
+        except OSError:
+            pass
+    p.terminate()
+    p.join()
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def run_jobs(jobs, num_processes=1, redo=False, timeout=None, retries=1, manifest=None, num_samples=None, verbose=1):
+    '''Runs jobs made by makeJobs on a pool of worker processes. Jobs are started largest file first and
+        handed to whichever worker is free, so one worker with a few large files does not hold up the rest.
+        Every file is parsed in its own process, so a file that crashes (or hangs) ROOT does not take down
+        the other jobs.
+        #Arguments
+            jobs -- A list of jobs as returned by makeJobs
+            num_processes -- The maximum number of files to parse at the same time
+            redo -- Whether to parse files again that were already parsed
+            timeout -- If not None, the number of seconds after which a job is killed
+            retries -- How many times to retry a job that failed or timed out
+            manifest -- If not None, the path of a json file to which the status, number of entries and elapsed
+                        time of each file is written every time a job finishes, along with what stale_jobs needs
+                        to tell whether it has to run again (see input_record). Entries of other files are kept.
+            num_samples -- If not None, stop starting new jobs once this many entries have been converted
+        #Returns
+            A dictionary keyed by ROOT file with the manifest entry of each job
+    '''
+    from multiprocessing import Process, Pipe
+    pending = sorted(jobs, key=lambda job: _file_size(job[0]), reverse=True)
+    status = {job[0]: {"status": "pending", "entries": 0, "elapsed": 0.0, "attempts": 0,
+                       "out_file": None, "error": None, "size": _file_size(job[0])} for job in jobs}
+    previous = read_manifest(manifest)
+    running = []
+    samples_read = 0
+
+    def _write_manifest():
+        merged = dict(previous)
+        merged.update(status)
+        write_json_atomic(merged, manifest)
+
+    def _finish(job, num, out_file, error, elapsed, timed_out=False):
+        entry = status[job[0]]
+        entry["elapsed"] += elapsed
+        if(error == None):
+            entry.update({"status": "ok", "entries": int(num), "out_file": out_file, "error": None,
+                          "storeType": job[2], "schema": _schema_fingerprint(job[5]), "schema_version": SCHEMA_VERSION})
+        else:
+            #Outputs are written under a temporary name and renamed, or streamed with commits (see stream_to_hdf5),
+            #   so a killed worker never leaves a half written file behind and any existing output is kept.
+            entry.update({"status": "timeout" if timed_out else "failed", "error": error})
+            if(entry["attempts"] <= retries):
+                if(verbose >= 1): print("Retrying %r after: %s" % (job[0], error))
+                pending.insert(0, job)
+                entry["status"] = "pending"
+        if(manifest != None):
+            _write_manifest()
+        if(verbose >= 1 and entry["status"] != "pending"):
+            print("%s %r: %r entries in %.1fs" % (entry["status"], job[0], entry["entries"], entry["elapsed"]))
+        return int(num) if error == None else 0
+
+    try:
+        while(len(pending) > 0 or len(running) > 0):
+            #Hand out jobs to free workers
+            while(len(pending) > 0 and len(running) < num_processes and
+                  (num_samples == None or samples_read < num_samples)):
+                job = pending.pop(0)
+                recv, send = Pipe(duplex=False)
+                p = Process(target=_job_worker, args=(job, redo, send))
+                p.start()
+                send.close()
+                status[job[0]]["attempts"] += 1
+                status[job[0]]["status"] = "running"
+                #Recorded before parsing, so that changes made while parsing show up next time
+                status[job[0]].update(input_record(job[0]))
+                running.append((job, p, recv, time.time()))
+            if(len(running) == 0):
+                break
+
+            time.sleep(.05)
+            still_running = []
+            for job, p, recv, started in running:
+                elapsed = time.time() - started
+                message = None
+                if(recv.poll()):
+                    #A worker that died without sending anything closes the pipe, which polls as readable too
+                    try:
+                        message = recv.recv()
+                    except EOFError:
+                        pass
+                if(message != None):
+                    p.join()
+                    samples_read += _finish(job, message[0], message[1], message[2], elapsed)
+                elif(not p.is_alive()):
+                    p.join()
+                    samples_read += _finish(job, 0, None, "Worker exited with code %r" % p.exitcode, elapsed)
+                elif(timeout != None and elapsed > timeout):
+                    _kill_job(p)
+                    samples_read += _finish(job, 0, None, "Timed out after %.1fs" % elapsed, elapsed, timed_out=True)
+                else:
+                    still_running.append((job, p, recv, started))
+            running = still_running
+    finally:
+        for job, p, recv, started in running:
+            _kill_job(p)
+    for entry in status.values():
+        if(entry["status"] == "pending"): entry["status"] = "skipped"
+    if(manifest != None):
+        _write_manifest()
+    return status
+#------------------------------------------------------------------------
+
 def main(data_dir, argv):
-    from multiprocessing import Process
-    from time import sleep
     # print(data_dir)
     storeType = "hdf5"
     redo = False
     num_samples = None
     num_processes = 1
-    screwup_error = "python delphes_parser.py <input_dir>"
+    chunk_size = None
+    timeout = None
+    retries = 1
+    fan_out = 1
+    schema = None
+    dry_run = False
+    screwup_error = "python delphes_parser.py <input_dir> [-n num_samples] [-p num_processes] [-c chunk_size] [-f fan_out] [-t timeout] [-a retries] [-s schema.json] [-m] [-l] [-r] [-d]"
     try:
-        opts, args = getopt.getopt(argv,'n:p:mrh')
+        opts, args = getopt.getopt(argv,'n:p:c:f:t:a:s:mlrdh')
         print(opts)
         print(args)
     except getopt.GetoptError:
         print(argv)
         # print(args)
-        print screwup_error
+        print(screwup_error)
         sys.exit(2)
   
     for opt, arg in opts:
       # print(opt, arg)
         if opt in ("-m", "--msg", "--msgpack"):
             storeType = "msgpack"
+        elif opt in ("-l", "--columnar"):
+            storeType = "columnar"
         elif opt in ('-h5', "--hdf", "--hdf5"):
             storeType = "hdf5"
         elif opt in ('-r', "--redo"):
             redo = True
+        elif opt in ('-d', "--dry_run"):
+            dry_run = True
         elif opt in ('-n', "--num_samples"):
             if(arg == ''): arg = None
             num_samples = int(arg)
         elif opt in ('-p', "--num_processes"):
             if(arg == ''): arg = None
             num_processes = int(arg)
+        elif opt in ('-c', "--chunk_size"):
+            chunk_size = int(arg)
+        elif opt in ('-t', "--timeout"):
+            timeout = float(arg)
+        elif opt in ('-a', "--retries"):
+            retries = int(arg)
+        elif opt in ('-f', "--fan_out"):
+            fan_out = int(arg)
+        elif opt in ('-s', "--schema"):
+            schema = load_schema(arg)
     print(num_samples)
     print(storeType)
-    pandas_folder = "/pandas_h5/" if storeType == "hdf5" else "/pandas_msg/"
-    jobs = makeJobs(data_dir,storeType, pandas_folder=pandas_folder)
-
-    def f(jobs ,samples_per_process,verbose=0 , i=0):
-        samples_read = 0
-        if (verbose >= 1): print("Parse process %r started." % i)
-        for job in jobs:
-            # ok = True
-            out = doJob(job)
-            if(not isinstance(out,tuple)):
-                print("Something wrong with root file. Skipping...")
-                continue
-                # ok = False
-            # else:
-
-            samples_from_job, out_file = out
-            try:
-                store = pd.HDFStore(out_file)
-                num_val_frame = store.get('/NumValues')
-            except Exception as e:
-                # ok = False
-                print(e)
-                print("Corrupted HDFStore. Skipping...")
-                continue
-            # if(ok):
-            samples_read += samples_from_job
-            print("Parsed %r of %r samples dedicated to process %r" % (samples_read, samples_per_process, i))
-            if (samples_read >= samples_per_process):
-                break
-
-
-    processes = []
-    # if (verbose >= 1): print("Starting  stating with %r/%r DataProcedures" % (len(dps) - len(unarchived), len(dps)))
-    splits = [ jobs[i::num_processes] for i in range(num_processes)]
-    samples_per_process = np.ceil(num_samples / num_processes)
-        # np.array_split(jobs, num_processes)
-    for i, sublist in enumerate(splits[1:]):
-        print("Thread %r Started" % i)
-        p = Process(target=f, args=(sublist,samples_per_process,1, i + 1))
-        processes.append(p)
-        p.start()
-        sleep(.001)
-    try:
-        f(splits[0], samples_per_process, verbose=1)
-    except:
-        for p in processes:
-            p.terminate()
-    for p in processes:
-        p.join()
-    # for job in jobs:
-    #     pandas_file = job[0]
-    #     store = pd.HDFStore(pandas_file)
-
-    # if False in [u.is_archived() for u in unarchived]:
-    #     print("Batch Assert Failed")
-    #     pass  # batchAssertArchived(dps, num_processes=num_processes)
-
-
-    # samples_read = 0
-    # for job in jobs:
-    #     # print(job)
-    #     samples_read += doJob(job, redo=redo)
-    #     if(num_samples != None):
-    #         print("Parsed %r of %r samples" %(samples_read, num_samples))
-    #         if(samples_read >= num_samples):
-    #             break
-            
-
-
+    pandas_folder = {"hdf5" : "/pandas_h5/", "msgpack" : "/pandas_msg/", "columnar" : "/pandas_col/"}[storeType]
+    jobs = makeJobs(data_dir,storeType, pandas_folder=pandas_folder, chunk_size=chunk_size, fan_out=fan_out, schema=schema)
+    if(len(jobs) == 0):
+        print("No ROOT files found in %r" % data_dir)
+        return
+    manifest = manifest_path(jobs[0][1])
+    if(not redo):
+        #Decided from the manifest alone, none of the outputs are opened
+        n_files = len(jobs)
+        jobs, fresh = stale_jobs(jobs, manifest)
+        n_fresh_entries = sum([entry["entries"] for entry in fresh.values()])
+        print("%r of %r files are up to date with %r entries, %r to parse" % (len(fresh), n_files, n_fresh_entries, len(jobs)))
+        if(num_samples != None):
+            num_samples -= n_fresh_entries
+        if(len(jobs) == 0 or (num_samples != None and num_samples <= 0)):
+            return
+    if(dry_run):
+        return
+    status = run_jobs(jobs, num_processes=num_processes, redo=redo, timeout=timeout, retries=retries,
+                      manifest=manifest, num_samples=num_samples)
+    n_ok = len([v for v in status.values() if v["status"] == "ok"])
+    print("Parsed %r of %r files, %r entries. See %r" % (n_ok, len(status), sum([v["entries"] for v in status.values()]), manifest))
 
 
 if __name__ == "__main__":
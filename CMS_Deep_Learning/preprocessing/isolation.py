@@ -0,0 +1,136 @@
+'''
+isolation.py
+Batched angular neighbour searches for isolation and track matching. Particles from many entries
+are handled at once; each particle carries the index of the entry (event) it belongs to and only
+particles of the same entry are ever paired. Instead of building a dense N x M DeltaRsq matrix per
+entry, the particles are binned on an eta-phi grid so that only neighbouring cells are compared.
+'''
+import math
+import numpy as np
+
+
+def delta_rsq(A_Eta, A_Phi, B_Eta, B_Phi):
+    '''Elementwise version of delphes_parser.DeltaRsq for arrays of pairs'''
+    DeltaEta = A_Eta - B_Eta
+    DeltaPhi = A_Phi - B_Phi
+    tooLarge = -2. * math.pi * (DeltaPhi > math.pi)
+    tooSmall = 2. * math.pi * (DeltaPhi < -math.pi)
+    DeltaPhi = DeltaPhi + tooLarge + tooSmall
+    return DeltaEta * DeltaEta + DeltaPhi * DeltaPhi
+
+
+def _expand_ranges(lo, hi):
+    '''Returns (owner, index) for every index in the ranges [lo[i], hi[i])'''
+    lengths = hi - lo
+    owner = np.repeat(np.arange(len(lo), dtype='int64'), lengths)
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype('int64')
+    index = np.repeat(lo - starts, lengths) + np.arange(lengths.sum(), dtype='int64')
+    return owner, index
+
+
+class EtaPhiGrid(object):
+    '''An index of particles binned by (entry, eta, phi). Cells are at least cell wide in both
+        eta and phi, and the phi bins wrap around, so every particle within an angular distance
+        of cell of a point is in the 3x3 block of cells around it.
+        #Arguments
+            Eta, Phi -- numpy arrays of shape (M,) of the particles to index
+            event -- An integer numpy array of shape (M,) with the entry of each particle
+            cell -- The minimum width of a cell
+    '''
+    def __init__(self, Eta, Phi, event, cell=0.3):
+        self.Eta = np.asarray(Eta, dtype='float64')
+        self.Phi = np.asarray(Phi, dtype='float64')
+        self.event = np.asarray(event, dtype='int64')
+        self.cell = float(cell)
+        self.n_phi = max(int(2 * math.pi / self.cell), 1)
+        self.phi_width = 2 * math.pi / self.n_phi
+        eta_bins = self._eta_bins(self.Eta)
+        self.eta_min = int(eta_bins.min()) if len(eta_bins) > 0 else 0
+        self.n_eta = int(eta_bins.max()) - self.eta_min + 3 if len(eta_bins) > 0 else 1
+        keys = self._keys(self.event, eta_bins, self._phi_bins(self.Phi))
+        self.order = np.argsort(keys, kind='mergesort')
+        self.keys = keys[self.order]
+
+    def __len__(self):
+        return len(self.Eta)
+
+    def _eta_bins(self, Eta):
+        return np.floor(Eta / self.cell).astype('int64')
+
+    def _phi_bins(self, Phi):
+        return np.floor((Phi + math.pi) / self.phi_width).astype('int64') % self.n_phi
+
+    def _keys(self, event, eta_bins, phi_bins):
+        #Eta bins are shifted by one so that the neighbours of the lowest bin are still valid keys
+        return (event * self.n_eta + (eta_bins - self.eta_min + 1)) * self.n_phi + phi_bins
+
+    def pairs(self, Eta, Phi, event, maxdist=None):
+        '''Finds every pair of (query particle, indexed particle) in the same entry that are closer
+            than maxdist.
+            #Arguments
+                Eta, Phi -- numpy arrays of shape (N,) of the query particles
+                event -- An integer numpy array of shape (N,) with the entry of each query particle
+                maxdist -- The maximum angular distance, at most the cell size. Defaults to the cell size.
+            #Returns (ia, ib, DRsq)
+                ia -- The indicies of the query particles
+                ib -- The indicies of the indexed particles
+                DRsq -- The squared angular distance of each pair, computed like DeltaRsq(A, B)
+        '''
+        maxdist = self.cell if maxdist == None else maxdist
+        if(maxdist > self.cell):
+            raise ValueError("maxdist %r is larger than the grid cells %r" % (maxdist, self.cell))
+        Eta = np.asarray(Eta, dtype='float64')
+        Phi = np.asarray(Phi, dtype='float64')
+        event = np.asarray(event, dtype='int64')
+        eta_bins = self._eta_bins(Eta)
+        phi_bins = self._phi_bins(Phi)
+        #With fewer than three phi bins every bin is a neighbour
+        phi_neighbours = [(phi_bins + d) % self.n_phi for d in (-1, 0, 1)] if self.n_phi >= 3 else \
+                         [np.full(len(phi_bins), b, dtype='int64') for b in range(self.n_phi)]
+        ia, ib = [], []
+        for d_eta in (-1, 0, 1):
+            #Keep the keys valid for particles outside of the indexed eta range, they just have no neighbours
+            eb = np.clip(eta_bins + d_eta, self.eta_min - 1, self.eta_min + self.n_eta - 2)
+            for pb in phi_neighbours:
+                keys = self._keys(event, eb, pb)
+                lo = np.searchsorted(self.keys, keys, 'left')
+                hi = np.searchsorted(self.keys, keys, 'right')
+                hi = np.where(eta_bins + d_eta == eb, hi, lo)
+                owner, index = _expand_ranges(lo, hi)
+                ia.append(owner)
+                ib.append(self.order[index])
+        ia = np.concatenate(ia)
+        ib = np.concatenate(ib)
+        DRsq = delta_rsq(Eta[ia], Phi[ia], self.Eta[ib], self.Phi[ib])
+        close = DRsq < maxdist * maxdist
+        return ia[close], ib[close], DRsq[close]
+
+
+def nearest(ia, ib, DRsq, n):
+    '''Picks the closest indexed particle for each query particle from the output of EtaPhiGrid.pairs.
+        Ties go to the lowest index, like np.argmin.
+        #Returns
+            An int64 numpy array of shape (n,) of indicies of indexed particles, or -1 where a query particle
+            has no neighbours
+    '''
+    out = np.full(n, -1, dtype='int64')
+    if(len(ia) == 0):
+        return out
+    order = np.lexsort((ib, DRsq, ia))
+    first = np.concatenate([[True], ia[order][1:] != ia[order][:-1]])
+    out[ia[order][first]] = ib[order][first]
+    return out
+
+
+def isolation(ia, DRsq, A_Pt, weights=None):
+    '''Segmented version of delphes_parser.Iso on the output of EtaPhiGrid.pairs.
+        #Arguments
+            ia -- The query particle index of each pair
+            DRsq -- The squared distance of each pair
+            A_Pt -- A numpy array of shape (N,) of the transverse momenta of the query particles
+            weights -- (optional) A numpy array multiplied into each pair, i.e. to exclude some particles
+        #Returns
+            The isolation of each query particle
+    '''
+    w = DRsq if weights is None else DRsq * weights
+    return np.bincount(ia, weights=w, minlength=len(A_Pt)) / np.asarray(A_Pt, dtype='float64')
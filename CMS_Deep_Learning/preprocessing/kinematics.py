@@ -0,0 +1,191 @@
+'''
+kinematics.py
+Vectorized kinematics for jagged blocks of particles. A block is a set of flat arrays holding
+the values of many entries back to back, together with the number of values in each entry
+(counts) as produced by delphes_parser.read_block.
+'''
+import math
+import time
+import numpy as np
+
+
+def wrap_phi(DeltaPhi):
+    '''Maps differences of two azimuthal angles in [-pi,pi] back into [-pi,pi]'''
+    tooLarge = -2.0 * math.pi * (DeltaPhi > math.pi)
+    tooSmall = 2.0 * math.pi * (DeltaPhi < -math.pi)
+    return DeltaPhi + tooLarge + tooSmall
+
+
+def per_entry(values, counts):
+    '''Broadcasts one value per entry to every particle of that entry
+        #Arguments
+            values -- A numpy array of shape (n_entries,)
+            counts -- The number of particles in each entry, shape (n_entries,)
+        #Returns
+            A numpy array with shape (sum(counts),)
+    '''
+    return np.repeat(np.asarray(values, dtype='float64'), counts)
+
+
+def four_momentum(PT, Eta, Phi, M):
+    '''Computes the same thing as TLorentzVector.SetPtEtaPhiM for whole arrays of particles
+        #Arguments
+            PT, Eta, Phi -- numpy arrays of shape (N,)
+            M -- The mass, either a scalar or a numpy array of shape (N,)
+        #Returns
+            E, Px, Py, Pz -- float64 numpy arrays of shape (N,)
+    '''
+    PT = np.abs(np.asarray(PT, dtype='float64'))
+    Eta = np.asarray(Eta, dtype='float64')
+    Phi = np.asarray(Phi, dtype='float64')
+    M = np.asarray(M, dtype='float64')
+    Px = PT * np.cos(Phi)
+    Py = PT * np.sin(Phi)
+    Pz = PT * np.sinh(Eta)
+    #TLorentzVector treats negative masses as spacelike
+    Esq = Px * Px + Py * Py + Pz * Pz + M * np.abs(M)
+    E = np.sqrt(np.maximum(Esq, 0.0))
+    return E, Px, Py, Pz
+
+
+class LorentzVector(object):
+    '''A pure python stand in for the part of ROOT.TLorentzVector used by delphes_parser,
+        for when ROOT is not installed. Masses are treated like four_momentum.'''
+    def SetPtEtaPhiM(self, pt, eta, phi, m):
+        pt = abs(pt)
+        self.px = pt * math.cos(phi)
+        self.py = pt * math.sin(phi)
+        self.pz = pt * math.sinh(eta)
+        self.e = math.sqrt(max(self.px * self.px + self.py * self.py + self.pz * self.pz + m * abs(m), 0.0))
+
+    def E(self):
+        return self.e
+
+    def Px(self):
+        return self.px
+
+    def Py(self):
+        return self.py
+
+    def Pz(self):
+        return self.pz
+
+
+def relative_observables(PT, Eta, Phi, ref_PT, ref_Eta, ref_Phi):
+    '''Computes the angular distances and kt-like distances of particles w.r.t a reference
+        particle (for example the leading lepton) of their entry.
+        #Arguments
+            PT, Eta, Phi -- numpy arrays of shape (N,) for the particles
+            ref_PT, ref_Eta, ref_Phi -- numpy arrays of shape (N,) for the reference particle
+                                        of each particle's entry (see per_entry)
+        #Returns
+            DeltaEta, DeltaPhi, DeltaR, Kt, AntiKt -- float64 numpy arrays of shape (N,)
+    '''
+    PT = np.asarray(PT, dtype='float64')
+    ref_PT = np.asarray(ref_PT, dtype='float64')
+    DeltaEta = ref_Eta - np.asarray(Eta, dtype='float64')
+    DeltaPhi = wrap_phi(ref_Phi - np.asarray(Phi, dtype='float64'))
+    DeltaRSqr = DeltaEta ** 2 + DeltaPhi ** 2
+    with np.errstate(divide='ignore'):
+        Kt = np.minimum(PT ** 2, ref_PT ** 2) * DeltaRSqr
+        AntiKt = np.minimum(PT ** -2, ref_PT ** -2) * DeltaRSqr
+    return DeltaEta, DeltaPhi, np.sqrt(DeltaRSqr), Kt, AntiKt
+
+
+def leading_index(values, counts):
+    '''Finds the index of the largest value in each entry. Ties go to the first particle.
+        #Arguments
+            values -- A flat numpy array of shape (sum(counts),)
+            counts -- The number of values in each entry, shape (n_entries,)
+        #Returns
+            An int64 numpy array of shape (n_entries,) holding indicies into values, or -1 for
+            entries without any values
+    '''
+    counts = np.asarray(counts, dtype='int64')
+    entry = np.repeat(np.arange(len(counts)), counts)
+    order = np.lexsort((np.arange(len(values)), -np.asarray(values, dtype='float64'), entry))
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype('int64')
+    out = np.full(len(counts), -1, dtype='int64')
+    nonempty = counts > 0
+    out[nonempty] = order[starts[nonempty]]
+    return out
+
+
+def leading(PT, Eta, Phi, counts):
+    '''Vectorized delphes_parser.getMaxPt_Eta_Phi. Returns the PT, Eta and Phi of the particle with
+        the highest (positive) PT in each entry, or zeros if there is no such particle.
+        #Returns
+            PT, Eta, Phi -- float64 numpy arrays of shape (n_entries,)
+    '''
+    index = leading_index(PT, counts)
+    ok = index >= 0
+    out = [np.zeros(len(counts), dtype='float64') for _ in range(3)]
+    for o, values in zip(out, (PT, Eta, Phi)):
+        o[ok] = np.asarray(values, dtype='float64')[index[ok]]
+    ok = out[0] > 0.0
+    return tuple(o * ok for o in out)
+
+
+def segment_sum(values, counts):
+    '''Sums the values of each entry'''
+    entry = np.repeat(np.arange(len(counts)), counts)
+    return np.bincount(entry, weights=np.asarray(values, dtype='float64'), minlength=len(counts))
+
+
+#---------------------------------BENCHMARK------------------------------------
+def _scalar_kinematics(PT, Eta, Phi, M, counts, ref_PT, ref_Eta, ref_Phi):
+    '''The particle by particle computation done by delphes_parser.fill_object,
+        with math in place of TLorentzVector.'''
+    out = []
+    i = 0
+    for e, n in enumerate(counts):
+        for _ in range(n):
+            pt, eta, phi = float(PT[i]), float(Eta[i]), float(Phi[i])
+            px, py, pz = pt * math.cos(phi), pt * math.sin(phi), pt * math.sinh(eta)
+            E = math.sqrt(px * px + py * py + pz * pz + M * M)
+            dEta = ref_Eta[e] - eta
+            dPhi = ref_Phi[e] - phi
+            dPhi = dPhi + -2.0 * math.pi * (dPhi > math.pi) + 2.0 * math.pi * (dPhi < -math.pi)
+            dRsq = dEta ** 2 + dPhi ** 2
+            out.append((E, px, py, pz, dEta, dPhi, math.sqrt(dRsq),
+                        min(pt ** 2, ref_PT[e] ** 2) * dRsq, min(pt ** -2, ref_PT[e] ** -2) * dRsq))
+            i += 1
+    return out
+
+
+def benchmark(n_entries=2000, mean_multiplicity=100, seed=0, verbose=1):
+    '''Times the vectorized kinematics against the particle by particle computation
+        on a random jagged block.
+        #Returns
+            A dictionary with the particles/sec of each path
+    '''
+    rng = np.random.RandomState(seed)
+    counts = rng.poisson(mean_multiplicity, n_entries)
+    n = int(counts.sum())
+    PT = rng.exponential(20.0, n).astype('float32') + 0.5
+    Eta = rng.normal(0.0, 1.5, n).astype('float32')
+    Phi = rng.uniform(-math.pi, math.pi, n).astype('float32')
+    ref_PT, ref_Eta, ref_Phi = leading(PT, Eta, Phi, counts)
+    ref_PT[ref_PT == 0.0] = 1.0
+
+    start = time.time()
+    scalar = _scalar_kinematics(PT, Eta, Phi, 0.0, counts, ref_PT, ref_Eta, ref_Phi)
+    scalar_time = time.time() - start
+
+    start = time.time()
+    E, Px, Py, Pz = four_momentum(PT, Eta, Phi, 0.0)
+    rel = relative_observables(PT, Eta, Phi, per_entry(ref_PT, counts),
+                               per_entry(ref_Eta, counts), per_entry(ref_Phi, counts))
+    vector_time = time.time() - start
+
+    vectorized = np.stack((E, Px, Py, Pz) + rel, axis=1)
+    if(not np.allclose(np.array(scalar), vectorized, rtol=1e-7)):
+        raise ValueError("Vectorized kinematics do not match the scalar computation")
+    out = {"particles": n,
+           "scalar (particles/sec)": n / max(scalar_time, 1e-9),
+           "vectorized (particles/sec)": n / max(vector_time, 1e-9)}
+    if(verbose >= 1):
+        print("%r particles: scalar %.0f particles/sec, vectorized %.0f particles/sec (%.1fx)" %
+              (n, out["scalar (particles/sec)"], out["vectorized (particles/sec)"], scalar_time / max(vector_time, 1e-9)))
+    return out
+#-------------------------------------------------------------------------------
@@ -5,11 +5,15 @@ if __package__ is None:
     sys.path.append(os.path.realpath(__file__+"/../../../"))
 
 
-import time, math,re,h5py,shutil
+import time, math,re,h5py,shutil,json
 import argparse
-from multiprocessing import Process
-from time import sleep
+from multiprocessing import Pool, Process, Queue, Semaphore
+import traceback
+from six.moves.queue import Empty
 from CMS_Deep_Learning.preprocessing.preprocessing import size_from_meta,get_sizes_meta_dict
+from CMS_Deep_Learning.preprocessing.delphes_parser import write_json_atomic
+from CMS_Deep_Learning.io import read_dataset_manifest, sample_index, DATASET_MANIFEST, DATASET_FORMAT
+from CMS_Deep_Learning.storage.columnar import ColumnarFile, is_columnar, COLUMNAR_EXTENSION
 
 PARTICLE_OBSERVS = ['Energy', 'Px', 'Py', 'Pz', 'Pt', 'Eta', 'Phi', 'Charge',
                     'ChPFIso', 'GammaPFIso', 'NeuPFIso',
@@ -18,15 +22,20 @@ PARTICLE_OBSERVS = ['Energy', 'Px', 'Py', 'Pz', 'Pt', 'Eta', 'Phi', 'Charge',
 HLF_OBSERVS = ['HT', 'MET', 'MT', 'PhiMET', 'bJets', 'nJets']
 DEFAULT_RPE = {"Particles": 801, "HLF": 1}
 DEFAULT_OBSERVS = {"Particles": PARTICLE_OBSERVS, "HLF": HLF_OBSERVS }
+DATASET_VERSION = 1
+COMPRESSIONS = [None, "gzip", "lzf"]
 
 import pandas as pd
 import numpy as np
 
 #----------------------------IO-----------------------------
-def get_from_pandas(f, file_start_read, samples_to_read, file_total_events=-1, observ_types=DEFAULT_OBSERVS,rows_per_event=DEFAULT_RPE):
-    '''Helper Function - Gets a numpy array from a pandas .h5 file
+def get_from_pandas(f, file_start_read, samples_to_read, file_total_events=-1, observ_types=DEFAULT_OBSERVS,rows_per_event=DEFAULT_RPE,
+                    dtype=None):
+    '''Helper Function - Gets a numpy array from a pandas .h5 file, or a columnar file (see storage.columnar).
+        Only the columns in observ_types are read. Both tables are read in one open of the file and straight into
+        arrays, except for HDFStore tables in the 'table' format which are read through pandas.
     
-        :param f: The filepath of the pandas file
+        :param f: The filepath of the pandas file, or the file opened by _open_pandas which is left open
         :type f: str
         :param file_start_read: what samples to start reading with
         :type file_start_read: uint
@@ -38,37 +47,87 @@ def get_from_pandas(f, file_start_read, samples_to_read, file_total_events=-1, o
         :type observ_types: dict
         :param rows_per_event: A dictionary of the number of rows per event for each data type
         :type rows_per_event: dict
-        :returns: the numpy array
+        :param dtype: The dtype of the arrays, by default the common dtype of the columns read
+        :type dtype: str
+        :returns: A dictionary of arrays of shape (samples_to_read, rows_per_event, features), or
+                  (samples_to_read, features) for tables with one row per event
     '''
-    store = pd.HDFStore(f)
+    opened = isinstance(f, string_types)
+    store = _open_pandas(f) if opened else f
+    columnar = isinstance(store, ColumnarFile)
 
     values = {}
-    for key, rpe in rows_per_event.items():
-        # Where to start reading the table based on the sum of the selection start 
-        select_start = file_start_read * rpe
-        select_stop = select_start + samples_to_read * rpe
+    try:
+        for key, rpe in rows_per_event.items():
+            # Where to start reading the table based on the sum of the selection start
+            select_start = file_start_read * rpe
+            select_stop = select_start + samples_to_read * rpe
+            columns = observ_types[key] if observ_types != None else None
+
+            if (columnar):
+                # The offsets map the samples straight to their rows
+                x = store.read_array('/' + key, file_start_read, file_start_read + samples_to_read, columns, dtype)
+            elif (not 'table' in store[key]):
+                x = _read_fixed(store[key], select_start, select_stop, columns, dtype)
+            else:
+                frame = pd.read_hdf(store.filename, '/' + key, start=select_start, stop=select_stop, columns=columns)
+                x = np.ascontiguousarray(frame.values if columns == None else frame[columns].values, dtype=dtype)
 
-        if (samples_to_read == file_total_events):
-            frame = store.get('/' + key)
-        else:
-            frame = store.select('/' + key, start=select_start, stop=select_stop)
+            if (rpe > 1):
+                n_rows, n_columns = x.shape
+                x = x.reshape((n_rows // rpe, rpe, n_columns))
+
+            values[key] = x
+    finally:
+        if (opened): store.close()
+    return values
 
-        columns = list(frame.columns)
 
-        x = frame.values
-        if (observ_types != None):
-            x = np.take(x, [columns.index(o) for o in observ_types[key]], axis=-1)
-        if (rpe > 1):
-            n_rows, n_columns = x.shape
-            x = x.reshape((n_rows / rpe, rpe, n_columns))
+def _open_pandas(f):
+    '''Helper Function - Opens a pandas .h5 file (with h5py) or a columnar file for get_from_pandas'''
+    return ColumnarFile(f) if is_columnar(f) else h5py.File(f, 'r')
 
-        values[key] = x
-    store.close()
-    return values
+
+def _read_fixed(group, start, stop, columns=None, dtype=None):
+    '''Helper Function - Reads the rows [start, stop) of some columns of a DataFrame stored by HDFStore in the
+        'fixed' format straight from its blocks
+        :returns: An array of shape (rows, columns)
+    '''
+    _str = lambda x: x.decode() if isinstance(x, bytes) else str(x)
+    if (columns == None):
+        columns = [_str(c) for c in group["axis0"][:]]
+    n_rows = group["block0_values"].shape[0] if int(group.attrs["nblocks"]) > 0 else 0
+    start, stop = min(start, n_rows), min(stop, n_rows)
+    # (block values, [(location in the block, location in the output)]) for each block with columns to read
+    blocks, found = [], []
+    for i in range(int(group.attrs["nblocks"])):
+        items = [_str(c) for c in group["block%d_items" % i][:]]
+        locs = sorted([(items.index(c), j) for j, c in enumerate(columns) if c in items])
+        if (len(locs) > 0):
+            blocks.append((group["block%d_values" % i], locs))
+            found += [columns[j] for _, j in locs]
+    if (len(found) != len(columns)):
+        raise KeyError("No columns %r in %r" % (sorted(set(columns) - set(found)), group.name))
+    if (dtype == None):
+        dtype = np.result_type(*[dset.dtype for dset, _ in blocks]) if len(blocks) > 0 else 'float64'
+    out = np.empty((stop - start, len(columns)), dtype=dtype)
+    for dset, locs in blocks:
+        block_locs = [b for b, _ in locs]
+        if (block_locs == list(range(dset.shape[1]))):
+            block = dset[start:stop]
+        else:
+            block = dset[start:stop, block_locs]
+        out[:, [j for _, j in locs]] = block
+    return out
 #------------------------------------------------------------
 
 
 #---------------------------HELPERS---------------------------
+def _pandas_files(data_dir):
+    '''Returns the pandas .h5 and columnar files in a directory'''
+    return glob.glob(os.path.abspath(data_dir) + "/*.h5") + glob.glob(os.path.abspath(data_dir) + "/*" + COLUMNAR_EXTENSION)
+
+
 def _gen_label_vecs(data_dirs):
     num_labels = len(data_dirs)
     label_vecs = {}
@@ -79,12 +138,12 @@ def _gen_label_vecs(data_dirs):
     return label_vecs
 
 
-def _initializeArrays(data_dirs, samples_per_class):
-    '''Helper Function - Generates the initial data structures for the X (data) and Y (target)'''
-    num_classes = len(data_dirs)
-    X_train = [None] * (samples_per_class * num_classes)
-    y_train = [None] * (samples_per_class * num_classes)
-    HLF_train = [None] * (samples_per_class * num_classes)
+def _initializeArrays(data_dirs, samples_per_class, observ_types, rows_per_event, dtype, label_dtype):
+    '''Helper Function - Allocates the final X (data), Y (target) and HLF arrays, which are filled in place'''
+    num_samples = samples_per_class * len(data_dirs)
+    X_train = np.empty((num_samples, rows_per_event["Particles"], len(observ_types["Particles"])), dtype=dtype)
+    y_train = np.empty((num_samples, len(data_dirs)), dtype=label_dtype)
+    HLF_train = np.empty((num_samples, len(observ_types["HLF"])), dtype=dtype)
     return X_train, y_train, HLF_train
 #-------------------------------------------------------------
 
@@ -100,14 +159,19 @@ def _check_inputs(data_dirs, observ_types):
 
 
 #--------------------SORTING UTILS--------------------------------
+#Every function below takes a single event of shape (particles, features) or a block of events of shape
+#(events, particles, features), and works along the particle axis of each event.
 def maxLepPtEtaPhi(X, locs):
-    for x in X:
-        if (x[locs['isEle']] or x[locs["isMu"]]):
-            return x[locs['Pt']], x[locs['Eta']], x[locs['Phi']]
+    '''Returns the Pt, Eta and Phi of the first lepton of each event, shaped to broadcast against X[..., 0]'''
+    is_lep = (X[..., locs['isEle']] != 0) | (X[..., locs["isMu"]] != 0)
+    first = np.argmax(is_lep, axis=-1)[..., None]
+    if (not np.all(np.take_along_axis(is_lep, first, axis=-1))):
+        raise ValueError("Cannot sort by the leading lepton of events without a lepton")
+    return tuple(np.take_along_axis(X[..., locs[c]], first, axis=-1) for c in ['Pt', 'Eta', 'Phi'])
         
 def assertZerosBack(sort_slice, x, locs, sort_ascending):
     from numpy import inf
-    sort_slice[np.all(x == 0.0, axis=1)] = inf if sort_ascending else -inf
+    sort_slice[~np.any(x, axis=-1)] = inf if sort_ascending else -inf
     return sort_slice
 
 def resolveMetric(s, locs, sort_ascending):
@@ -117,27 +181,37 @@ def resolveMetric(s, locs, sort_ascending):
         raise ValueError("Unrecognized sorting metric %r" % s)
 
 
+def _take_rows(x, order):
+    '''Reorders the particles of each event of x by order, which has the shape of x[..., 0]'''
+    if (x.ndim == 2):
+        return x[order]
+    #Faster than np.take_along_axis, which broadcasts order over the features
+    return x[np.arange(len(x))[:, None], order]
+
+
 def _sortBy(x, sorts, sort_ascending):  
     if (sorts != None):
         for s in reversed(sorts):
             if (isinstance(s, int)):
-                sort_slice = x[:, s]
+                sort_slice = x[..., s]
             else:
                 sort_slice = s(x)
-            if (sort_ascending == True):
-                x = x[sort_slice.argsort()]
-            else:
-                x = x[sort_slice.argsort()[::-1]]
+            #Stable, so that each sort keeps the order of the previous one among ties
+            order = np.argsort(sort_slice, axis=-1, kind='mergesort')
+            if (sort_ascending != True):
+                order = order[..., ::-1]
+            x = _take_rows(x, order)
     return x
 
 
 def sort_numpy(x, sort_columns, sort_ascending, observ_types):
-    '''Helper Function - pads the data and sorts it'''
+    '''Helper Function - pads the data and sorts it. x is a single event (particles, features) or a block of
+        events (events, particles, features), which are all sorted at once.'''
     sort_locs = None
     assert not isinstance(sort_columns, string_types), "sort_columns improperly stored"
     if (sort_columns != None):
         if (True in [c in sort_columns for c in ["shuffle", "random"]]):
-            np.random.shuffle(x)
+            x = _take_rows(x, np.argsort(np.random.random(x.shape[:-1]), axis=-1))
         elif (not None in sort_columns):
             assert not False in [isinstance(s, string_types) for s in sort_columns], \
                 "Type should be string got %s" % (",".join([str(type(s)) for s in sort_columns]))
@@ -145,9 +219,16 @@ def sort_numpy(x, sort_columns, sort_ascending, observ_types):
             sorts = [locs[s] if s in observ_types else resolveMetric(s, locs, sort_ascending)
                      for s in sort_columns]
             # KLUGE FIX
-            x[x[:, locs["Energy"]] == 0] = 0.0
+            energy = x[..., locs["Energy"]]
+            x[energy == 0] = 0.0
             # Sort
-            x = _sortBy(x, sorts, sort_ascending)  
+            if (x.ndim == 3 and sort_columns[0] in SORT_METRICS):
+                #Metrics put the padding at the back, so the particles after the last one of any event can be left out
+                used = np.flatnonzero(np.any(energy != 0, axis=0))
+                n = used[-1] + 1 if len(used) > 0 else 0
+                x[:, :n] = _sortBy(x[:, :n], sorts, sort_ascending)
+            else:
+                x = _sortBy(x, sorts, sort_ascending)
 
     return x
 #------------------------------------------------------------------
@@ -155,7 +236,7 @@ def sort_numpy(x, sort_columns, sort_ascending, observ_types):
 #-------------------------SORTINGS---------------------------------
 def MaxLepDeltaPhi(X, locs, mlpep=None):
     maxLepPt, maxLepEta, maxLepPhi = maxLepPtEtaPhi(X, locs) if isinstance(mlpep, type(None)) else mlpep
-    out = maxLepPhi - X[:, locs["Phi"]]
+    out = maxLepPhi - X[..., locs["Phi"]]
 
     tooLarge = -2.0 * math.pi * (out > math.pi)
     tooSmall = 2.0 * math.pi * (out < -math.pi)
@@ -165,7 +246,7 @@ def MaxLepDeltaPhi(X, locs, mlpep=None):
 
 def MaxLepDeltaEta(X, locs, mlpep=None):
     maxLepPt, maxLepEta, maxLepPhi = maxLepPtEtaPhi(X, locs) if isinstance(mlpep, type(None)) else mlpep
-    return maxLepEta - X[:, locs["Eta"]]
+    return maxLepEta - X[..., locs["Eta"]]
 
 
 def MaxLepDeltaR(X, locs, mlpep=None):
@@ -176,13 +257,20 @@ def MaxLepDeltaR(X, locs, mlpep=None):
 def MaxLepKt(X, locs):
     mlpep = maxLepPtEtaPhi(X, locs)
     maxLepPt, maxLepEta, maxLepPhi = mlpep
-    return np.minimum(X[:, locs["Pt"]] ** 2, maxLepPt ** 2) * MaxLepDeltaR(X, locs, mlpep) ** 2
+    return np.minimum(X[..., locs["Pt"]] ** 2, maxLepPt ** 2) * MaxLepDeltaR(X, locs, mlpep) ** 2
+
+
+def _inverse_square(x):
+    '''x ** -2, but inf without a divide by zero warning where x is 0 (i.e. the zero padding)'''
+    x = np.asarray(x)
+    out = np.full(x.shape, np.inf, dtype=np.result_type(x.dtype, np.float32))
+    return np.divide(1, np.square(x), out=out, where=x != 0)
 
 
 def MaxLepAntiKt(X, locs):
     mlpep = maxLepPtEtaPhi(X, locs)
     maxLepPt, maxLepEta, maxLepPhi = mlpep
-    return np.minimum(X[:, locs["Pt"]] ** -2, maxLepPt ** -2) * MaxLepDeltaR(X, locs, mlpep) ** 2
+    return np.minimum(_inverse_square(X[..., locs["Pt"]]), _inverse_square(maxLepPt)) * MaxLepDeltaR(X, locs, mlpep) ** 2
 
 
 SORT_METRICS = {f.__name__: f for f in
@@ -197,7 +285,8 @@ import glob
 
 
 def pandas_to_numpy(data_dirs, start, samples_per_class,
-                    observ_types=DEFAULT_OBSERVS, sort_columns=None, sort_ascending=True, verbose=1):
+                    observ_types=DEFAULT_OBSERVS, sort_columns=None, sort_ascending=True, verbose=1,
+                    dtype='float32', label_dtype='int8'):
     '''Builds a trainable (particle level) sorted and (event level) shuffled numpy array from directories of pandas .h5 files.
     
         :param data_dirs: 
@@ -213,6 +302,8 @@ def pandas_to_numpy(data_dirs, start, samples_per_class,
         :param sort_columns: The columns to sort by, or special quantities including [MaxLepDeltaPhi,
                             MaxLepDeltaEta,MaxLepDeltaR,MaxLepKt,MaxLepAntiKt]
         :param sort_ascending: If True sort in ascending order, false decending  
+        :param dtype: The dtype of X_train and HFL_train
+        :param label_dtype: The dtype of Y_train
         :returns: (X_train, Y_train, HFL_train) 
     '''
     if (isinstance(data_dirs, dict)): data_dirs = sorted(data_dirs.values(), key=lambda x: x.join(x.split("/")[::-1]))
@@ -220,95 +311,39 @@ def pandas_to_numpy(data_dirs, start, samples_per_class,
     _check_inputs(data_dirs, observ_types)
 
     label_vecs = _gen_label_vecs(data_dirs)
-    X_train, y_train, HLF_train = _initializeArrays(data_dirs, samples_per_class)
+    X_train, y_train, HLF_train = _initializeArrays(data_dirs, samples_per_class, observ_types, DEFAULT_RPE,
+                                                    dtype, label_dtype)
+    # The events are shuffled as they are written: the i-th event read goes to row indices[i]
+    indices = np.random.permutation(len(y_train))
     X_train_index = 0
 
-    y_train_start = 0
+    start_time = time.time()
     for data_dir in data_dirs:
-        files = glob.glob(os.path.abspath(data_dir) + "/*.h5")
-        files.sort()
-        samples_read, location = 0, 0
-
-        sizesDict = get_sizes_meta_dict(data_dir)
-
-        last_time = time.clock() - 1.0
-        count,last_count = 0,0
-        # Loop the files associated with the current label
-        for f in files:
-            file_total_events = size_from_meta(f, sizesDict=sizesDict)  # len(num_val_frame.index)
-            if (file_total_events == None or file_total_events == 0):
-                print("Skipping %r" % f)
-                continue
-
-            if (location + file_total_events <= start):
-                location += file_total_events
-                continue
-
-            # Determine what row to start reading the num_val table which contains
-            # information about how many rows there are for each entry
-            file_start_read = start - location if start > location else 0
-
-            # How many rows we will read from this table each corresponds to one entry
-            samples_to_read = min(samples_per_class - samples_read, file_total_events - file_start_read)
-            assert samples_to_read >= 0
-
+        # The files of a directory are read as if they were one long list
+        index = sample_index(data_dir, _pandas_files(data_dir))
+        for f, file_start_read, samples_to_read in index.slices(start, samples_per_class):
             d = get_from_pandas(f, file_start_read=file_start_read,
                                        samples_to_read=samples_to_read,
-                                       file_total_events=file_total_events,
                                        rows_per_event=DEFAULT_RPE,
                                        observ_types=observ_types)
-            Particles, HLF = d["Particles"], d["HLF"]
-
-            for s, (particles, hlf) in enumerate(zip(Particles, HLF)):
-                # ----------pretty progress bar---------------
-                
-                if (verbose >= 1):
-                    c = time.clock()
-                    if (c > last_time + .25):
-                        prog = X_train_index + s
-                        percent = float(prog) / (samples_per_class * len(data_dirs))
-                        sys.stdout.write('\r')
-                        sys.stdout.write("[%-20s] %r/%r  %r(Event/sec)" % ('=' * int(20 * percent), prog,
-                                                                           int(samples_per_class) * len(data_dirs),
-                                                                           4 * (count-last_count)))
-                        sys.stdout.flush()
-                        #prev_sample = s
-                        last_time = c
-                        last_count = count
-
-                count += 1
-                # ------------------------------------------
-                particles = sort_numpy(particles, sort_columns, sort_ascending, observ_types["Particles"])
-
-                X_train[X_train_index + s] = particles
-                HLF_train[X_train_index + s] = hlf
+            #All the events of the file are sorted at once
+            Particles = sort_numpy(d["Particles"], sort_columns, sort_ascending, observ_types["Particles"])
 
-            X_train_index += samples_to_read
-
-            location += file_total_events
-            samples_read += samples_to_read
-            if (samples_read >= samples_per_class):
-                assert samples_read == samples_per_class
-                break
-        if (samples_read != samples_per_class):
-            raise IOError(
-                "Not enough data in %r to read in range(%r, %r)" % (data_dir, start, samples_per_class + start))
-
-        # Generate the target data as vectors like [1,0,0], [0,1,0], [0,0,1]
-        for i in range(samples_per_class):
-            y_train[y_train_start + i] = label_vecs[data_dir]
-        y_train_start += samples_per_class
-
-    # Turn everything into numpy arrays and shuffle them just in case.
-    # Although, we probably don't need to shuffle since keras shuffles by default.
-    y_train = np.array(y_train)
+            dest = indices[X_train_index: X_train_index + samples_to_read]
+            X_train[dest] = Particles
+            HLF_train[dest] = d["HLF"]
+            y_train[dest] = label_vecs[data_dir]
+            Particles, d = None, None
 
-    indices = np.arange(len(y_train))
-    np.random.shuffle(indices)
-
-    X_train = np.array(X_train)[indices]
-    HLF_train = np.array(HLF_train)[indices]
-    y_train = y_train[indices]
+            X_train_index += samples_to_read
+            # ----------pretty progress bar---------------
+            if (verbose >= 1):
+                percent = float(X_train_index) / len(y_train)
+                sys.stdout.write('\r')
+                sys.stdout.write("[%-20s] %r/%r  %r(Event/sec)" % ('=' * int(20 * percent), X_train_index, len(y_train),
+                                                                   int(X_train_index / max(time.time() - start_time, 1e-6))))
+                sys.stdout.flush()
+            # ------------------------------------------
 
     return X_train, y_train, HLF_train
 
@@ -350,10 +385,23 @@ def set_range_from_splits(splits, length):
     return out
 
 
-def strideFromTargetSize(rows_per_event, observ_types, num_classes, megabytes=100):
-    '''Computes how large a stride is required to build a file with size megabytes'''
-    megabytes_per_sample = sum([rows_per_event[key]*observ_types for key, in rows_per_event]) * 24.0 / (1000.0 * 1000.0)
-    return int(megabytes/megabytes_per_sample)
+def parse_megabytes(size):
+    '''Parses a size like '500MB' or '1.5GB' into megabytes
+        :param size: a number followed by MB or GB
+        :returns: the number of megabytes as a float
+        :raises ValueError: if size is not a number of MB or GB
+    '''
+    match = re.match(r'^\s*(\d+\.?\d*|\.\d+)\s*([MG])B\s*$', size, re.IGNORECASE)
+    if (match == None):
+        raise ValueError("size %r must be a number of MB or GB, i.e '500MB' or '1.5GB'" % size)
+    return float(match.group(1)) * (1000.0 if match.group(2).upper() == "G" else 1.0)
+
+
+def strideFromTargetSize(rows_per_event, observ_types, num_classes=1, megabytes=100, dtype='float32'):
+    '''Computes how large a stride (samples per class) is required to build an uncompressed file with size megabytes'''
+    megabytes_per_sample = sum([rows_per_event[key] * len(observ_types[key]) for key in rows_per_event]) * \
+                           np.dtype(dtype).itemsize / (1000.0 * 1000.0)
+    return max(int(megabytes / (megabytes_per_sample * num_classes)), 1)
 
 
 def _checkDir(dir):
@@ -367,19 +415,211 @@ def runAndStore():
 
 def check_enough_data(sources, num_samples):
     for s in sources:
-        files = glob.glob(os.path.abspath(s) + "/*.h5")
-        tot = 0
-        sizesDict = get_sizes_meta_dict(s)
-        for f in files:
-            tot += size_from_meta(f, sizesDict=sizesDict)
+        tot = sample_index(s, _pandas_files(s)).total
         if(tot < num_samples):
             raise IOError("Only %r samples in %r but requested %r" % (tot,s,num_samples))
     
 
+def _write_manifest(folder, manifest):
+    write_json_atomic(manifest, os.path.join(folder, DATASET_MANIFEST))
+
+
+def _dataset_options(D, batch_size, compression, compression_level):
+    '''Helper Function - The h5py create_dataset options of a shard dataset'''
+    opts = {}
+    if (compression != None):
+        opts = {"compression": compression, "shuffle": True}
+        if (compression == "gzip"): opts["compression_opts"] = compression_level
+    if (batch_size != None and len(D) > 0):
+        # One chunk per batch, so a batch is read and decompressed in one go
+        opts["chunks"] = (min(batch_size, len(D)),) + D.shape[1:]
+    return opts
+
+
+def _write_shard(dest, arrays, storage):
+    '''Helper Function - Writes a shard under a temporary name and renames it once it is complete
+        :param arrays: the datasets of the shard keyed by name, including "Labels"
+        :param storage: the batch_size, compression and compression_level of the datasets
+        :returns: the entry of the shard in the manifest
+    '''
+    tmp = dest + ".tmp"
+    h5f = h5py.File(tmp, 'w')
+    try:
+        for key, D in arrays.items():
+            h5f.create_dataset(key, data=D, **_dataset_options(D, **storage))
+    finally:
+        h5f.close()
+    os.rename(tmp, dest)
+    return {"samples": len(arrays["Labels"]), "class_counts": [int(c) for c in np.sum(arrays["Labels"], axis=0)],
+            "shapes": {key: list(D.shape) for key, D in arrays.items()},
+            "dtypes": {key: str(D.dtype) for key, D in arrays.items()}}
+
+
+def _build_shard(job):
+    '''Worker - Builds one shard
+        :returns: (the path of the shard, its entry in the manifest)
+    '''
+    kargs, dest, storage = job
+    x = pandas_to_numpy(**kargs)
+    return dest, _write_shard(dest, dict(zip(["Particles", "Labels", "HLF"], x)), storage)
+
+
+def _prepare_folder(folder, params, force):
+    '''Helper Function - Clears or checks an output directory and returns its manifest, which lists the shards
+        that a previous run of the same build already completed'''
+    if (force):
+        shutil.rmtree(folder, ignore_errors=True)
+    if (not os.path.exists(folder)):
+        os.mkdir(folder)
+    manifest = read_dataset_manifest(folder)
+    if (manifest == None):
+        if (len(glob.glob(folder + "/*.h5")) != 0):
+            raise IOError("directory %r is not empty use -f or --force to clear the directory first" % folder)
+        manifest = {"format": DATASET_FORMAT, "version": DATASET_VERSION, "params": params, "shards": {}}
+    elif (manifest["params"] != params):
+        raise IOError("directory %r holds a different dataset, use -f or --force to clear the directory first" % folder)
+    # Shards that were being written when a previous run stopped
+    for tmp in glob.glob(folder + "/*.h5.tmp"):
+        os.remove(tmp)
+    for name in list(manifest["shards"].keys()):
+        if (not os.path.exists(os.path.join(folder, name))):
+            del manifest["shards"][name]
+    _write_manifest(folder, manifest)
+    return manifest
+
+
+#--------------------------STREAMING--------------------------
+# Blocks in flight are (shard, class, offset of the block in the class's samples of the shard, Particles, HLF),
+# workers report a failure as (STREAM_ERROR, traceback)
+STREAM_ERROR = -1
+# How many shards a reader may start ahead of the last shard that was written
+STREAM_SHARDS_AHEAD = 2
+# How many seconds to wait for a block before checking whether a reader or worker died
+STREAM_POLL_INTERVAL = 1.0
+
+
+def _stream_reader(label, source, shards, block_size, observ_types, permits, read_queue, write_queue):
+    '''Worker - Reads the samples of one class for every shard in order and puts them on read_queue in blocks of at
+        most block_size samples. Since the shards are consecutive ranges each source file is opened only once.'''
+    store, f_open = None, None
+    try:
+        index = sample_index(source, _pandas_files(source))
+        for shard, (start, samples_per_class) in enumerate(shards):
+            permits.acquire()
+            offset = 0
+            for f, file_start_read, samples_to_read in index.slices(start, samples_per_class):
+                if (f != f_open):
+                    if (store != None): store.close()
+                    store, f_open = _open_pandas(f), f
+                for block_start in range(0, samples_to_read, block_size):
+                    n = min(block_size, samples_to_read - block_start)
+                    d = get_from_pandas(store, file_start_read + block_start, n, rows_per_event=DEFAULT_RPE,
+                                        observ_types=observ_types)
+                    read_queue.put((shard, label, offset, d["Particles"], d["HLF"]))
+                    offset += n
+    except Exception:
+        write_queue.put((STREAM_ERROR, traceback.format_exc()))
+    finally:
+        if (store != None): store.close()
+
+
+def _stream_transform(read_queue, write_queue, sort_columns, sort_ascending, observ_types, dtype):
+    '''Worker - Sorts the particles of the blocks on read_queue and converts them to dtype until it gets None'''
+    for block in iter(read_queue.get, None):
+        try:
+            shard, label, offset, Particles, HLF = block
+            Particles = sort_numpy(Particles, sort_columns, sort_ascending, observ_types["Particles"])
+            write_queue.put((shard, label, offset, Particles.astype(dtype, copy=False), HLF.astype(dtype, copy=False)))
+        except Exception:
+            write_queue.put((STREAM_ERROR, traceback.format_exc()))
+
+
+def stream_shards(sources, shards, storage, done, num_processes=1, block_size=1000, observ_types=DEFAULT_OBSERVS,
+                  sort_columns=None, sort_ascending=True, dtype='float32', label_dtype='int8'):
+    '''Builds shards like _build_shard, but in one pass over the sources: one process per class reads its source
+        sequentially in blocks of events, num_processes workers sort and convert the blocks, and this process
+        interleaves the classes into the shards and writes them while the sources are still being read.
+
+        :param sources: the source directory of each class
+        :param shards: a list of (dest, start, samples_per_class) of consecutive ranges of samples, in order, i.e.
+                       the missing shards of train and then val
+        :param storage: the batch_size, compression and compression_level of the datasets
+        :param done: called with (dest, entry of the shard in the manifest) once a shard is written
+        :param num_processes: the number of workers that sort the blocks
+        :param block_size: the number of events in each block
+    '''
+    num_classes = len(sources)
+    read_queue = Queue(maxsize=4 * max(num_processes, num_classes))
+    write_queue = Queue(maxsize=4 * max(num_processes, num_classes))
+    # Readers wait for a permit before starting each shard, so that the fast classes do not fill up memory
+    permits = [Semaphore(STREAM_SHARDS_AHEAD) for _ in sources]
+    ranges = [(start, n) for dest, start, n in shards]
+    readers = [Process(target=_stream_reader, name="stream_reader-%d" % label,
+                       args=(label, source, ranges, block_size, observ_types, permits[label], read_queue, write_queue))
+               for label, source in enumerate(sources)]
+    workers = [Process(target=_stream_transform, name="stream_transform-%d" % i,
+                       args=(read_queue, write_queue, sort_columns, sort_ascending, observ_types, dtype))
+               for i in range(max(num_processes, 1))]
+    for p in readers + workers:
+        p.daemon = True
+        p.start()
+
+    # The shards that are being filled: (arrays, rows filled, the row each sample read goes to)
+    building = {}
+    written = 0
+    try:
+        while (written < len(shards)):
+            try:
+                block = write_queue.get(timeout=STREAM_POLL_INTERVAL)
+            except Empty:
+                # A process that was killed (i.e. out of memory) never reports back
+                dead = [p for p in readers + workers if p.exitcode != None and p.exitcode != 0]
+                if (len(dead) > 0):
+                    raise RuntimeError("%s exited with code %r" % (dead[0].name, dead[0].exitcode))
+                continue
+            if (block[0] == STREAM_ERROR):
+                raise RuntimeError("A worker of stream_shards failed:\n" + block[1])
+            shard, label, offset, Particles, HLF = block
+            dest, start, samples_per_class = shards[shard]
+            if (not shard in building):
+                num_samples = samples_per_class * num_classes
+                arrays = {"Particles": np.empty((num_samples,) + Particles.shape[1:], dtype=dtype),
+                          "Labels": np.zeros((num_samples, num_classes), dtype=label_dtype),
+                          "HLF": np.empty((num_samples,) + HLF.shape[1:], dtype=dtype)}
+                # The events are shuffled as they are written, as in pandas_to_numpy
+                building[shard] = [arrays, 0, np.random.permutation(num_samples)]
+            arrays, filled, indices = building[shard]
+            first = label * samples_per_class + offset
+            rows = indices[first: first + len(Particles)]
+            arrays["Particles"][rows] = Particles
+            arrays["HLF"][rows] = HLF
+            arrays["Labels"][rows, label] = 1
+            building[shard][1] += len(Particles)
+            if (building[shard][1] == len(indices)):
+                del building[shard]
+                done(dest, _write_shard(dest, arrays, storage))
+                written += 1
+                for permit in permits:
+                    permit.release()
+        for _ in workers:
+            read_queue.put(None)
+        for p in readers + workers:
+            p.join()
+    finally:
+        for p in readers + workers:
+            if (p.is_alive()): p.terminate()
+
+
 def make_datasets(sources, output_dir, num_samples, size=1000,
                   num_processes=1, sort_on=None, sort_ascending=False,
-                  v_split=0.0, force=False):
-    '''Creates a data set in the output_dir folder with /train and /val subdirectories
+                  v_split=0.0, force=False, dtype='float32', batch_size=None, compression=None, compression_level=4,
+                  stream=False, block_size=1000):
+    '''Creates a data set in the output_dir folder with /train and /val subdirectories. Shards are written under
+        a temporary name and recorded in a manifest.json in their directory once they are complete, so running
+        the same build again only builds the shards that are missing, and training can read the shards that are
+        published while the build goes on (see io.gen_from_tail). The manifest also records the number of
+        samples of each class, and the shape and dtype of each dataset, of every shard so that readers
+        (i.e. gen_from_data, DataIterator and size_from_meta) do not need to open them.
     
         :param sources: a list of source directories of pandas .h5 files. Order matters; 
                         the first source corresponds to [1,0,..,0], the second to [0,1,..,0],etc.
@@ -388,7 +628,7 @@ def make_datasets(sources, output_dir, num_samples, size=1000,
         :type output_dir: str
         :param num_samples: the number of samples to take for each class
         :type num_samples: int
-        :param size: the number of samples to put in each file, or '<int>MB' (i.e '100MB')
+        :param size: the number of samples to put in each file, or a target filesize in MB or GB (i.e '100MB')
                     corresponding to the target filesize
         :type size: int or str
         :param num_processes: The number of processes to use concurrently to build the dataset 
@@ -400,76 +640,99 @@ def make_datasets(sources, output_dir, num_samples, size=1000,
         :param v_split: the proportion of the total data to use for validation, 
                         or the total number of events to use (the rest goes to training)
         :type v_split: float or int
-        
-        
-        
+        :param force: if True clear the output directories first, otherwise finish the shards of a previous
+                      run of the same build
+        :type force: bool
+        :param dtype: the dtype to store Particles and HLF as
+        :type dtype: str
+        :param batch_size: if given the datasets are chunked by this many samples, i.e. the training batch size
+        :type batch_size: int
+        :param compression: the compression filter of the datasets; None, 'gzip' or 'lzf' (fast, but compresses less)
+        :type compression: str
+        :param compression_level: the gzip compression level from 1 (fastest) to 9
+        :type compression_level: int
+        :param stream: if True build the shards with stream_shards, which reads each source file once, instead of
+                       building every shard on its own. num_processes is then the number of workers that sort.
+        :type stream: bool
+        :param block_size: the number of events read at a time when stream is True
+        :type block_size: int
         '''
     sources = [_checkDir(s) for s in sources]
 
     check_enough_data(sources,num_samples)
     
     if(isinstance(size ,string_types)):
-        if ("MB" in size):
-            megabytes = int(re.search(r'\d+', size).group())
-            stride = strideFromTargetSize(rows_per_event=DEFAULT_RPE, observ_types=DEFAULT_OBSERVS, megabytes=megabytes)
+        if (size.strip().upper().endswith("B")):
+            stride = strideFromTargetSize(rows_per_event=DEFAULT_RPE, observ_types=DEFAULT_OBSERVS,
+                                          num_classes=len(sources), megabytes=parse_megabytes(size), dtype=dtype)
         else:
             stride = int(re.search(r'\d+', size).group())
     else:
         stride = size
+    if (not compression in COMPRESSIONS):
+        raise ValueError("compression must be one of %r" % COMPRESSIONS)
+    storage = {"batch_size": batch_size, "compression": compression, "compression_level": compression_level}
     SNs = set_range_from_splits(splitsFromVal(v_split, num_samples), num_samples)
 
     if (not os.path.exists(output_dir)):
         os.mkdir(output_dir)
     jobs = []
+    manifests = {}
     for i, sn in enumerate(SNs):
         folder = os.path.abspath(output_dir) + ("/train" if (i == 0) else '/val')
-        if (force):
-            try:
-                shutil.rmtree(folder)
-            except Exception:
-                pass
-        if (len(glob.glob(folder + "/*.h5")) != 0):
-            raise IOError("directory %r is not empty use -f or --force to clear the directory first" % folder)
-
-        if (not os.path.exists(folder)):
-            os.mkdir(folder)
+        params = {"sources": sources, "start": sn[0], "num_samples": sn[1], "stride": stride, "sort_on": sort_on,
+                  "sort_ascending": sort_ascending, "dtype": dtype}
+        params.update(storage)
+        manifest = manifests[folder] = _prepare_folder(folder, params, force)
         order_of_mag = max(int(math.log(sn[1] / stride + 1, 10)), 3)
         end = sn[0] + sn[1]
+        # Readers tailing the directory (see io.gen_from_tail) wait for more shards until it is complete
+        manifest["num_shards"] = len(range(sn[0], end, stride))
+        manifest["complete"] = len(manifest["shards"]) == manifest["num_shards"]
+        _write_manifest(folder, manifest)
         for j, start in enumerate(range(sn[0], end, stride)):
             samples_per_class = min(stride, end - start)
             kargs = {'data_dirs': sources, 'start': start, 'samples_per_class': samples_per_class,
                      'observ_types': DEFAULT_OBSERVS, 'sort_columns': [sort_on], 'sort_ascending': sort_ascending,
-                     'verbose': 1}
+                     'verbose': 1, 'dtype': dtype}
             dest = os.path.abspath(folder + ("/%0" + str(order_of_mag) + "d.h5") % j)
-            jobs.append((kargs, dest))
-
-    def f(jobs):
-        for kargs, dest in jobs:
-            x = pandas_to_numpy(**kargs)
-            h5f = h5py.File(dest, 'w')
-            for D, key in zip(x, ["Particles", "Labels", "HLF"]):
-                h5f.create_dataset(key, data=D)
-            h5f.close()
-            print("Done: %s/%s" % tuple(dest.split("/")[-2:]))
-
-    num_processes = num_processes
-    processes = []
-    splits = [jobs[i::num_processes] for i in range(num_processes)]
-    Ksamples_per_process = np.ceil(num_samples / num_processes)
-    for i, sublist in enumerate(splits[1:]):
-        print("Thread %r Started" % i)
-        p = Process(target=f, args=sublist)
-        processes.append(p)
-        p.start()
-        sleep(.001)
-    try:
-        f(splits[0])
-    except Exception as e:
-        for p in processes:
-            p.terminate()
-        raise e
-    for p in processes:
-        p.join()
+            if (not os.path.basename(dest) in manifest["shards"]):
+                jobs.append((kargs, dest, storage))
+    if (len(jobs) == 0):
+        print("All shards are already built")
+        return
+
+    def done(dest, info):
+        folder, name = os.path.split(dest)
+        manifest = manifests[folder]
+        manifest["shards"][name] = info
+        manifest["complete"] = len(manifest["shards"]) == manifest["num_shards"]
+        # The shard is published by replacing the manifest, after the shard itself was renamed into place
+        _write_manifest(folder, manifest)
+        print("Done: %s/%s" % tuple(dest.split("/")[-2:]))
+
+    if (stream):
+        # Val follows train in the sources, so both are streamed in one pass and the source file at the boundary
+        #   is opened once
+        shards = sorted([(dest, kargs['start'], kargs['samples_per_class']) for kargs, dest, _ in jobs],
+                        key=lambda shard: shard[1])
+        stream_shards(sources, shards, storage, done, num_processes=num_processes, block_size=block_size,
+                      observ_types=DEFAULT_OBSERVS, sort_columns=[sort_on], sort_ascending=sort_ascending, dtype=dtype)
+    elif (num_processes > 1):
+        # Workers take the next job as soon as they finish one
+        pool = Pool(num_processes)
+        try:
+            for dest, info in pool.imap_unordered(_build_shard, jobs):
+                done(dest, info)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        for job in jobs:
+            done(*_build_shard(job))
 
 def main(argv):
     parser = argparse.ArgumentParser(
@@ -480,9 +743,9 @@ def main(argv):
     parser.add_argument('-p', '--num_processes', metavar='N', type=int, dest='num_processes', default=1,
                         help='How many processes to use concurrently.')
     parser.add_argument('-s', '--size', metavar='N', type=str, default='1000',
-                        help='The number of samples per file to use. Can also indicate a target size in MB. An integer, or integer followed by MB (i.e 100MB)')
+                        help='The number of samples per file to use. Can also indicate a target size in MB or GB. An integer, or a number followed by MB or GB (i.e 100MB)')
     parser.add_argument('-f', '--force', action='store_true',  default=False,
-                        help='if true clean the output directory before starting, else throw an error')
+                        help='if true clean the output directory before starting, else only build the shards that are missing')
     parser.add_argument('-v', '--validation_split', type=float, default=0.0, dest='v_split',
                         help='the proportion of samples that should be reserved for validation, or the number of samples_per_class that should be used')
     parser.add_argument('--sort_on', type=str, default=None, dest='sort_on',
@@ -491,13 +754,27 @@ def main(argv):
                         help='To sort ascending')
     parser.add_argument('--sort_descending', action='store_false', default=False, dest='sort_ascending',
                         help='To sort descending')
+    parser.add_argument('--dtype', type=str, default='float32', dest='dtype',
+                        help='The dtype to store Particles and HLF as (i.e float32 or float64)')
+    parser.add_argument('-b', '--batch_size', metavar='N', type=int, default=None, dest='batch_size',
+                        help='Chunk the datasets by this many samples, i.e. the training batch size')
+    parser.add_argument('-c', '--compression', type=str, default=None, dest='compression', choices=['gzip', 'lzf'],
+                        help='The compression filter to use, lzf is faster but compresses less')
+    parser.add_argument('--compression_level', metavar='N', type=int, default=4, dest='compression_level',
+                        help='The gzip compression level from 1 (fastest) to 9')
+    parser.add_argument('--stream', action='store_true', default=False, dest='stream',
+                        help='Read each source file once, with a reader per class, and sort with --num_processes workers')
+    parser.add_argument('--block_size', metavar='N', type=int, default=1000, dest='block_size',
+                        help='The number of events to read at a time with --stream')
     
     try:
         args = parser.parse_args(argv)
     except Exception:
         parser.print_usage()
     make_datasets(args.sources, args.output_dir, args.num_samples, size=args.size, num_processes=args.num_processes,
-                  sort_on=args.sort_on, sort_ascending=args.sort_ascending, v_split=args.v_split, force=args.force)
+                  sort_on=args.sort_on, sort_ascending=args.sort_ascending, v_split=args.v_split, force=args.force,
+                  dtype=args.dtype, batch_size=args.batch_size, compression=args.compression,
+                  compression_level=args.compression_level, stream=args.stream, block_size=args.block_size)
         
 
 if __name__ == "__main__":
@@ -0,0 +1,130 @@
+'''
+parser_benchmark.py
+Times each stage of delphes_parser on a SyntheticTree, so that the throughput of the parser can be
+followed on machines without ROOT. Every stage is reported in entries/sec, along with the peak memory
+allocated while it runs (measured in a second, traced pass since tracing slows everything down).
+
+    python parser_benchmark.py [-n num_entries] [-b block_size] [-s seed]
+'''
+import os
+import sys
+if __package__ is None:
+    sys.path.append(os.path.realpath(__file__+"/../../../"))
+import time
+import getopt
+import numpy as np
+try:
+    import tracemalloc
+except ImportError:
+    #Python 2, only the timings are reported
+    tracemalloc = None
+from CMS_Deep_Learning.preprocessing.delphes_parser import DEFAULT_BLOCK_SIZE, iter_delphes_tables, _to_frames
+from CMS_Deep_Learning.preprocessing.synthetic_delphes import SyntheticTree
+
+STAGES = ['preselection', 'read', 'fill', 'track matching', 'isolation', 'dataframe']
+
+
+class StageRecorder(object):
+    '''Accumulates the time spent in each stage, and optionally the largest amount of memory
+        allocated by a single call of each stage.
+        #Arguments
+            trace_memory -- Whether or not to trace memory allocations with tracemalloc
+    '''
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory and tracemalloc != None
+        self.seconds = {stage: 0.0 for stage in STAGES}
+        self.peak = {stage: 0 for stage in STAGES}
+
+    def __call__(self, stage, f, *args, **kwargs):
+        '''Calls f(*args, **kwargs) as part of stage and returns its output'''
+        if(self.trace_memory):
+            tracemalloc.start()
+        start = time.time()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            self.seconds[stage] += time.time() - start
+            if(self.trace_memory):
+                self.peak[stage] = max(self.peak[stage], tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+
+
+def _run(tree, record, block_size=DEFAULT_BLOCK_SIZE, **cuts):
+    '''Parses a whole tree like iter_delphes_to_pandas, recording every stage with record
+        #Returns
+            The number of entries that passed the cuts
+    '''
+    n_accepted = 0
+    for dicts_by_object, n_chunk, index_by_objects, chunk_start in iter_delphes_tables(tree, verbosity=0, block_size=block_size,
+                                                                                     recorder=record, **cuts):
+        record('dataframe', _to_frames, dicts_by_object, n_chunk, index_by_objects, chunk_start)
+        n_accepted += n_chunk
+    return n_accepted
+
+
+def benchmark_stages(n_entries=2000, seed=0, block_size=DEFAULT_BLOCK_SIZE, memory=True, tree=None, verbose=1, **cuts):
+    '''Times every stage of the columnar parser on a synthetic sample
+        #Arguments
+            n_entries -- The number of entries to generate
+            seed -- The seed of the synthetic sample
+            block_size -- The number of entries to read at a time
+            memory -- Whether or not to measure the peak memory of each stage in a second pass
+            tree -- (optional) A tree to use instead of generating a SyntheticTree
+            verbose -- Whether or not to print a table of the results
+            **cuts -- Passed on to iter_delphes_tables, i.e. requireLepton, num_jets
+        #Returns
+            A dictionary keyed by stage of dictionaries with the "seconds", "entries/sec" and
+            "peak memory (MB)" (None if it was not measured) of that stage
+    '''
+    if(tree == None):
+        tree = SyntheticTree(n_entries, seed=seed)
+    n_entries = tree.GetEntries()
+    timer = StageRecorder()
+    n_accepted = _run(tree, timer, block_size=block_size, **cuts)
+    tracer = None
+    if(memory and tracemalloc != None):
+        tracer = StageRecorder(trace_memory=True)
+        _run(tree, tracer, block_size=block_size, **cuts)
+
+    out = {}
+    for stage in STAGES:
+        #Only preselection sees the entries that fail the cuts
+        n = n_entries if stage == 'preselection' else n_accepted
+        seconds = timer.seconds[stage]
+        out[stage] = {"seconds": seconds,
+                      "entries/sec": n / max(seconds, 1e-9),
+                      "peak memory (MB)": None if tracer == None else tracer.peak[stage] / 2.0**20}
+    if(verbose >= 1):
+        print("%r entries, %r passed the cuts, block_size=%r" % (n_entries, n_accepted, block_size))
+        print("%-16s %10s %14s %18s" % ("stage", "seconds", "entries/sec", "peak memory (MB)"))
+        for stage in STAGES:
+            r = out[stage]
+            mem = "-" if r["peak memory (MB)"] == None else "%.1f" % r["peak memory (MB)"]
+            print("%-16s %10.3f %14.0f %18s" % (stage, r["seconds"], r["entries/sec"], mem))
+    return out
+
+
+def main(argv):
+    n_entries = 2000
+    block_size = DEFAULT_BLOCK_SIZE
+    seed = 0
+    screwup_error = "python parser_benchmark.py [-n num_entries] [-b block_size] [-s seed]"
+    try:
+        opts, args = getopt.getopt(argv,'n:b:s:h')
+    except getopt.GetoptError:
+        print(screwup_error)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print(screwup_error)
+            sys.exit()
+        elif opt in ("-n"):
+            n_entries = int(arg)
+        elif opt in ("-b"):
+            block_size = int(arg)
+        elif opt in ("-s"):
+            seed = int(arg)
+    benchmark_stages(n_entries=n_entries, seed=seed, block_size=block_size)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
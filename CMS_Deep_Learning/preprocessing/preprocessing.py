@@ -12,7 +12,9 @@ from six import string_types,reraise
 
 from CMS_Deep_Learning.storage.archiving import DataProcedure,read_json_obj,write_json_obj
 from CMS_Deep_Learning.storage.meta import msgpack_assertMeta
-from CMS_Deep_Learning.io import get_sizes_meta_dict, size_from_meta,gen_from_data
+from CMS_Deep_Learning.storage.columnar import ColumnarFile, COLUMNAR_EXTENSION
+from CMS_Deep_Learning.storage.indexed_msgpack import IndexedMsgpackFile, is_indexed_msgpack, read_legacy_msgpack
+from CMS_Deep_Learning.io import get_sizes_meta_dict, size_from_meta,gen_from_data,sample_index
 
 
 
@@ -180,18 +182,16 @@ def getFiles_StoreType(data_dir):
     data_dir = os.path.expandvars(data_dir)
     if(not os.path.isdir(data_dir)):
             raise IOError("Directory %r does not exist." % data_dir)
-    msgFiles = glob.glob(data_dir+"*.msg")
-    hdfFiles = glob.glob(data_dir+"*.h5")
-    if(len(msgFiles) == 0):
-        files = hdfFiles
-        storeType = "hdf5"
-    elif(len(hdfFiles) == 0):
-        files = msgFiles
-        storeType = "msgpack"
-    else:
-        raise IOError("Directory %r contains both .msg files and .h5 files, please use only one \
+    filesByType = {"hdf5" : glob.glob(data_dir+"*.h5"),
+                   "msgpack" : glob.glob(data_dir+"*.msg"),
+                   "columnar" : glob.glob(data_dir+"*"+COLUMNAR_EXTENSION)}
+    found = [t for t, lst in filesByType.items() if len(lst) > 0]
+    if(len(found) > 1):
+        raise IOError("Directory %r contains %s files, please use only one \
                         filetype when generating pandas files, to avoid data repetition issues\
-                        " % data_dir)
+                        " % (data_dir, " and ".join(sorted(found))))
+    storeType = found[0] if len(found) == 1 else "hdf5"
+    files = filesByType[storeType]
 
     #files = glob.glob(data_dir+"*.h5")
     if(len(files) < 1):
@@ -244,6 +244,10 @@ def getNumValFrame(filename, storeType):
             return None
         store.close()
         return num_val_frame
+    elif(storeType == "columnar"):
+        store = ColumnarFile(filename)
+        num_val_frame = store.read('NumValues')
+        store.close()
     elif(storeType == "msgpack"):
         meta_frames =  msgpack_assertMeta(filename)
         num_val_frame = meta_frames["NumValues"]
@@ -252,18 +256,18 @@ def getNumValFrame(filename, storeType):
     return num_val_frame
 
 def _getStore(f, storeType):
-    '''Helper Function - Gets the HDFStore or frames for the file and storeType'''
-    frames = None
+    '''Helper Function - Gets the HDFStore (or ColumnarFile) or frames for the file and storeType'''
+    store, frames = None, None
     if(storeType == "hdf5"):
         store = pd.HDFStore(f)
+    elif(storeType == "columnar"):
+        store = ColumnarFile(f)
+    elif(storeType == "msgpack" and is_indexed_msgpack(f)):
+        store = IndexedMsgpackFile(f)
     elif(storeType == "msgpack"):
-        print("Bulk reading .msg. Be patient, reading in slices not supported.")
+        print("Bulk reading .msg. Be patient, reading in slices not supported. Upgrade it with storage.indexed_msgpack.")
         sys.stdout.flush()
-        #Need to check for latin encodings due to weird pandas default
-        try:
-            frames = pd.read_msgpack(f)
-        except UnicodeDecodeError as e:
-            frames = pd.read_msgpack(f, encoding='latin-1')
+        frames = read_legacy_msgpack(f)
     return store,frames
 def _getFrame(store, storeType, key, select_start, select_stop,
               samples_to_read, file_total_entries, frames):
@@ -275,6 +279,9 @@ def _getFrame(store, storeType, key, select_start, select_stop,
             frame = store.get('/'+key)
         else:
             frame = store.select('/'+key, start=select_start, stop=select_stop)
+    elif(storeType == "columnar" or store != None):
+        #Only the chunks (or blocks of an indexed .msg) holding the selected rows are read
+        frame = store.read_rows('/'+key, select_start, select_stop)
     elif(storeType == "msgpack"):
         frame = frames[key]
         frame = frame[select_start:select_stop]
@@ -495,33 +502,16 @@ def preprocessFromPandas_label_dir_pairs(label_dir_pairs,start, samples_per_labe
     y_train_start = 0
     for (label,data_dir) in label_dir_pairs:
         files, storeType = getFiles_StoreType(data_dir)
-        files.sort()
         samples_read = 0
-        location = 0
         
-        sizesDict = get_sizes_meta_dict(data_dir)
+        #The files are read as if they were one long list, file_index finds where range(start, start+samples_per_label) is
+        file_index = sample_index(data_dir, files)
+        file_totals = dict(zip(file_index.files, file_index.counts))
          #Loop the files associated with the current label
-        for f in files:
-            file_total_entries = size_from_meta(f, storeType, sizesDict=sizesDict)#len(num_val_frame.index)
-            if (file_total_entries == None):
-                print("Skipping %r" % f)
-                continue
-            
-            assert file_total_entries > 0, "num_val_frame has zero values"
-            
-            if(location + file_total_entries <= start):
-                location += file_total_entries
-                continue
-
+        for f, file_start_read, samples_to_read in file_index.slices(start, samples_per_label):
+            file_total_entries = int(file_totals[f])
             num_val_frame = getNumValFrame(f, storeType)
             assert file_total_entries == len(num_val_frame.index)
-            #Determine what row to start reading the num_val table which contains
-            #information about how many rows there are for each entry
-            file_start_read = start-location if start > location else 0
-            
-            #How many rows we will read from this table each corresponds to one entry
-            samples_to_read = min(samples_per_label-samples_read, file_total_entries-file_start_read)
-            assert samples_to_read >= 0
             
             if(verbose >= 1): print("Reading %r samples from %r:" % (samples_to_read,f))
             
@@ -598,17 +588,12 @@ def preprocessFromPandas_label_dir_pairs(label_dir_pairs,start, samples_per_labe
             
             #Free this (probably not necessary)
             num_val_frame = None
-            if(storeType == "hdf5"):
+            if(store != None):
                 store.close()
-            location     += file_total_entries
             samples_read += samples_to_read
             if(verbose >= 1): print("*Read %r Samples of %r in range(%r, %r)" % (samples_read, samples_per_label, start, samples_per_label+start))
-            if(samples_read >= samples_per_label):
-                if(verbose >= 1): print('-' * 50)
-                assert samples_read == samples_per_label
-                break
-        if(samples_read != samples_per_label):
-            raise IOError("Not enough data in %r to read in range(%r, %r)" % (data_dir, start, samples_per_label+start))
+        assert samples_read == samples_per_label
+        if(verbose >= 1): print('-' * 50)
         
         #Generate the target data as vectors like [1,0,0], [0,1,0], [0,0,1]
         for i in range(samples_per_label):
@@ -697,69 +682,50 @@ def strideFromTargetSize(object_profiles, num_labels, observ_types, megabytes=10
     megabytes_per_sample = sum(o.max_size for o in object_profiles) * len(observ_types) * 24.0 / (1000.0 * 1000.0)
     return int(megabytes/megabytes_per_sample)
 
+#The keys of the files checked by maxMutualLength, keyed by file with the modification time they were read at
+_keys_cache = {}
+
+def _file_keys(f, storeType):
+    '''Gets the keys of a pandas file, which are only read again if the file changed. Returns None for .msg files
+        that are not indexed, since they would have to be decoded entirely.'''
+    modtime = os.path.getmtime(f)
+    if(f in _keys_cache and _keys_cache[f][0] == modtime):
+        return _keys_cache[f][1]
+    if(storeType == "hdf5"):
+        store = pd.HDFStore(f, mode='r')
+    elif(storeType == "columnar"):
+        store = ColumnarFile(f)
+    elif(is_indexed_msgpack(f)):
+        store = IndexedMsgpackFile(f)
+    else:
+        return None
+    keys = set(store.keys())
+    store.close()
+    _keys_cache[f] = (modtime, keys)
+    return keys
+
 def maxMutualLength(label_dir_pairs, object_profiles):
     '''Gets the mamximum number of samples that can mutually be read in the directories listed by
-        label_dir_pairs. Must also input object_profiles so that it knows what keys to check '''
+        label_dir_pairs. Must also input object_profiles so that it knows what keys to check, files that are missing
+        any of them may be corrupted and are skipped. The number of entries of each file comes from its sample_index,
+        so files are only opened if they changed since they were last counted.'''
+    keys = None
+    if(object_profiles != None):
+        keys = set(["/" + o.name for o in object_profiles])
     label_totals = {}
     for (label,data_dir) in label_dir_pairs:
-
         files, storeType = getFiles_StoreType(data_dir)
-
-        files.sort()
-        
-        keys = None
-        if(object_profiles != None):
-            keys = ["/" + o.name for o in object_profiles]
-        
+        index = sample_index(data_dir, files)
         label_totals[label] = 0
-         #Loop the files associated with the current label
-        
-        for f in files:
-            #Get the HDF Store for the file
-            if(storeType == "hdf5"):
-                #Get the HDF Store for the file
-                store = pd.HDFStore(f)
-
-                #Get the NumValues frame which lists the number of values for each entry
-
-                if(keys != None and set(keys).issubset(set(store.keys())) == False):
-                    print('File: ' + f + ' may be corrupted:' + os.linesep + 
-                                    'Requested keys: ' + str(keys) + os.linesep + 
-                                    'But found keys: ' + str(store.keys()) )
-                    print('Skipping %r' % f)
-                    continue
-                
-                try:
-                    num_val_frame = store.get('/NumValues')
-                except KeyError as e:
-                    raise KeyError(str(e) + " " + f)
-            elif(storeType == "msgpack"):
-                print("Bulk reading .msg. Be patient, reading in slices not supported.")
-                sys.stdout.flush()
-
-                #Need to check for latin encodings due to weird pandas default
-                try:
-                    frames = pd.read_msgpack(f)
-                except UnicodeDecodeError as e:
-                    frames = pd.read_msgpack(f, encoding='latin-1')
-                num_val_frame = frames["NumValues"]
-                    # store = pd.HDFStore(f)
-                    # #print(keys)
-                    # #print(store.keys())
-                    # #print(set(keys).issubset(set(store.keys())))
-                    # if(keys != None and set(keys).issubset(set(store.keys())) == False):
-                    #     raise KeyError('File: ' + f + ' may be corrupted:' + os.linesep + 
-                    #                     'Requested keys: ' + str(keys) + os.linesep + 
-                    #                     'But found keys: ' + str(store.keys()) )
-                    
-                    # #Get file_total_entries
-                    # try:
-                    #     num_val_frame = store.get('/NumValues')
-                    # except KeyError as e:
-                    #     raise KeyError(str(e) + " " + f)
-            file_total_entries = len(num_val_frame.index)
-            label_totals[label] += file_total_entries
-    #print(label_totals)
+        for f, count in zip(index.files, index.counts):
+            found = None if keys == None else _file_keys(f, storeType)
+            if(found != None and keys.issubset(found) == False):
+                print('File: ' + f + ' may be corrupted:' + os.linesep +
+                                'Requested keys: ' + str(sorted(keys)) + os.linesep +
+                                'But found keys: ' + str(sorted(found)) )
+                print('Skipping %r' % f)
+                continue
+            label_totals[label] += int(count)
     return min(label_totals.values())
 
 def start_num_fromSplits(splits, length):
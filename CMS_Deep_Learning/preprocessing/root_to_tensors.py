@@ -0,0 +1,212 @@
+'''
+root_to_tensors.py
+Converts Delphes ROOT files straight into the padded and sorted training tensors that
+preprocessFromPandas_label_dir_pairs builds out of pandas tables. The tables of each chunk of entries are
+parsed into TableBuffers by iter_delphes_tables and cut, sorted and padded for every entry at once,
+so nothing is written to (and read back from) an HDFStore in between:
+
+    root_to_tensors("ttbar_1.root", "ttbar_1.h5", object_profiles, observ_types, label=[1,0,0])
+'''
+import os
+import sys
+if __package__ is None:
+    sys.path.append(os.path.realpath(__file__+"/../../../"))
+import numpy as np
+import h5py
+import pandas as pd
+from CMS_Deep_Learning.preprocessing.delphes_parser import iter_delphes_tables, _to_frames, DEFAULT_SCHEMA, \
+    DEFAULT_BLOCK_SIZE
+from CMS_Deep_Learning.preprocessing.preprocessing import ObjectProfile, JET_PROFILE, EVENT_CHARS_PROFILE, \
+    _check_Object_Profiles
+
+RANDOM_SORTS = ["shuffle", "random"]
+
+
+def _sort_keys(columns, sort_columns, ascending):
+    '''Returns the keys to sort rows by (first key first) as in _sortByLocs, or None if they should not be sorted.
+        A "shuffle" or "random" sort gives the rows a random order.'''
+    if(sort_columns == None or None in sort_columns):
+        return None
+    n = len(next(iter(columns.values())))
+    if(True in [c in sort_columns for c in RANDOM_SORTS]):
+        return [np.random.random(n)]
+    return [columns[c] if ascending else -columns[c] for c in sort_columns]
+
+
+def _order(entry, keys):
+    '''Returns the order that sorts rows by entry and then by keys. Rows with equal keys keep their order.'''
+    if(keys == None):
+        return np.argsort(entry, kind='mergesort')
+    return np.lexsort(tuple(reversed(keys)) + (entry,))
+
+
+def _ranks(entry):
+    '''Returns the position of each row among the rows of its entry, for rows sorted by entry'''
+    return np.arange(len(entry)) - np.searchsorted(entry, entry, side='left')
+
+
+def _pad(entry, rank, values, n_entries, max_size):
+    '''Scatters rows sorted by entry into a zero padded array of shape (n_entries, max_size, vecsize)'''
+    out = np.zeros((n_entries, max_size, values.shape[1]))
+    out[entry, rank] = values
+    return out
+
+
+def _kept_columns(buf, n_rows, columns):
+    '''Returns the kept rows of the given columns of a TableBuffer as a dictionary of arrays'''
+    keep = buf.keep[:n_rows]
+    return {c: buf[c][:n_rows][keep] for c in columns}
+
+
+def _profile_rows(buf, n_rows, profile, observ_types):
+    '''Does what _applyParticleCuts and _addColumns do for every entry of a table at once: presorts the rows of each
+        entry, keeps the first profile.max_size of them, takes the columns in observ_types and fills in the
+        constant columns of profile.addColumns.
+        #Returns
+            (the entry of each row, the rows as an array of shape (n_rows, len(observ_types))), sorted by entry
+    '''
+    add_columns = profile.addColumns or {}
+    needed = ["Entry"] + [o for o in observ_types if not o in add_columns]
+    if(profile.pre_sort_columns != None):
+        needed += [c for c in profile.pre_sort_columns if c != None and not c in RANDOM_SORTS]
+    missing = [c for c in needed if not c in buf]
+    if(len(missing) > 0):
+        raise ValueError("Table %r has no columns %r" % (profile.name, missing))
+    columns = _kept_columns(buf, n_rows, set(needed))
+    entry = columns["Entry"]
+
+    order = _order(entry, _sort_keys(columns, profile.pre_sort_columns, profile.pre_sort_ascending))
+    entry = entry[order]
+    cut = _ranks(entry) < profile.max_size
+    rows = order[cut]
+    values = np.empty((len(rows), len(observ_types)))
+    for i, o in enumerate(observ_types):
+        values[:, i] = add_columns[o] if o in add_columns else columns[o][rows]
+    return entry[cut], values
+
+
+def _sort_and_pad(entry, values, n_entries, max_size, sort_columns, sort_ascending, observ_types):
+    '''Does what _padAndSort does for every entry at once, for rows sorted by entry'''
+    keys = None
+    if(sort_columns != None and len(values) > 0):
+        keys = _sort_keys({o: values[:, i] for i, o in enumerate(observ_types)}, sort_columns, sort_ascending)
+    order = _order(entry, keys)
+    entry, values = entry[order], values[order]
+    return _pad(entry, _ranks(entry), values, n_entries, max_size)
+
+
+def tables_to_tensors(dicts_by_object, n_entries, index_by_objects, object_profiles, observ_types, single_list=False,
+                      sort_columns=None, sort_ascending=True, schema=None):
+    '''Turns the TableBuffers of a chunk into the padded arrays that preprocessFromPandas_label_dir_pairs makes
+        out of the same entries.
+        #Arguments
+            dicts_by_object, n_entries, index_by_objects -- A chunk as yielded by iter_delphes_tables
+            schema -- The ParserSchema that the chunk was parsed with, it decides the columns of the jets
+            (See preprocessFromPandas_label_dir_pairs for the rest)
+        #Returns
+            (X, jets, eventChars), where X is a list with an array of shape (n_entries, max_size, len(observ_types))
+            for each profile, or a single array if single_list
+    '''
+    schema = DEFAULT_SCHEMA if schema == None else schema
+    rows = [_profile_rows(dicts_by_object[p.name], index_by_objects[p.name], p, observ_types) for p in object_profiles]
+    if(single_list):
+        entry = np.concatenate([r[0] for r in rows])
+        values = np.concatenate([r[1] for r in rows], axis=0)
+        #Keep the profiles in order within each entry
+        order = np.argsort(entry, kind='mergesort')
+        X = _sort_and_pad(entry[order], values[order], n_entries, sum([p.max_size for p in object_profiles]),
+                          sort_columns, sort_ascending, observ_types)
+    else:
+        X = [_sort_and_pad(entry, values, n_entries, p.max_size, p.sort_columns, p.sort_ascending, observ_types)
+             for p, (entry, values) in zip(object_profiles, rows)]
+
+    jet_observs = [c for c in schema.columns["Jet"] if c != "Entry"]
+    entry, values = _profile_rows(dicts_by_object["Jet"], index_by_objects["Jet"], JET_PROFILE, jet_observs)
+    jets = _sort_and_pad(entry, values, n_entries, JET_PROFILE.max_size, None, True, jet_observs)
+
+    chars_observs = [c for c in dicts_by_object["EventChars"].columns if c != "Entry"]
+    entry, values = _profile_rows(dicts_by_object["EventChars"], n_entries, EVENT_CHARS_PROFILE, chars_observs)
+    eventChars = _sort_and_pad(entry, values, n_entries, EVENT_CHARS_PROFILE.max_size, None, True, chars_observs)
+    return X, jets, eventChars
+
+
+def iter_root_to_tensors(filepath, object_profiles, observ_types, chunk_size=None, single_list=False, sort_columns=None,
+                         sort_ascending=True, pandas_out=None, verbosity=1, **kwargs):
+    '''Parses a Delphes ROOT file chunk_size entries at a time and yields the padded, sorted arrays of each chunk
+        #Arguments
+            filepath -- The path to the ROOT file, or an open tree like a SyntheticTree
+            object_profiles -- A list of ObjectProfiles with resolved max_sizes, one for each table to put in X
+            observ_types -- The columns of X, in order
+            chunk_size -- The number of entries (that pass the cuts) in each chunk. If None everything is one chunk.
+            single_list -- If True all object types are joined into a single list, sorted by sort_columns
+            pandas_out -- (optional) The path of an HDFStore to also append the tables of every chunk to
+            **kwargs -- Passed on to iter_delphes_tables, i.e. requireLepton, fixedNum, schema
+        #Yields
+            (X, jets, eventChars) for each chunk, see tables_to_tensors
+    '''
+    if("Entry" in observ_types):
+        raise ValueError("Using Entry in observ_types can result in skewed training results. Just don't.")
+    object_profiles = _check_Object_Profiles([ObjectProfile(p) if isinstance(p, dict) else p for p in object_profiles],
+                                             observ_types)
+    schema = kwargs.get("schema", None) or DEFAULT_SCHEMA
+    store = pd.HDFStore(pandas_out, mode='w') if pandas_out != None else None
+    try:
+        for tables in iter_delphes_tables(filepath, chunk_size=chunk_size, verbosity=verbosity, **kwargs):
+            dicts_by_object, n_entries, index_by_objects, chunk_start = tables
+            if(store != None):
+                for key, frame in _to_frames(dicts_by_object, n_entries, index_by_objects, chunk_start, schema).items():
+                    if(len(frame) > 0): store.append(key, frame, format='table')
+            yield tables_to_tensors(dicts_by_object, n_entries, index_by_objects, object_profiles, observ_types,
+                                    single_list=single_list, sort_columns=sort_columns, sort_ascending=sort_ascending,
+                                    schema=schema)
+    finally:
+        if(store != None): store.close()
+
+
+def _append(h5f, key, values):
+    if(not key in h5f):
+        h5f.create_dataset(key, data=values, maxshape=(None,) + values.shape[1:],
+                           chunks=(max(min(len(values), 256), 1),) + values.shape[1:])
+    else:
+        dset = h5f[key]
+        n = dset.shape[0]
+        dset.resize((n + len(values),) + dset.shape[1:])
+        dset[n:] = values
+
+
+def root_to_tensors(filepath, out_file, object_profiles, observ_types, label=None, chunk_size=DEFAULT_BLOCK_SIZE,
+                    single_list=False, sort_columns=None, sort_ascending=True, pandas_out=None, verbosity=1, **kwargs):
+    '''Converts a Delphes ROOT file into an HDF5 file of training tensors, chunk_size entries at a time. The file
+        has the same keys as the archives of the DataProcedures made by procsFrom_label_dir_pairs, so it can be read
+        with retrieve_data or gen_from_data: "X" (a dataset if single_list, otherwise a group with one dataset per
+        profile), "Y" (the label of every entry), "Jets" and "EventChars". Entries are not shuffled since a file
+        only holds one label.
+        #Arguments
+            filepath -- The path to the ROOT file
+            out_file -- The path of the HDF5 file to write
+            label -- (optional) The target vector of every entry of the file, i.e. [1,0,0]
+            pandas_out -- (optional) The path of an HDFStore to also write the pandas tables to
+            (See iter_root_to_tensors for the rest)
+        #Returns
+            The number of entries written
+    '''
+    num = 0
+    h5f = h5py.File(out_file, 'w')
+    try:
+        for X, jets, eventChars in iter_root_to_tensors(filepath, object_profiles, observ_types, chunk_size=chunk_size,
+                                                        single_list=single_list, sort_columns=sort_columns,
+                                                        sort_ascending=sort_ascending, pandas_out=pandas_out,
+                                                        verbosity=verbosity, **kwargs):
+            if(single_list):
+                _append(h5f, "X", X)
+            else:
+                for i, x in enumerate(X):
+                    _append(h5f, "X/" + str(i), x)
+            if(label != None):
+                _append(h5f, "Y", np.tile(np.asarray(label, dtype='float64'), (len(jets), 1)))
+            _append(h5f, "Jets", jets)
+            _append(h5f, "EventChars", eventChars)
+            num += len(jets)
+    finally:
+        h5f.close()
+    return num
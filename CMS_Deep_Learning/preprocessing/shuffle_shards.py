@@ -0,0 +1,184 @@
+'''
+shuffle_shards.py
+Shuffles the samples of a directory of shards written by make_datasets across all of its shards, so that
+training batches do not carry the order of the source files. Since a dataset does not fit in memory this
+is done in two passes over the disk:
+
+    scatter     every sample of every shard is sent to one of num_buckets buckets at random
+    gather      every bucket is read back, shuffled in memory and written out as a shard
+
+The number of buckets follows from the memory budget, so that a bucket fits in memory. Every shard
+(and every bucket) draws from its own random stream derived from the seed, so the result only depends on
+the seed, and not on the number of processes used.
+
+    python shuffle_shards.py <dataset_dir> -o <output_dir> [-s seed] [-m 500MB] [-p num_processes]
+'''
+import os
+import sys
+if __package__ is None:
+    sys.path.append(os.path.realpath(__file__+"/../../../"))
+import glob
+import argparse
+import numpy as np
+import h5py
+from multiprocessing import Pool
+from CMS_Deep_Learning.io import read_dataset_manifest, shards_from_manifest, nb_samples_from_manifest, \
+    DATASET_FORMAT
+from CMS_Deep_Learning.preprocessing.pandas_to_numpy import parse_megabytes, _write_shard, _write_manifest, \
+    DATASET_VERSION
+
+SCATTER, GATHER = 0, 1
+
+
+def _shards(directory):
+    '''Returns the shards of a directory and their number of samples, from its manifest if it has one'''
+    shards = shards_from_manifest(directory)
+    if (shards == None):
+        shards = sorted(glob.glob(os.path.join(os.path.abspath(directory), "*.h5")))
+    sizes = []
+    for shard in shards:
+        n = nb_samples_from_manifest(shard)
+        if (n == None):
+            with h5py.File(shard, 'r') as f:
+                n = len(f["Labels"])
+        sizes.append(n)
+    return shards, sizes
+
+
+def _scatter(args):
+    '''Worker - Sends every sample of a shard to a random bucket. The samples of each bucket are written
+        contiguously, in their original order, to a group of the part file of the shard.
+        #Returns
+            The number of samples sent to each bucket
+    '''
+    shard, index, part, num_buckets, seed, chunk_samples = args
+    with h5py.File(shard, 'r') as src:
+        n = len(src["Labels"])
+        buckets = np.random.RandomState([seed, SCATTER, index]).randint(num_buckets, size=n)
+        counts = np.bincount(buckets, minlength=num_buckets)
+        with h5py.File(part, 'w') as out:
+            for b in np.nonzero(counts)[0]:
+                group = out.create_group(str(b))
+                for key in src.keys():
+                    group.create_dataset(key, shape=(counts[b],) + src[key].shape[1:], dtype=src[key].dtype)
+            written = np.zeros(num_buckets, dtype='int64')
+            for start in range(0, n, chunk_samples):
+                stop = min(start + chunk_samples, n)
+                order = np.argsort(buckets[start:stop], kind='mergesort')
+                chunk_counts = np.bincount(buckets[start:stop], minlength=num_buckets)
+                bounds = np.concatenate([[0], np.cumsum(chunk_counts)])
+                for key in src.keys():
+                    X = src[key][start:stop][order]
+                    for b in np.nonzero(chunk_counts)[0]:
+                        out[str(b)][key][written[b]:written[b] + chunk_counts[b]] = X[bounds[b]:bounds[b + 1]]
+                written += chunk_counts
+    return counts
+
+
+def _gather(args):
+    '''Worker - Reads a bucket from the part files of every shard, shuffles it and writes it as a shard
+        #Returns
+            (the path of the shard, its entry in the manifest)
+    '''
+    parts, bucket, dest, seed, storage = args
+    arrays = {}
+    for part in parts:
+        with h5py.File(part, 'r') as f:
+            if (not str(bucket) in f):
+                continue
+            for key, D in f[str(bucket)].items():
+                arrays.setdefault(key, []).append(D[:])
+    arrays = {key: np.concatenate(lst) for key, lst in arrays.items()}
+    perm = np.random.RandomState([seed, GATHER, bucket]).permutation(len(arrays["Labels"]))
+    arrays = {key: D[perm] for key, D in arrays.items()}
+    return dest, _write_shard(dest, arrays, storage)
+
+
+def shuffle_dataset(directory, output_dir, seed=0, memory="500MB", num_buckets=None, num_processes=1, verbose=1):
+    '''Shuffles the samples of a directory of shards across all of the shards, see the top of this file.
+        #Arguments
+            directory -- The directory of shards to shuffle, i.e. the train or val directory of make_datasets
+            output_dir -- The directory to write the shuffled shards to, it must not be directory
+            seed -- The seed of the shuffle, the same seed always gives the same shards
+            memory -- The memory each process may use like "500MB" or "2GB", it sets the number of buckets (and shards)
+            num_buckets -- The number of buckets (and shards) to use, if None it follows from memory
+            num_processes -- The number of shards (in the first pass) or buckets (in the second) to work on at
+                            the same time
+        #Returns
+            A list of (shard path, number of samples)
+    '''
+    directory = os.path.join(os.path.abspath(directory), "")
+    output_dir = os.path.join(os.path.abspath(output_dir), "")
+    if (directory == output_dir):
+        raise ValueError("output_dir must be different from directory %r" % directory)
+    shards, sizes = _shards(directory)
+    if (len(shards) == 0):
+        raise IOError("No shards in %r" % directory)
+    manifest = read_dataset_manifest(directory)
+    params = {} if manifest == None else dict(manifest["params"])
+    storage = {key: params.get(key, default) for key, default in
+               [("batch_size", None), ("compression", None), ("compression_level", 4)]}
+
+    with h5py.File(shards[0], 'r') as f:
+        bytes_per_sample = sum([np.prod(D.shape[1:]) * D.dtype.itemsize for D in f.values()])
+    budget = parse_megabytes(memory) * 1000.0 * 1000.0
+    total = sum(sizes)
+    if (num_buckets == None):
+        #A bucket is in memory twice while it is shuffled
+        num_buckets = int(np.ceil(2 * total * bytes_per_sample / budget))
+    num_buckets = max(min(num_buckets, total), 1)
+    chunk_samples = max(int(budget / (2 * bytes_per_sample)), 1)
+
+    if (not os.path.exists(output_dir)):
+        os.makedirs(output_dir)
+    if (len(glob.glob(output_dir + "*.h5")) != 0):
+        raise IOError("directory %r is not empty" % output_dir)
+    parts = [output_dir + "%05d.part" % i for i in range(len(shards))]
+    if (verbose >= 1): print("Shuffling %r samples of %r shards through %r buckets" % (total, len(shards), num_buckets))
+
+    pool = Pool(num_processes) if num_processes > 1 else None
+    try:
+        jobs = [(shard, i, part, num_buckets, seed, chunk_samples) for i, (shard, part) in enumerate(zip(shards, parts))]
+        counts = sum(pool.map(_scatter, jobs) if pool != None else [_scatter(job) for job in jobs])
+        buckets = [b for b in range(num_buckets) if counts[b] > 0]
+        order_of_mag = max(len(str(len(buckets) - 1)), 3)
+        dests = [output_dir + ("%0" + str(order_of_mag) + "d") % i + ".h5" for i in range(len(buckets))]
+        jobs = [(parts, b, dest, seed, storage) for b, dest in zip(buckets, dests)]
+        out = pool.map(_gather, jobs) if pool != None else [_gather(job) for job in jobs]
+    finally:
+        if (pool != None):
+            pool.close()
+            pool.join()
+        for part in parts:
+            if (os.path.exists(part)): os.remove(part)
+
+    params["shuffle"] = {"source": directory, "seed": seed, "num_buckets": num_buckets}
+    _write_manifest(output_dir, {"format": DATASET_FORMAT, "version": DATASET_VERSION, "params": params,
+                                 "shards": {os.path.basename(dest): info for dest, info in out}})
+    if (verbose >= 1): print("Wrote %r shards to %r" % (len(out), output_dir))
+    return [(dest, info["samples"]) for dest, info in out]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Shuffle the samples of a dataset across all of its shards.')
+    parser.add_argument('dataset_dir', type=str,
+                        help='A directory of shards, or an output directory of make_datasets (with train and val).')
+    parser.add_argument('-o', '--output_dir', type=str, dest='output_dir', required=True)
+    parser.add_argument('-s', '--seed', metavar='N', type=int, dest='seed', default=0,
+                        help='The seed of the shuffle.')
+    parser.add_argument('-m', '--memory', type=str, default='500MB',
+                        help='The memory each process may use (i.e 500MB), which sets the number of buckets.')
+    parser.add_argument('-n', '--num_buckets', metavar='N', type=int, dest='num_buckets', default=None,
+                        help='The number of buckets (and output shards), used instead of --memory.')
+    parser.add_argument('-p', '--num_processes', metavar='N', type=int, dest='num_processes', default=1,
+                        help='How many shards or buckets to process concurrently.')
+    args = parser.parse_args(argv)
+    splits = [s for s in ("train", "val") if os.path.isdir(os.path.join(args.dataset_dir, s))]
+    pairs = [(os.path.join(args.dataset_dir, s), os.path.join(args.output_dir, s)) for s in splits] if splits else \
+        [(args.dataset_dir, args.output_dir)]
+    for directory, output_dir in pairs:
+        shuffle_dataset(directory, output_dir, seed=args.seed, memory=args.memory, num_buckets=args.num_buckets,
+                        num_processes=args.num_processes)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
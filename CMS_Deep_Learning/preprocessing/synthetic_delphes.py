@@ -0,0 +1,213 @@
+'''
+synthetic_delphes.py
+A numpy backed stand in for the parts of a Delphes TTree that delphes_parser uses (GetLeaf, GetBranch,
+GetEntry, GetLen, GetValue, Draw/GetVal, TEntryList), filled with random events. It lets the parser be
+benchmarked and regression tested on machines without ROOT or Delphes files:
+
+    tree = SyntheticTree(1000, seed=0)
+    frames = delphes_to_pandas(tree)
+'''
+import math
+import numpy as np
+
+#The mean number of values per entry and the leaves of each collection, roughly those of
+#   13TeV ttbar events run through the Delphes CMS card without pileup
+MULTIPLICITIES = {'Electron': 0.8, 'MuonTight': 0.8, 'Photon': 1.5, 'MissingET': None, 'EFlowPhoton': 90.0,
+                  'EFlowNeutralHadron': 45.0, 'EFlowTrack': 120.0, 'Jet': 6.0}
+LEAVES = {'Electron': ['PT', 'Eta', 'Phi', 'Charge', 'EhadOverEem'],
+          'MuonTight': ['PT', 'Eta', 'Phi', 'Charge'],
+          'Photon': ['PT', 'Eta', 'Phi', 'E', 'EhadOverEem'],
+          'MissingET': ['MET', 'Eta', 'Phi'],
+          'EFlowPhoton': ['ET', 'Eta', 'Phi', 'E', 'Ehad', 'Eem'],
+          'EFlowNeutralHadron': ['ET', 'Eta', 'Phi', 'E', 'Ehad', 'Eem'],
+          'EFlowTrack': ['PT', 'Eta', 'Phi', 'Charge', 'X', 'Y', 'Z', 'Dxy'],
+          'Jet': ['PT', 'Eta', 'Phi', 'Mass', 'Flavor', 'FlavorAlgo', 'FlavorPhys', 'BTag', 'BTagAlgo', 'BTagPhys',
+                  'TauTag', 'Charge', 'EhadOverEem', 'NCharged', 'NNeutrals', 'Beta', 'BetaStar', 'MeanSqDeltaR',
+                  'PTD', 'NSubJetsTrimmed', 'NSubJetsPruned', 'NSubJetsSoftDropped']}
+#The mean of the exponential PT spectrum of each collection, on top of its threshold
+PT_SCALES = {'Electron': (30.0, 10.0), 'MuonTight': (30.0, 10.0), 'Photon': (20.0, 10.0), 'MissingET': (40.0, 0.0),
+             'EFlowPhoton': (3.0, 0.5), 'EFlowNeutralHadron': (4.0, 0.5), 'EFlowTrack': (3.0, 0.5), 'Jet': (50.0, 20.0)}
+#Leptons leave a track within TRACK_SMEAR of their direction
+TRACK_SMEAR = 0.01
+
+
+def _rows(offsets, entries):
+    '''Returns the flat indicies of the values of the given entries, in order'''
+    lo, hi = offsets[entries], offsets[entries+1]
+    n = hi - lo
+    shift = lo - np.concatenate([[0], np.cumsum(n)[:-1]]).astype('int64')
+    return np.repeat(shift, n) + np.arange(n.sum(), dtype='int64')
+
+
+class TLeafElement(object):
+    '''One leaf of a SyntheticTree. Values are read for the entry its branch is at.'''
+    def __init__(self, values, branch):
+        self.values = values
+        self.branch = branch
+
+    def GetBranch(self):
+        return self.branch
+
+    def GetLen(self):
+        return self.branch.n
+
+    def GetValue(self, i):
+        return float(self.values[self.branch.start + i])
+
+
+class TBranch(object):
+    '''The branch of one collection of a SyntheticTree'''
+    def __init__(self, offsets):
+        self.offsets = offsets
+        self.start, self.n = 0, 0
+
+    def GetEntry(self, entry):
+        self.start = int(self.offsets[entry])
+        self.n = int(self.offsets[entry+1]) - self.start
+        return 1
+
+
+class TEntryList(object):
+    '''A list of the entries of a SyntheticTree that TTree::Draw should read'''
+    def __init__(self, name="", title="", tree=None):
+        self.entries = []
+
+    def Enter(self, entry):
+        self.entries.append(int(entry))
+        return True
+
+    def GetN(self):
+        return len(self.entries)
+
+    def GetEntry(self, i):
+        return self.entries[i]
+
+
+class SyntheticTree(object):
+    '''A Delphes-like tree of random events, generated up front.
+        #Arguments
+            n_entries -- The number of entries
+            seed -- The seed of the random numbers
+            multiplicities -- (optional) A dictionary overriding the mean multiplicity of some collections
+    '''
+    def __init__(self, n_entries, seed=0, multiplicities={}):
+        rng = np.random.RandomState(seed)
+        self.n_entries = int(n_entries)
+        self.counts, self.offsets, self.columns = {}, {}, {}
+        for obj in sorted(LEAVES.keys()):
+            mult = multiplicities.get(obj, MULTIPLICITIES[obj])
+            if(mult == None):
+                counts = np.ones(self.n_entries, dtype='int64')
+            else:
+                counts = rng.poisson(mult, self.n_entries).astype('int64')
+            self.counts[obj] = counts
+            self.offsets[obj] = np.concatenate([[0], np.cumsum(counts)]).astype('int64')
+            self.columns[obj] = self._generate(rng, obj, int(counts.sum()))
+        for obj in ('Electron', 'MuonTight'):
+            self._plant_tracks(rng, obj)
+        for obj in self.columns:
+            for leaf in self.columns[obj]:
+                self.columns[obj][leaf] = self.columns[obj][leaf].astype('float32')
+        self.branches = {obj: TBranch(self.offsets[obj]) for obj in LEAVES}
+        self.entry_list = None
+        self.vals = []
+        self.rows = 0
+
+    def _generate(self, rng, obj, n):
+        scale, threshold = PT_SCALES[obj]
+        columns = {}
+        for leaf in LEAVES[obj]:
+            if(leaf in ('PT', 'ET', 'MET')):
+                columns[leaf] = rng.exponential(scale, n) + threshold
+            elif(leaf == 'Eta'):
+                columns[leaf] = np.clip(rng.normal(0.0, 1.6, n), -4.9, 4.9)
+            elif(leaf == 'Phi'):
+                columns[leaf] = rng.uniform(-math.pi, math.pi, n)
+            elif(leaf == 'Charge'):
+                columns[leaf] = rng.choice([-1.0, 1.0], n)
+            elif(leaf == 'Mass'):
+                columns[leaf] = rng.exponential(8.0, n)
+            elif(leaf in ('E', 'Ehad', 'Eem', 'Flavor', 'FlavorAlgo', 'FlavorPhys', 'NCharged', 'NNeutrals',
+                          'NSubJetsTrimmed', 'NSubJetsPruned', 'NSubJetsSoftDropped')):
+                columns[leaf] = rng.poisson(5.0, n).astype('float64')
+            elif(leaf in ('BTag', 'BTagAlgo', 'BTagPhys', 'TauTag')):
+                columns[leaf] = (rng.uniform(0.0, 1.0, n) < 0.2).astype('float64')
+            else:
+                columns[leaf] = rng.normal(0.0, 1.0, n)
+        return columns
+
+    def _plant_tracks(self, rng, obj):
+        '''Moves a random track of the same entry next to each lepton, so that track matching finds it'''
+        entry = np.repeat(np.arange(self.n_entries), self.counts[obj])
+        n_tracks = self.counts['EFlowTrack'][entry]
+        has_tracks = n_tracks > 0
+        tracks = self.offsets['EFlowTrack'][entry] + (rng.uniform(0.0, 1.0, len(entry)) * n_tracks).astype('int64')
+        lepton, tracks = np.nonzero(has_tracks)[0], tracks[has_tracks]
+        for leaf in ('Eta', 'Phi'):
+            smear = rng.uniform(-TRACK_SMEAR, TRACK_SMEAR, len(lepton))
+            self.columns['EFlowTrack'][leaf][tracks] = self.columns[obj][leaf][lepton] + smear
+        Phi = self.columns['EFlowTrack']['Phi']
+        Phi[tracks] = np.mod(Phi[tracks] + math.pi, 2 * math.pi) - math.pi
+        self.columns['EFlowTrack']['PT'][tracks] = self.columns[obj]['PT'][lepton]
+
+    def GetEntries(self):
+        return self.n_entries
+
+    def GetEntry(self, entry):
+        for branch in self.branches.values():
+            branch.GetEntry(entry)
+        return 1
+
+    def GetLeaf(self, name):
+        obj, leaf = name.split('.')
+        if(obj in self.columns and leaf in self.columns[obj]):
+            return TLeafElement(self.columns[obj][leaf], self.branches[obj])
+        return None
+
+    def SetCacheSize(self, size):
+        pass
+
+    def AddBranchToCache(self, name, subbranches=False):
+        pass
+
+    def SetBranchStatus(self, name, status):
+        pass
+
+    def SetEstimate(self, n):
+        pass
+
+    def SetEntryList(self, entry_list):
+        self.entry_list = entry_list
+
+    def GetEntryList(self):
+        return self.entry_list
+
+    def make_entry_list(self, name="", title=""):
+        '''Returns an empty TEntryList for this tree, where ROOT would use ROOT.TEntryList(name, title, tree)'''
+        return TEntryList(name, title, self)
+
+    def Draw(self, varexp, selection="", option="", nentries=None, firstentry=0):
+        '''Like TTree::Draw with only leaves or counter leaves (i.e. Electron_size) as expressions. With an entry
+            list set, firstentry and nentries count along the entry list like they do in ROOT.'''
+        if(self.entry_list != None):
+            entries = np.array(self.entry_list.entries, dtype='int64')
+        else:
+            entries = np.arange(self.n_entries, dtype='int64')
+        stop = len(entries) if nentries == None else firstentry+nentries
+        entries = entries[firstentry:stop]
+        self.vals = []
+        for expression in varexp.split(':'):
+            if(expression.endswith('_size')):
+                self.vals.append(self.counts[expression[:-len('_size')]][entries].astype('float64'))
+            else:
+                obj, leaf = expression.split('.')
+                self.vals.append(self.columns[obj][leaf][_rows(self.offsets[obj], entries)].astype('float64'))
+        self.rows = len(self.vals[0])
+        return self.rows
+
+    def GetSelectedRows(self):
+        return self.rows
+
+    def GetVal(self, i):
+        return self.vals[i]
+
@@ -0,0 +1,226 @@
+'''
+columnar.py
+An HDF5 layout for the tables written by delphes_parser that stores every column of a table as its own
+chunked, compressed, typed dataset. Collections with a variable number of rows per entry also store an
+int64 array of per-entry offsets, so that the rows of the entries [start, stop) are simply the rows
+[offsets[start], offsets[stop]) of every column. The "Entry" column is not stored, it is rebuilt from
+the offsets when a table is read.
+
+    /                   attrs: format, version, entries, (schema)
+    /<table>            attrs: columns (json list), per_entry
+    /<table>/<column>   one dataset per column, in its own dtype
+    /<table>/offsets    int64, length entries+1 (only for collections)
+'''
+import os
+import json
+import h5py
+import numpy as np
+import pandas as pd
+from six.moves.urllib.parse import quote
+
+COLUMNAR_FORMAT = "delphes-columnar"
+COLUMNAR_VERSION = 1
+COLUMNAR_EXTENSION = ".h5col"
+#Tables with exactly one row per entry
+PER_ENTRY_TABLES = ["NumValues", "EventChars"]
+CHUNK_ROWS = 16384
+COMPRESSION = "gzip"
+COMPRESSION_LEVEL = 4
+
+
+def _dataset_name(column):
+    '''Column names like E/c are not valid HDF5 names'''
+    return quote(column, safe='')
+
+
+def _unique(lst):
+    '''Returns the unique elements of lst in order of first appearance'''
+    out = []
+    for x in lst:
+        if(not x in out): out.append(x)
+    return out
+
+
+def is_columnar(path):
+    '''Returns True if path is an HDF5 file written by ColumnarWriter'''
+    if(not os.path.isfile(path) or not h5py.is_hdf5(path)):
+        return False
+    with h5py.File(path, 'r') as f:
+        return f.attrs.get("format", None) in (COLUMNAR_FORMAT, COLUMNAR_FORMAT.encode())
+
+
+class ColumnarWriter(object):
+    '''Writes (or appends) dictionaries of DataFrames, as returned by delphes_to_pandas, to a columnar file.
+        Tables are added to with every call to append, so a file can be written one chunk of entries at a time.
+        #Arguments
+            path -- The path of the file to write, it is overwritten
+            chunk_rows -- The number of rows per HDF5 chunk
+            compression -- The HDF5 compression filter (i.e. "gzip", "lzf" or None)
+    '''
+    def __init__(self, path, chunk_rows=CHUNK_ROWS, compression=COMPRESSION):
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.compression = compression
+        self.file = h5py.File(path, 'w')
+        self.file.attrs["format"] = COLUMNAR_FORMAT
+        self.file.attrs["version"] = COLUMNAR_VERSION
+        self.file.attrs["entries"] = 0
+        self.entries = 0
+
+    def _append_dataset(self, group, name, values):
+        if(not name in group):
+            opts = {}
+            if(self.compression != None):
+                opts = dict(compression=self.compression, shuffle=True)
+                if(self.compression == "gzip"): opts["compression_opts"] = COMPRESSION_LEVEL
+            group.create_dataset(name, data=values, maxshape=(None,), chunks=(self.chunk_rows,), **opts)
+        else:
+            dset = group[name]
+            n = dset.shape[0]
+            dset.resize((n + len(values),))
+            dset[n:] = values
+
+    def append(self, frames):
+        '''Appends the tables of the next entries. Every table of frames must be given every time.
+            #Arguments
+                frames -- A dictionary of DataFrames keyed by table, including "NumValues"
+        '''
+        num_values = frames["NumValues"]
+        for key, frame in frames.items():
+            self.append_table(key, frame, None if key in PER_ENTRY_TABLES else num_values[key].values)
+        self.entries += len(num_values.index)
+        self.file.attrs["entries"] = self.entries
+
+    def append_table(self, key, frame, counts=None):
+        '''Appends rows to a single table, without changing the number of entries of the file
+            #Arguments
+                key -- The name of the table
+                frame -- The DataFrame of the rows to append
+                counts -- The number of rows of each entry, or None if the table has one row per entry
+        '''
+        per_entry = counts is None
+        if(not key in self.file):
+            group = self.file.create_group(key)
+            group.attrs["columns"] = json.dumps([str(c) for c in frame.columns])
+            group.attrs["per_entry"] = per_entry
+            if(not per_entry):
+                self._append_dataset(group, "offsets", np.zeros(1, dtype='int64'))
+        group = self.file[key]
+        if(json.loads(group.attrs["columns"]) != [str(c) for c in frame.columns]):
+            raise ValueError("The columns of %r changed between appends" % key)
+        for column in frame.columns:
+            if(column == "Entry"): continue
+            self._append_dataset(group, _dataset_name(column), np.asarray(frame[column].values))
+        if(not per_entry):
+            last = group["offsets"][-1]
+            self._append_dataset(group, "offsets", last + np.cumsum(np.asarray(counts, dtype='int64')))
+
+    def close(self, **attrs):
+        '''Closes the file, recording any attrs (i.e. schema=fingerprint) with it'''
+        for key, value in attrs.items():
+            self.file.attrs[key] = value
+        self.file.close()
+
+
+def write_columnar(path, frames, **attrs):
+    '''Writes a dictionary of DataFrames to a columnar file in one go, see ColumnarWriter'''
+    writer = ColumnarWriter(path)
+    try:
+        writer.append(frames)
+    finally:
+        writer.close(**attrs)
+
+
+class ColumnarFile(object):
+    '''Reads the tables of a columnar file by entry or by row range without touching any other rows
+        #Arguments
+            path -- The path of the columnar file
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.file = h5py.File(path, 'r')
+        self.n_entries = int(self.file.attrs["entries"])
+
+    def keys(self):
+        return ["/" + key for key in self.file.keys()]
+
+    def columns(self, key):
+        return json.loads(self.file[key.strip("/")].attrs["columns"])
+
+    def attrs(self):
+        return dict(self.file.attrs)
+
+    def offsets(self, key, start=0, stop=None):
+        '''Returns the row offsets of the entries [start, stop] of a table'''
+        group = self.file[key.strip("/")]
+        stop = self.n_entries if stop == None else stop
+        if(group.attrs["per_entry"]):
+            return np.arange(start, stop+1, dtype='int64')
+        return group["offsets"][start:stop+1]
+
+    def read(self, key, start=0, stop=None, columns=None):
+        '''Returns a DataFrame of the rows of the entries [start, stop)'''
+        stop = self.n_entries if stop == None else min(stop, self.n_entries)
+        offsets = self.offsets(key, start, stop)
+        entries = np.repeat(np.arange(start, stop, dtype='int64'), np.diff(offsets))
+        return self._frame(key, int(offsets[0]), int(offsets[-1]), columns, entries)
+
+    def read_rows(self, key, start=0, stop=None, columns=None):
+        '''Returns a DataFrame of the rows [start, stop) of a table, like HDFStore.select(key, start=, stop=)'''
+        offsets = self.offsets(key)
+        stop = int(offsets[-1]) if stop == None else min(stop, int(offsets[-1]))
+        #The entry of each row is the last entry that starts at or before it
+        entries = np.searchsorted(offsets, np.arange(start, stop), side='right') - 1
+        return self._frame(key, start, stop, columns, entries.astype('int64'))
+
+    def read_array(self, key, start=0, stop=None, columns=None, dtype=None):
+        '''Returns the columns of the rows of the entries [start, stop) as one contiguous array of shape
+            (rows, columns), without building a DataFrame
+            #Arguments
+                columns -- The columns to read, in the order to return them. If None all columns are read.
+                dtype -- The dtype of the array, by default the common dtype of the columns
+        '''
+        group = self.file[key.strip("/")]
+        columns = self.columns(key) if columns == None else columns
+        stop = self.n_entries if stop == None else min(stop, self.n_entries)
+        offsets = self.offsets(key, start, stop)
+        row_start, row_stop = int(offsets[0]), int(offsets[-1])
+        datasets = [None if c == "Entry" else group[_dataset_name(c)] for c in columns]
+        if(dtype == None):
+            dtype = np.result_type(*[np.dtype('int64') if d == None else d.dtype for d in datasets])
+        out = np.empty((row_stop-row_start, len(columns)), dtype=dtype)
+        for i, dset in enumerate(datasets):
+            if(dset == None):
+                out[:, i] = np.repeat(np.arange(start, stop, dtype='int64'), np.diff(offsets))
+            elif(row_stop > row_start):
+                column = np.empty(row_stop-row_start, dtype=dset.dtype)
+                dset.read_direct(column, source_sel=np.s_[row_start:row_stop])
+                out[:, i] = column
+        return out
+
+    def _frame(self, key, start, stop, columns, entries):
+        '''Reads the columns of the rows [start, stop) straight into one 2D block per dtype, so that the DataFrame
+            is built on top of the blocks without consolidating them'''
+        group = self.file[key.strip("/")]
+        all_columns = self.columns(key)
+        columns = all_columns if columns == None else [c for c in all_columns if c in columns]
+        datasets = {c: group[_dataset_name(c)] for c in columns if c != "Entry"}
+        dtypes = [entries.dtype if c == "Entry" else datasets[c].dtype for c in columns]
+        frames = []
+        for dtype in _unique(dtypes):
+            names = [c for c, t in zip(columns, dtypes) if t == dtype]
+            block = np.empty((len(names), stop-start), dtype=dtype)
+            for i, name in enumerate(names):
+                if(name == "Entry"):
+                    block[i] = entries
+                elif(stop > start):
+                    datasets[name].read_direct(block[i], source_sel=np.s_[start:stop])
+            frames.append(pd.DataFrame(block.T, columns=names, index=pd.RangeIndex(start, stop), copy=False))
+        if(len(frames) == 0):
+            return pd.DataFrame(index=pd.RangeIndex(start, stop))
+        if(len(frames) == 1):
+            return frames[0][columns]
+        return pd.concat(frames, axis=1)[columns]
+
+    def close(self):
+        self.file.close()
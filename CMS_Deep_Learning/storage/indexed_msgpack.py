@@ -0,0 +1,268 @@
+'''
+indexed_msgpack.py
+A msgpack container for the tables written by delphes_parser that can be read by entry or row range.
+The file is a plain sequence of msgpack objects, so any msgpack reader can walk it:
+
+    [magic, version, index offset]      the header, the offset is a big-endian uint64 (bin 8)
+    [column bytes, ...]                 one block per table per range of entries, a bin per column
+    ...
+    {entries, attrs, tables}            the index, at the offset given in the header
+
+For every table the index holds its columns and dtypes, the row range and byte range of each of its
+blocks, and (for collections) the int64 row offsets of every entry. Reading a range of rows only seeks
+to and decodes the blocks that hold them, and NumValues can be read without touching the other tables.
+Old .msg files written by pd.to_msgpack can be upgraded in place with upgrade_msgpack_dir:
+
+    python indexed_msgpack.py <data_dir> [<data_dir> ...]
+'''
+import os
+import sys
+if __package__ is None:
+    sys.path.append(os.path.realpath(__file__+"/../../../"))
+import glob
+import struct
+import numpy as np
+import pandas as pd
+try:
+    import msgpack
+except ImportError:
+    #Only old .msg files (read by pandas) can be used
+    msgpack = None
+
+MSGPACK_FORMAT = b"delphes-msgpack-index"
+MSGPACK_VERSION = 1
+#Tables with exactly one row per entry
+PER_ENTRY_TABLES = ["NumValues", "EventChars"]
+BLOCK_ENTRIES = 1000
+
+
+def _header(index_offset):
+    '''The header is packed by hand so that it has a fixed size: a fixarray of 3, the magic as a fixstr,
+        the version as a positive fixint and the index offset as a bin 8 of length 8'''
+    return b"\x93" + struct.pack("B", 0xa0 | len(MSGPACK_FORMAT)) + MSGPACK_FORMAT + \
+           struct.pack("B", MSGPACK_VERSION) + b"\xc4\x08" + struct.pack(">Q", index_offset)
+
+HEADER_SIZE = len(_header(0))
+
+
+def _check_msgpack():
+    if(msgpack == None):
+        raise ImportError("The msgpack package is required to read and write indexed .msg files")
+
+
+def is_indexed_msgpack(path):
+    '''Returns True if path is a .msg file written by IndexedMsgpackWriter'''
+    if(not os.path.isfile(path)):
+        return False
+    with open(path, 'rb') as f:
+        head = f.read(HEADER_SIZE)
+    return len(head) == HEADER_SIZE and head[:-8] == _header(0)[:-8]
+
+
+def read_legacy_msgpack(path):
+    '''Reads all the tables of a .msg file written by pd.to_msgpack'''
+    #Need to check for latin encodings due to weird pandas default
+    try:
+        return pd.read_msgpack(path)
+    except UnicodeDecodeError as e:
+        return pd.read_msgpack(path, encoding='latin-1')
+
+
+class IndexedMsgpackWriter(object):
+    '''Writes (or appends) dictionaries of DataFrames, as returned by delphes_to_pandas, to an indexed .msg file.
+        The index is written by close, a file that was not closed cannot be read.
+        #Arguments
+            path -- The path of the file to write, it is overwritten
+            block_entries -- The largest number of entries in a block
+    '''
+    def __init__(self, path, block_entries=BLOCK_ENTRIES):
+        _check_msgpack()
+        self.path = path
+        self.block_entries = block_entries
+        self.file = open(path, 'wb')
+        self.file.write(_header(0))
+        self.tables = {}
+        self.entries = 0
+
+    def _table(self, key, frame, per_entry):
+        if(not key in self.tables):
+            dtypes = [np.asarray(frame[c].values).dtype for c in frame.columns]
+            if(True in [t.hasobject for t in dtypes]):
+                raise ValueError("Table %r has columns that are not numeric" % key)
+            self.tables[key] = {"columns": [str(c) for c in frame.columns], "dtypes": [t.str for t in dtypes],
+                                "per_entry": per_entry, "blocks": [], "offsets": [np.zeros(1, dtype='int64')]}
+        table = self.tables[key]
+        if(table["columns"] != [str(c) for c in frame.columns]):
+            raise ValueError("The columns of %r changed between appends" % key)
+        return table
+
+    def _write_block(self, table, frame, start, stop, row_start):
+        columns = [np.ascontiguousarray(frame[c].values[start:stop], dtype=t)
+                   for c, t in zip(table["columns"], table["dtypes"])]
+        data = msgpack.packb([c.tobytes() for c in columns], use_bin_type=True)
+        offset = self.file.tell()
+        self.file.write(data)
+        table["blocks"].append([row_start + start, row_start + stop, offset, len(data)])
+
+    def append(self, frames):
+        '''Appends the tables of the next entries. Every table of frames must be given every time.
+            #Arguments
+                frames -- A dictionary of DataFrames keyed by table, including "NumValues"
+        '''
+        num_values = frames["NumValues"]
+        n = len(num_values.index)
+        for key, frame in frames.items():
+            per_entry = key in PER_ENTRY_TABLES
+            table = self._table(key, frame, per_entry)
+            counts = np.ones(n, dtype='int64') if per_entry else np.asarray(num_values[key].values, dtype='int64')
+            offsets = np.concatenate([[0], np.cumsum(counts)])
+            row_start = int(table["offsets"][-1][-1])
+            #Blocks hold whole entries so that entry ranges never need part of a block
+            for start in range(0, n, self.block_entries):
+                stop = min(start + self.block_entries, n)
+                if(offsets[stop] > offsets[start]):
+                    self._write_block(table, frame, int(offsets[start]), int(offsets[stop]), row_start)
+            table["offsets"].append(row_start + offsets[1:])
+        self.entries += n
+
+    def close(self, **attrs):
+        '''Writes the index, recording any attrs (i.e. schema=fingerprint) with it, and closes the file'''
+        tables = {}
+        for key, table in self.tables.items():
+            tables[key] = dict(table, offsets=None if table["per_entry"] else np.concatenate(table["offsets"]).tobytes())
+        index = {"entries": self.entries, "attrs": attrs, "tables": tables}
+        offset = self.file.tell()
+        self.file.write(msgpack.packb(index, use_bin_type=True))
+        self.file.seek(0)
+        self.file.write(_header(offset))
+        self.file.close()
+
+
+def write_indexed_msgpack(path, frames, block_entries=BLOCK_ENTRIES, **attrs):
+    '''Writes a dictionary of DataFrames to an indexed .msg file under a temporary name and then renames it,
+        so that path is never left half written'''
+    tmp = path + ".tmp"
+    writer = IndexedMsgpackWriter(tmp, block_entries=block_entries)
+    try:
+        writer.append(frames)
+    finally:
+        writer.close(**attrs)
+    os.rename(tmp, path)
+
+
+class IndexedMsgpackFile(object):
+    '''Reads the tables of an indexed .msg file by entry or by row range, decoding only the blocks that are needed.
+        Has the same interface as storage.columnar.ColumnarFile.
+        #Arguments
+            path -- The path of the .msg file
+    '''
+    def __init__(self, path):
+        _check_msgpack()
+        self.path = path
+        self.file = open(path, 'rb')
+        head = self.file.read(HEADER_SIZE)
+        if(len(head) != HEADER_SIZE or head[:-8] != _header(0)[:-8]):
+            self.file.close()
+            raise IOError("%r is not an indexed .msg file" % path)
+        index_offset = struct.unpack(">Q", head[-8:])[0]
+        if(index_offset == 0):
+            self.file.close()
+            raise IOError("%r was not closed properly, it has no index" % path)
+        self.file.seek(index_offset)
+        index = msgpack.unpackb(self.file.read(), raw=False)
+        self.n_entries = index["entries"]
+        self._attrs = index["attrs"]
+        self.tables = index["tables"]
+
+    def keys(self):
+        return ["/" + key for key in self.tables.keys()]
+
+    def columns(self, key):
+        return list(self.tables[key.strip("/")]["columns"])
+
+    def attrs(self):
+        return dict(self._attrs)
+
+    def offsets(self, key, start=0, stop=None):
+        '''Returns the row offsets of the entries [start, stop] of a table'''
+        table = self.tables[key.strip("/")]
+        stop = self.n_entries if stop == None else stop
+        if(table["per_entry"]):
+            return np.arange(start, stop+1, dtype='int64')
+        return np.frombuffer(table["offsets"], dtype='int64')[start:stop+1]
+
+    def read(self, key, start=0, stop=None, columns=None):
+        '''Returns a DataFrame of the rows of the entries [start, stop)'''
+        stop = self.n_entries if stop == None else min(stop, self.n_entries)
+        offsets = self.offsets(key, start, stop)
+        return self.read_rows(key, int(offsets[0]), int(offsets[-1]), columns)
+
+    def read_rows(self, key, start=0, stop=None, columns=None):
+        '''Returns a DataFrame of the rows [start, stop) of a table, like HDFStore.select(key, start=, stop=)'''
+        table = self.tables[key.strip("/")]
+        blocks = table["blocks"]
+        n_rows = blocks[-1][1] if len(blocks) > 0 else 0
+        stop = n_rows if stop == None else min(stop, n_rows)
+        start = min(start, stop)
+        all_columns = table["columns"]
+        columns = all_columns if columns == None else [c for c in all_columns if c in columns]
+        locs = [all_columns.index(c) for c in columns]
+        dtypes = [np.dtype(table["dtypes"][i]) for i in locs]
+        out = [np.empty(stop-start, dtype=t) for t in dtypes]
+        for row_start, row_stop, offset, length in blocks:
+            if(row_stop <= start or row_start >= stop):
+                continue
+            self.file.seek(offset)
+            data = msgpack.unpackb(self.file.read(length), raw=False)
+            lo, hi = max(start, row_start), min(stop, row_stop)
+            for x, i, t in zip(out, locs, dtypes):
+                x[lo-start:hi-start] = np.frombuffer(data[i], dtype=t)[lo-row_start:hi-row_start]
+        return pd.DataFrame(dict(zip(columns, out)), columns=columns, index=pd.RangeIndex(start, stop))
+
+    def close(self):
+        self.file.close()
+
+
+def read_msgpack_tables(path, keys=None):
+    '''Returns the tables of a .msg file in either format as a dictionary of DataFrames'''
+    if(not is_indexed_msgpack(path)):
+        frames = read_legacy_msgpack(path)
+        return frames if keys == None else {key: frames[key] for key in keys}
+    f = IndexedMsgpackFile(path)
+    try:
+        return {key.strip("/"): f.read(key) for key in (f.keys() if keys == None else keys)}
+    finally:
+        f.close()
+
+
+def upgrade_msgpack(path, block_entries=BLOCK_ENTRIES):
+    '''Rewrites a .msg file written by pd.to_msgpack as an indexed .msg file in place
+        #Returns
+            True if the file was upgraded, False if it already was an indexed .msg file
+    '''
+    if(is_indexed_msgpack(path)):
+        return False
+    frames = read_legacy_msgpack(path)
+    write_indexed_msgpack(path, frames, block_entries=block_entries)
+    return True
+
+
+def upgrade_msgpack_dir(data_dir, block_entries=BLOCK_ENTRIES, verbose=1):
+    '''Upgrades every old .msg file in a directory, see upgrade_msgpack. The .meta files next to them are not
+        needed any more and are removed.
+        #Returns
+            The list of files that were upgraded
+    '''
+    upgraded = []
+    for f in sorted(glob.glob(os.path.join(data_dir, "*.msg"))):
+        if(upgrade_msgpack(f, block_entries=block_entries)):
+            upgraded.append(f)
+            meta = f.replace(".msg", ".meta")
+            if(os.path.exists(meta)): os.remove(meta)
+            if(verbose >= 1): print("Upgraded %r" % f)
+    return upgraded
+
+
+if __name__ == "__main__":
+    for d in sys.argv[1:]:
+        upgrade_msgpack_dir(d)
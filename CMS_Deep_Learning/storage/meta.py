@@ -1,8 +1,15 @@
 import pandas as pd
 import os,sys
+from CMS_Deep_Learning.storage.indexed_msgpack import is_indexed_msgpack, IndexedMsgpackFile
 
 def msgpack_assertMeta(filename, frames=None, redo=False):
     '''Asserts that the .meta file for a given .msg file exists and returns the data in the .meta file once it exists'''
+    if(is_indexed_msgpack(filename)):
+        #NumValues is read through the index, no .meta file is needed
+        f = IndexedMsgpackFile(filename)
+        meta_frames = {"NumValues" : f.read("NumValues")}
+        f.close()
+        return meta_frames
     meta_out_file = filename.replace(".msg", ".meta")
     print(meta_out_file)
     meta_frames = None
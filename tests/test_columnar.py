@@ -0,0 +1,103 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_almost_equal
+
+if __package__ is None:
+    sys.path.append(os.path.realpath("../"))
+    sys.path.append(os.path.realpath("../../"))
+from CMS_Deep_Learning.storage.columnar import ColumnarFile, ColumnarWriter, write_columnar, is_columnar
+from CMS_Deep_Learning.preprocessing.delphes_parser import delphes_to_pandas, iter_delphes_to_pandas, \
+    write_columnar_output, read_columnar_fingerprint, DEFAULT_SCHEMA
+from CMS_Deep_Learning.preprocessing.preprocessing import getFiles_StoreType, getNumValFrame, _getStore, _getFrame
+from CMS_Deep_Learning.preprocessing.pandas_to_numpy import get_from_pandas
+from CMS_Deep_Learning.preprocessing.synthetic_delphes import SyntheticTree
+from CMS_Deep_Learning.io import nb_samples_from_h5
+
+
+class TestColumnar(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.tree = SyntheticTree(80, seed=5)
+        self.frames = delphes_to_pandas(self.tree, verbosity=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_roundtrip(self):
+        path = os.path.join(self.tmp, "a.h5col")
+        #Written in chunks, read back in one go and by entry range
+        num = write_columnar_output(self.tree, path, chunk_size=30)
+        n_entries = len(self.frames["NumValues"].index)
+        self.assertEqual(num, n_entries)
+        self.assertTrue(is_columnar(path))
+        self.assertFalse(os.path.exists(path + ".tmp"))
+        self.assertEqual(read_columnar_fingerprint(path), DEFAULT_SCHEMA.fingerprint())
+        self.assertEqual(nb_samples_from_h5(path), n_entries)
+
+        f = ColumnarFile(path)
+        self.assertEqual(set(f.keys()), set(["/" + key for key in self.frames.keys()]))
+        for key, df in self.frames.items():
+            out = f.read(key)
+            self.assertEqual(list(out.columns), list(df.columns))
+            self.assertEqual([str(t) for t in out.dtypes], [str(t) for t in df.dtypes])
+            assert_almost_equal(out.values, df.values)
+
+        start, stop = 7, 19
+        tracks = f.read("EFlowTrack", start, stop, columns=["Entry", "PT_ET"])
+        expected = self.frames["EFlowTrack"]
+        expected = expected[(expected["Entry"] >= start) & (expected["Entry"] < stop)]
+        self.assertEqual(list(tracks.columns), ["Entry", "PT_ET"])
+        assert_almost_equal(tracks.values, expected[["Entry", "PT_ET"]].values)
+
+        #Row ranges rebuild the entry of each row
+        rows = f.read_rows("Electron", 3, 11)
+        assert_almost_equal(rows.values, self.frames["Electron"].values[3:11])
+        self.assertEqual(list(rows.index), list(range(3, 11)))
+        f.close()
+
+    def test_readers(self):
+        for name in ("a", "b"):
+            write_columnar(os.path.join(self.tmp, name + ".h5col"), self.frames, schema="x")
+        files, storeType = getFiles_StoreType(self.tmp + "/")
+        self.assertEqual(storeType, "columnar")
+        self.assertEqual(len(files), 2)
+        num_val_frame = getNumValFrame(files[0], storeType)
+        assert_almost_equal(num_val_frame.values, self.frames["NumValues"].values)
+
+        store, frames = _getStore(files[0], storeType)
+        select_start = int(num_val_frame["Photon"][:5].sum())
+        select_stop = select_start + int(num_val_frame["Photon"][5:9].sum())
+        frame = _getFrame(store, storeType, "Photon", select_start, select_stop, 4, len(num_val_frame.index), frames)
+        assert_almost_equal(frame.values, self.frames["Photon"].values[select_start:select_stop])
+        self.assertEqual(set(frame["Entry"]), set(range(5, 9)) & set(self.frames["Photon"]["Entry"]))
+        store.close()
+
+        #Mixing storage types in one directory is not allowed
+        self.frames["NumValues"].to_hdf(os.path.join(self.tmp, "c.h5"), key="NumValues")
+        self.assertRaises(IOError, getFiles_StoreType, self.tmp + "/")
+
+    def test_fixed_rows(self):
+        #Tables with a fixed number of rows per sample, as read by pandas_to_numpy
+        n, rpe = 6, 3
+        particles = pd.DataFrame({"Pt": np.arange(n*rpe, dtype='float64'), "Eta": np.ones(n*rpe)})
+        hlf = pd.DataFrame({"HT": np.arange(n, dtype='float64')})
+        num_values = pd.DataFrame({"Particles": np.full(n, rpe, dtype='int64'), "HLF": np.ones(n, dtype='int64')})
+        path = os.path.join(self.tmp, "fixed.h5col")
+        writer = ColumnarWriter(path, chunk_rows=4)
+        for i in range(0, n, 4):
+            writer.append({"Particles": particles[i*rpe:(i+4)*rpe], "HLF": hlf[i:i+4], "NumValues": num_values[i:i+4]})
+        writer.close()
+        values = get_from_pandas(path, 2, 3, observ_types={"Particles": ["Pt"], "HLF": ["HT"]},
+                                 rows_per_event={"Particles": rpe, "HLF": 1})
+        self.assertEqual(values["Particles"].shape, (3, rpe, 1))
+        assert_almost_equal(values["Particles"][:, :, 0], np.arange(2*rpe, 5*rpe).reshape(3, rpe))
+        assert_almost_equal(values["HLF"][:, 0], [2, 3, 4])
+
+
+if __name__ == '__main__':
+    unittest.main()
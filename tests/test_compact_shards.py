@@ -0,0 +1,98 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_almost_equal
+
+if __package__ is None:
+    sys.path.append(os.path.realpath("../"))
+    sys.path.append(os.path.realpath("../../"))
+from CMS_Deep_Learning.preprocessing.delphes_parser import delphes_to_pandas, merge_frames, write_fingerprint, \
+    read_fingerprint, DEFAULT_SCHEMA
+from CMS_Deep_Learning.preprocessing.compact_shards import compact, plan_shards, SIZES_META
+from CMS_Deep_Learning.preprocessing.preprocessing import getFiles_StoreType, getNumValFrame
+from CMS_Deep_Learning.preprocessing.synthetic_delphes import SyntheticTree
+from CMS_Deep_Learning.storage.columnar import write_columnar, ColumnarFile
+from CMS_Deep_Learning.io import nb_entries, sample_index
+
+
+class TestCompactShards(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.parts = [delphes_to_pandas(SyntheticTree(n, seed=i), verbosity=0) for i, n in enumerate([30, 50, 20, 60, 40])]
+        self.merged = merge_frames(self.parts)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _write(self, storeType):
+        in_dir = os.path.join(self.tmp, storeType)
+        os.makedirs(in_dir)
+        for i, frames in enumerate(self.parts):
+            if(storeType == "columnar"):
+                write_columnar(os.path.join(in_dir, "%02d.h5col" % i), frames, schema=DEFAULT_SCHEMA.fingerprint())
+            else:
+                store = pd.HDFStore(os.path.join(in_dir, "%02d.h5" % i))
+                for key, frame in frames.items():
+                    store.put(key, frame, format='table')
+                write_fingerprint(store, DEFAULT_SCHEMA.fingerprint())
+                store.close()
+        return in_dir
+
+    def _check(self, out_dir, shards):
+        files, storeType = getFiles_StoreType(out_dir + "/")
+        self.assertEqual(sorted(files), [s for s, n in shards])
+        sizes = json.load(open(os.path.join(out_dir, SIZES_META)))
+        self.assertEqual({f: v[0] for f, v in sizes.items()}, dict(shards))
+        self.assertEqual(sum([n for s, n in shards]), len(self.merged["NumValues"].index))
+
+        #Counted without the sizes that compact wrote
+        os.remove(os.path.join(out_dir, SIZES_META))
+        self.assertEqual(list(sample_index(out_dir).counts), [n for s, n in shards])
+
+        frames = []
+        for f, n in shards:
+            self.assertEqual(len(getNumValFrame(f, storeType).index), n)
+            self.assertEqual(nb_entries(f), n)
+            if(storeType == "columnar"):
+                store = ColumnarFile(f)
+                frames.append({key.strip("/"): store.read(key) for key in store.keys()})
+            else:
+                store = pd.HDFStore(f, mode='r')
+                self.assertEqual(read_fingerprint(store), DEFAULT_SCHEMA.fingerprint())
+                frames.append({key.strip("/"): store.get(key) for key in store.keys()})
+            store.close()
+            #Entries are renumbered from the start of each shard
+            self.assertEqual(list(frames[-1]["NumValues"].index), list(range(n)))
+        compacted = merge_frames(frames)
+        for key, frame in self.merged.items():
+            self.assertEqual(list(compacted[key].columns), list(frame.columns))
+            assert_almost_equal(compacted[key].values.astype('float64'), frame.values.astype('float64'))
+
+    def test_plan(self):
+        self.assertEqual(plan_shards([1, 1, 1, 1], 2), [(0, 2), (2, 4)])
+        self.assertEqual(plan_shards([5, 1, 1, 1, 1, 1], 2), [(0, 1), (1, 6)])
+        self.assertEqual(plan_shards([1, 1], 5), [(0, 1), (1, 2)])
+        self.assertEqual(plan_shards([3], 1), [(0, 1)])
+
+    def test_hdf5(self):
+        out_dir = os.path.join(self.tmp, "out")
+        shards = compact(self._write("hdf5"), out_dir, num_shards=2, verbose=0)
+        self.assertEqual(len(shards), 2)
+        self.assertFalse([f for f in os.listdir(out_dir) if f.endswith((".part", ".tmp"))])
+        self._check(out_dir, shards)
+
+    def test_columnar(self):
+        in_dir = self._write("columnar")
+        self.assertRaises(ValueError, compact, in_dir, in_dir, num_shards=2, verbose=0)
+        out_dir = os.path.join(self.tmp, "out")
+        shards = compact(in_dir, out_dir, num_shards=2, num_processes=2, verbose=0)
+        self._check(out_dir, shards)
+
+
+if __name__ == '__main__':
+    unittest.main()
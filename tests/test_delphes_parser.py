@@ -9,7 +9,31 @@ if __package__ is None:
     sys.path.append(os.path.realpath("../"))
     sys.path.append(os.path.realpath("../../"))
 import CMS_Deep_Learning
-from CMS_Deep_Learning.preprocessing.delphes_parser import delphes_to_pandas, ISO_TYPES, Iso
+from CMS_Deep_Learning.preprocessing import delphes_parser
+from CMS_Deep_Learning.preprocessing.delphes_parser import delphes_to_pandas, ISO_TYPES, Iso, TableBuffer, output_dtype, cut_mask, \
+    stream_to_hdf5, read_progress, run_jobs, merge_frames, ParserSchema, DEFAULT_SCHEMA, read_fingerprint, \
+    makeJobs, manifest_path, stale_jobs, input_record, output_path, write_json_atomic, read_manifest, SCHEMA_VERSION
+from CMS_Deep_Learning.preprocessing.synthetic_delphes import SyntheticTree
+from CMS_Deep_Learning.io import nb_entries
+
+def stub_store(f, store_dir, rerun=False, storeType="hdf5", chunk_size=None, fan_out=1, schema=None):
+    '''Stands in for store() in the workers of run_jobs, behaving according to the name of the file'''
+    import time
+    name = os.path.basename(f)
+    if(name == "slow.root"):
+        time.sleep(30)
+    elif(name == "crash.root"):
+        os._exit(3)
+    elif(name == "flaky.root" and not os.path.exists(f + ".tried")):
+        open(f + ".tried", "w").close()
+        os._exit(4)
+    return 5, output_path(f, store_dir, storeType)
+
+def synthetic_open_tree(source):
+    '''Stands in for open_tree() in the workers of run_jobs, every .root file that exists is a SyntheticTree'''
+    if(not os.path.exists(source)):
+        raise IOError("No such file %r" % source)
+    return None, SyntheticTree(40, seed=len(os.path.basename(source)))
 
 def checkOmission(t,particles, tracks):
     for entry, part_df in particles:
@@ -39,6 +63,34 @@ class TestDelphesParser(unittest.TestCase):
 
         assert_almost_equal(Iso(A_Eta, A_Phi, A_PT, B_Eta, B_Phi),np.array([0.01]))
 
+    def test_TableBuffer(self):
+        buf = TableBuffer(['Entry', 'E/c', 'PT_ET', 'Eta'], 4, output_dtype)
+        buf['Entry'][1] = 1
+        buf['E/c'][1] = 2.5
+        buf['PT_ET'][1] = 3.0
+        df = buf.to_frame(2)
+        self.assertEqual(list(df.columns), ['Entry', 'E/c', 'PT_ET', 'Eta'])
+        self.assertEqual([str(t) for t in df.dtypes], ['int64', 'float64', 'float32', 'float32'])
+        assert_almost_equal(df.values, np.array([[0, 0., 0., 0.], [1, 2.5, 3.0, 0.]]))
+        self.assertTrue(np.shares_memory(df['E/c'].values, buf['E/c']))
+
+        #Rows cleared from the keep mask are left out
+        buf.keep[0] = False
+        df = buf.to_frame(2)
+        self.assertEqual([str(t) for t in df.dtypes], ['int64', 'float64', 'float32', 'float32'])
+        assert_almost_equal(df.values, np.array([[1, 2.5, 3.0, 0.]]))
+        self.assertEqual(list(df.index), [0])
+
+    def test_cut_mask(self):
+        counts = {"Electron": np.array([1, 0, 0]), "MuonTight": np.array([0, 1, 0]), "Jet": np.array([2, 2, 3])}
+        columns = {"Electron": {"PT": np.array([25.0])}, "MuonTight": {"PT": np.array([15.0])},
+                   "Jet": {"PT": np.array([50.0, 41.0, 50.0, 60.0, 45.0, 45.0, 10.0])}}
+        self.assertEqual(cut_mask(counts, columns).tolist(), [True, False, False])
+        self.assertEqual(cut_mask(counts, columns, requireLepton=False).tolist(), [True, True, True])
+        self.assertEqual(cut_mask(counts, columns, lepton_PT_threshold=10.0).tolist(), [True, True, False])
+        self.assertEqual(cut_mask(counts, columns, requireLepton=False, num_jets=2, jet_PT_threshold=45.0).tolist(),
+                         [False, True, False])
+
     def test_sanity(self):
         p = os.path.dirname(os.path.abspath(CMS_Deep_Learning.__file__))
         loc = p + "/../data/qcd_lepFilter_13TeV_2.root"
@@ -71,6 +123,166 @@ class TestDelphesParser(unittest.TestCase):
 
         # print(df)
 
+    def test_columnar(self):
+        tree = SyntheticTree(80, seed=5)
+        entrywise = delphes_to_pandas(tree, fixedNum=60, columnar=False, verbosity=0)
+        columnar = delphes_to_pandas(tree, fixedNum=60, columnar=True, block_size=7, verbosity=0)
+        self.assertTrue(len(entrywise["NumValues"].index) > 7)
+        self.assertEqual(set(entrywise.keys()), set(columnar.keys()))
+        for key, df in entrywise.items():
+            assert_almost_equal(df.values.astype('float64'), columnar[key][df.columns].values.astype('float64'),
+                                decimal=4)
+
+    def test_stream(self):
+        import tempfile, shutil
+        tree = SyntheticTree(80, seed=6)
+        frames = delphes_to_pandas(tree, fixedNum=60, verbosity=0)
+        tmp = tempfile.mkdtemp()
+        try:
+            out_file = os.path.join(tmp, "stream.h5")
+            num = stream_to_hdf5(tree, out_file, 7, fixedNum=60, verbosity=0)
+            self.assertEqual(num, len(frames["NumValues"].index))
+            self.assertTrue(read_progress(out_file)["complete"])
+            store = pd.HDFStore(out_file)
+            for key, df in frames.items():
+                assert_almost_equal(df.values.astype('float64'), store.get(key)[df.columns].values.astype('float64'))
+            store.close()
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_fan_out(self):
+        tree = SyntheticTree(80, seed=7)
+        frames = delphes_to_pandas(tree, fixedNum=60, verbosity=0)
+        parallel = delphes_to_pandas(tree, fixedNum=60, fan_out=3, verbosity=0)
+        merged = merge_frames([delphes_to_pandas(tree, entry_range=r, verbosity=0) for r in [(0, 25), (25, 60)]])
+        for key, df in frames.items():
+            assert_almost_equal(df.values.astype('float64'), parallel[key][df.columns].values.astype('float64'))
+            assert_almost_equal(df.values.astype('float64'), merged[key][df.columns].values.astype('float64'))
+            if(key in ("NumValues", "EventChars")):
+                self.assertEqual(list(df.index), list(parallel[key].index))
+
+    def test_schema(self):
+        import tempfile, shutil
+        schema = ParserSchema(["Electron", "EFlowTrack"], {"Electron": ["PT_ET", "Eta", "ChHadIso", "NeuHadIso", "X"]})
+        #NeuHadIso needs EFlowNeutralHadron, which is not read
+        self.assertEqual(schema.columns["Electron"], ["Entry", "PT_ET", "Eta", "X", "ChHadIso"])
+        self.assertFalse("EFlowNeutralHadron" in schema.leaves)
+        self.assertEqual(schema.leaves["Jet"], ["PT", "Eta", "Phi", "Mass"])
+        self.assertNotEqual(schema.fingerprint(), DEFAULT_SCHEMA.fingerprint())
+        self.assertEqual(ParserSchema().fingerprint(), DEFAULT_SCHEMA.fingerprint())
+        self.assertRaises(ValueError, ParserSchema, ["Muon"])
+
+        tree = SyntheticTree(60, seed=4)
+        full = delphes_to_pandas(tree, verbosity=0)
+        frames = delphes_to_pandas(tree, verbosity=0, schema=schema)
+        self.assertEqual(set(frames.keys()), set(["Electron", "EFlowTrack", "NumValues", "EventChars"]))
+        self.assertEqual(list(frames["NumValues"].columns), ["Electron", "EFlowTrack"])
+        for key, df in frames.items():
+            assert_almost_equal(df.values.astype('float64'), full[key][df.columns].values.astype('float64'))
+
+        #Output written with another schema is stale and parsed again
+        tmp = tempfile.mkdtemp()
+        try:
+            out_file = os.path.join(tmp, "stream.h5")
+            stream_to_hdf5(tree, out_file, 25, verbosity=0)
+            stream_to_hdf5(tree, out_file, 25, verbosity=0, schema=schema)
+            store = pd.HDFStore(out_file)
+            self.assertEqual(set(store.keys()), set(["/Electron", "/EFlowTrack", "/NumValues", "/EventChars"]))
+            self.assertEqual(read_fingerprint(store), schema.fingerprint())
+            assert_almost_equal(store.get("Electron").values, frames["Electron"].values)
+            store.close()
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_run_jobs(self):
+        import tempfile, shutil, json, multiprocessing
+        if(multiprocessing.get_start_method() != "fork"):
+            self.skipTest("The synthetic trees only reach the workers when they are forked")
+        tmp = tempfile.mkdtemp()
+        open_tree = delphes_parser.open_tree
+        delphes_parser.open_tree = synthetic_open_tree
+        try:
+            loc = os.path.join(tmp, "synthetic.root")
+            open(loc, "w").close()
+            missing = os.path.join(tmp, "missing.root")
+            jobs = [(loc, tmp + "/", "hdf5", None, 1, None), (missing, tmp + "/", "hdf5", None, 1, None)]
+            manifest = os.path.join(tmp, "manifest.json")
+            status = run_jobs(jobs, num_processes=2, retries=1, manifest=manifest, verbose=0)
+            self.assertEqual(status[loc]["status"], "ok")
+            self.assertTrue(status[loc]["entries"] > 0)
+            self.assertEqual(nb_entries(status[loc]["out_file"]), status[loc]["entries"])
+            self.assertEqual(status[missing]["status"], "failed")
+            self.assertEqual(status[missing]["attempts"], 2)
+            self.assertEqual(json.load(open(manifest)), status)
+        finally:
+            delphes_parser.open_tree = open_tree
+            shutil.rmtree(tmp)
+
+    def test_run_jobs_stub(self):
+        import tempfile, shutil, multiprocessing
+        if(multiprocessing.get_start_method() != "fork"):
+            self.skipTest("The stub only reaches the workers when they are forked")
+        tmp = tempfile.mkdtemp()
+        store = delphes_parser.store
+        delphes_parser.store = stub_store
+        try:
+            files = [os.path.join(tmp, name + ".root") for name in ("slow", "crash", "flaky", "good")]
+            slow, crash, flaky, good = files
+            jobs = [(f, tmp + "/", "hdf5", None, 1, None) for f in files]
+            #Output from an earlier run is kept when a job fails
+            with open(output_path(slow, tmp + "/"), "w") as f:
+                f.write("earlier")
+            status = run_jobs(jobs, num_processes=4, timeout=1.0, retries=1, verbose=0)
+            self.assertEqual(status[slow]["status"], "timeout")
+            self.assertEqual(status[slow]["attempts"], 2)
+            self.assertEqual(open(output_path(slow, tmp + "/")).read(), "earlier")
+            self.assertEqual(status[crash]["status"], "failed")
+            self.assertEqual(status[crash]["attempts"], 2)
+            self.assertTrue("3" in status[crash]["error"])
+            self.assertEqual((status[flaky]["status"], status[flaky]["attempts"], status[flaky]["entries"]), ("ok", 2, 5))
+            self.assertEqual((status[good]["status"], status[good]["attempts"]), ("ok", 1))
+        finally:
+            delphes_parser.store = store
+            shutil.rmtree(tmp)
+
+    def test_stale_jobs(self):
+        import tempfile, shutil
+        tmp = tempfile.mkdtemp()
+        try:
+            for name in ("a", "b", "c"):
+                with open(os.path.join(tmp, name + ".root"), "wb") as f:
+                    f.write(name.encode() * 1000)
+            jobs = sorted(makeJobs(tmp, "hdf5", pandas_folder="/pandas_h5/"))
+            a, b, c = [job[0] for job in jobs]
+            manifest = manifest_path(jobs[0][1])
+            entries = {}
+            for job in jobs[:2]:
+                out_file = output_path(job[0], job[1], "hdf5")
+                open(out_file, "w").close()
+                entries[job[0]] = dict(input_record(job[0]), status="ok", entries=10, out_file=out_file, storeType="hdf5",
+                                       schema=DEFAULT_SCHEMA.fingerprint(), schema_version=SCHEMA_VERSION)
+            write_json_atomic(entries, manifest)
+            stale, fresh = stale_jobs(jobs, manifest)
+            self.assertEqual([job[0] for job in stale], [c])
+            self.assertEqual(sorted(fresh.keys()), [a, b])
+
+            #Touched files stay fresh, rewritten ones do not
+            os.utime(a, (0, 1000))
+            with open(b, "wb") as f:
+                f.write(b"x" * 2000)
+            os.utime(b, (0, 1000))
+            stale, fresh = stale_jobs(jobs, manifest)
+            self.assertEqual(sorted([job[0] for job in stale]), [b, c])
+            self.assertEqual(read_manifest(manifest)[a]["mtime"], 1000)
+
+            #So are outputs written with another schema, or removed
+            self.assertEqual(len(stale_jobs(makeJobs(tmp, "hdf5", pandas_folder="/pandas_h5/",
+                                                     schema=ParserSchema(["Electron"])), manifest)[0]), 3)
+            os.remove(entries[a]["out_file"])
+            self.assertEqual(len(stale_jobs(jobs, manifest)[0]), 3)
+        finally:
+            shutil.rmtree(tmp)
+
 if __name__ == '__main__':
     unittest.main()
 
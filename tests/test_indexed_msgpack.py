@@ -0,0 +1,100 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_almost_equal
+
+if __package__ is None:
+    sys.path.append(os.path.realpath("../"))
+    sys.path.append(os.path.realpath("../../"))
+from CMS_Deep_Learning.storage.indexed_msgpack import IndexedMsgpackFile, IndexedMsgpackWriter, \
+    write_indexed_msgpack, is_indexed_msgpack, upgrade_msgpack_dir, msgpack
+from CMS_Deep_Learning.storage.meta import msgpack_assertMeta
+from CMS_Deep_Learning.preprocessing.delphes_parser import delphes_to_pandas
+from CMS_Deep_Learning.preprocessing.preprocessing import getFiles_StoreType, getNumValFrame, _getStore, _getFrame
+from CMS_Deep_Learning.preprocessing.synthetic_delphes import SyntheticTree
+
+
+@unittest.skipIf(msgpack == None, "msgpack is not installed")
+class TestIndexedMsgpack(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.frames = delphes_to_pandas(SyntheticTree(80, seed=8), verbosity=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_roundtrip(self):
+        path = os.path.join(self.tmp, "a.msg")
+        write_indexed_msgpack(path, self.frames, block_entries=7, schema="x")
+        self.assertTrue(is_indexed_msgpack(path))
+        self.assertFalse(os.path.exists(path + ".tmp"))
+        self.assertEqual(upgrade_msgpack_dir(self.tmp, verbose=0), [])
+
+        #The file is a plain stream of msgpack objects
+        with open(path, 'rb') as fp:
+            objects = list(msgpack.Unpacker(fp, raw=False))
+        self.assertEqual(objects[0][:2], ["delphes-msgpack-index", 1])
+        self.assertEqual(objects[-1]["attrs"], {"schema": "x"})
+
+        f = IndexedMsgpackFile(path)
+        self.assertEqual(f.n_entries, len(self.frames["NumValues"].index))
+        self.assertEqual(set(f.keys()), set(["/" + key for key in self.frames.keys()]))
+        for key, df in self.frames.items():
+            out = f.read(key)
+            self.assertEqual(list(out.columns), list(df.columns))
+            self.assertEqual([str(t) for t in out.dtypes], [str(t) for t in df.dtypes])
+            assert_almost_equal(out.values, df.values)
+
+        start, stop = 9, 23
+        tracks = f.read("EFlowTrack", start, stop, columns=["Entry", "PT_ET"])
+        expected = self.frames["EFlowTrack"]
+        expected = expected[(expected["Entry"] >= start) & (expected["Entry"] < stop)]
+        assert_almost_equal(tracks.values, expected[["Entry", "PT_ET"]].values)
+        rows = f.read_rows("Electron", 3, 11)
+        assert_almost_equal(rows.values, self.frames["Electron"].values[3:11])
+        self.assertEqual(list(rows.index), list(range(3, 11)))
+        f.close()
+
+    def test_append(self):
+        path = os.path.join(self.tmp, "b.msg")
+        writer = IndexedMsgpackWriter(path, block_entries=4)
+        self.assertRaises(IOError, IndexedMsgpackFile, path)
+        num_values = self.frames["NumValues"]
+        n = len(num_values.index)
+        for start in range(0, n, 20):
+            stop = min(start + 20, n)
+            chunk = {key: df[(df["Entry"] >= start) & (df["Entry"] < stop)] if "Entry" in df.columns else df[start:stop]
+                     for key, df in self.frames.items()}
+            chunk["NumValues"] = num_values[start:stop]
+            writer.append(chunk)
+        writer.close()
+        f = IndexedMsgpackFile(path)
+        for key, df in self.frames.items():
+            assert_almost_equal(f.read(key).values, df.values)
+        f.close()
+
+    def test_readers(self):
+        for name in ("a", "b"):
+            write_indexed_msgpack(os.path.join(self.tmp, name + ".msg"), self.frames, block_entries=10)
+        files, storeType = getFiles_StoreType(self.tmp + "/")
+        self.assertEqual(storeType, "msgpack")
+        num_val_frame = getNumValFrame(files[0], storeType)
+        assert_almost_equal(num_val_frame.values, self.frames["NumValues"].values)
+        assert_almost_equal(msgpack_assertMeta(files[0])["NumValues"].values, num_val_frame.values)
+        self.assertFalse(os.path.exists(files[0].replace(".msg", ".meta")))
+
+        store, frames = _getStore(files[0], storeType)
+        self.assertEqual(frames, None)
+        select_start = int(num_val_frame["Photon"][:15].sum())
+        select_stop = select_start + int(num_val_frame["Photon"][15:32].sum())
+        frame = _getFrame(store, storeType, "Photon", select_start, select_stop, 17, len(num_val_frame.index), frames)
+        assert_almost_equal(frame.values, self.frames["Photon"].values[select_start:select_stop])
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import numpy as np
+import pandas as pd
+
+if __package__ is None:
+    sys.path.append(os.path.realpath("../"))
+    sys.path.append(os.path.realpath("../../"))
+from CMS_Deep_Learning.io import SampleIndex, sample_index, nb_samples_from_h5, gen_from_tail, DATASET_FORMAT
+from CMS_Deep_Learning.preprocessing.preprocessing import maxMutualLength, ObjectProfile
+from CMS_Deep_Learning.preprocessing.pandas_to_numpy import check_enough_data, _write_shard, _write_manifest
+from CMS_Deep_Learning.preprocessing.delphes_parser import delphes_to_pandas, write_hdf5_output, DEFAULT_SCHEMA
+from CMS_Deep_Learning.preprocessing.synthetic_delphes import SyntheticTree
+
+
+def write_entries(path, n):
+    '''Writes a pandas file like those of delphes_parser (tables written by write_hdf5_output), with n entries
+        and 3 particles per entry'''
+    frames = {"Electron": pd.DataFrame({"Entry": np.repeat(np.arange(n), 3), "PT_ET": np.ones(3 * n)}),
+              "NumValues": pd.DataFrame({"Electron": np.full(n, 3)})}
+    write_hdf5_output(path, frames, DEFAULT_SCHEMA.fingerprint())
+
+
+class TestSampleIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_slices(self):
+        index = SampleIndex(["a", "b", "c", "d"], [5, 0, 3, 4], "dir")
+        self.assertEqual(index.total, 12)
+        self.assertEqual(index.slices(0, 12), [("a", 0, 5), ("c", 0, 3), ("d", 0, 4)])
+        self.assertEqual(index.slices(2, 2), [("a", 2, 2)])
+        self.assertEqual(index.slices(4, 3), [("a", 4, 1), ("c", 0, 2)])
+        self.assertEqual(index.slices(5, 4), [("c", 0, 3), ("d", 0, 1)])
+        self.assertEqual(index.slices(11, 1), [("d", 3, 1)])
+        self.assertEqual(index.slices(12, 0), [])
+        self.assertRaises(IOError, index.slices, 9, 4)
+
+    def test_directory(self):
+        a, b = os.path.join(self.tmp, "a"), os.path.join(self.tmp, "b")
+        os.makedirs(a)
+        os.makedirs(b)
+        for i, n in enumerate([4, 7, 2]):
+            write_entries(os.path.join(a, "%03d.h5" % i), n)
+        write_entries(os.path.join(b, "000.h5"), 9)
+        #Entries are counted from NumValues, not the rows of the first table
+        self.assertEqual(nb_samples_from_h5(os.path.join(a, "000.h5")), 4)
+
+        index = sample_index(a)
+        self.assertEqual(index.total, 13)
+        self.assertEqual(index.slices(3, 5), [(os.path.join(a, "000.h5"), 3, 1), (os.path.join(a, "001.h5"), 0, 4)])
+        sizes = json.load(open(os.path.join(a, "sizesMetaData.json")))
+        self.assertEqual(sorted([v[0] for v in sizes.values()]), [2, 4, 7])
+        self.assertEqual(maxMutualLength([("a", a + "/"), ("b", b + "/")], None), 9)
+        #Files without the tables of every object profile are skipped
+        store = pd.HDFStore(os.path.join(a, "001.h5"))
+        store.remove("Electron")
+        store.close()
+        self.assertEqual(maxMutualLength([("a", a + "/"), ("b", b + "/")], [ObjectProfile("Electron", 3)]), 6)
+        check_enough_data([a, b], 9)
+        self.assertRaises(IOError, check_enough_data, [a, b], 10)
+
+        #Output of the parser is counted by its entries, not the rows of its particle tables
+        c = os.path.join(self.tmp, "c")
+        os.makedirs(c)
+        totals = []
+        for i, seed in enumerate([1, 2]):
+            frames = delphes_to_pandas(SyntheticTree(60, seed=seed), verbosity=0)
+            write_hdf5_output(os.path.join(c, "%03d.h5" % i), frames, DEFAULT_SCHEMA.fingerprint())
+            totals.append(len(frames["NumValues"].index))
+        self.assertTrue(min(totals) > 0)
+        self.assertEqual(list(sample_index(c).counts), totals)
+        self.assertEqual(maxMutualLength([("c", c + "/")], None), sum(totals))
+        #Tables without NumValues are counted by their rows
+        pd.DataFrame({"HT": np.ones(7)}).to_hdf(os.path.join(c, "hlf.h5"), key="HLF", format='table')
+        self.assertEqual(nb_samples_from_h5(os.path.join(c, "hlf.h5")), 7)
+
+        #Changed files are counted again
+        time.sleep(.01)
+        write_entries(os.path.join(a, "001.h5"), 1)
+        write_entries(os.path.join(a, "003.h5"), 5)
+        index = sample_index(a)
+        self.assertEqual(list(index.counts), [4, 1, 2, 5])
+        self.assertEqual(index.slices(6, 2), [(os.path.join(a, "002.h5"), 1, 1), (os.path.join(a, "003.h5"), 0, 1)])
+
+
+class TestTail(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.manifest = {"format": DATASET_FORMAT, "params": {}, "shards": {}, "num_shards": 3, "complete": False}
+        self.storage = {"batch_size": None, "compression": None, "compression_level": 4}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def publish(self, i, n):
+        name = "%03d.h5" % i
+        arrays = {"Particles": np.full((n, 2, 1), i, dtype='float32'), "Labels": np.eye(2, dtype='int8')[np.zeros(n, int)]}
+        self.manifest["shards"][name] = _write_shard(os.path.join(self.tmp, name), arrays, self.storage)
+        self.manifest["complete"] = len(self.manifest["shards"]) == self.manifest["num_shards"]
+        _write_manifest(self.tmp, self.manifest)
+
+    def test_tail(self):
+        self.publish(1, 4)
+        gen = gen_from_tail(self.tmp, 3, samples_per_epoch=6, poll_interval=.01, timeout=.1, verbose=0)
+        #The first epoch needs 6 samples but only 4 are published
+        self.assertRaises(IOError, next, gen)
+
+        gen = gen_from_tail(self.tmp, 3, samples_per_epoch=6, poll_interval=.01, verbose=0)
+        timer = threading.Timer(.1, self.publish, (0, 5))
+        timer.start()
+        batches = [next(gen) for _ in range(4)]
+        timer.join()
+        #Shards are read in the order they were published
+        self.assertEqual([len(x[0]) for x in batches], [3, 1, 3, 2])
+        self.assertEqual([x[0][0, 0, 0] for x in batches], [1, 1, 0, 0])
+
+        #Once the dataset is complete the generator starts over
+        self.publish(2, 2)
+        batches = [next(gen) for _ in range(3)]
+        self.assertEqual([(len(x[0]), x[0][0, 0, 0]) for x in batches], [(2, 2), (3, 1), (1, 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
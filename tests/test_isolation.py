@@ -0,0 +1,50 @@
+import os
+import sys
+import math
+import unittest
+import numpy as np
+from numpy.testing import assert_almost_equal
+
+if __package__ is None:
+    sys.path.append(os.path.realpath("../"))
+    sys.path.append(os.path.realpath("../../"))
+from CMS_Deep_Learning.preprocessing.isolation import EtaPhiGrid, delta_rsq, nearest, isolation
+
+
+def random_particles(rng, n_events, mult):
+    counts = rng.poisson(mult, n_events)
+    n = counts.sum()
+    event = np.repeat(np.arange(n_events), counts)
+    return rng.normal(0, 1.0, n), rng.uniform(-math.pi, math.pi, n), rng.exponential(10, n) + .5, event
+
+
+class TestIsolation(unittest.TestCase):
+    def test_against_dense(self):
+        rng = np.random.RandomState(0)
+        A_Eta, A_Phi, A_Pt, A_event = random_particles(rng, 30, 5)
+        B_Eta, B_Phi, B_Pt, B_event = random_particles(rng, 30, 60)
+        #Put some particles right on the phi boundary
+        B_Phi[:10] = math.pi - 1e-3
+        A_Phi[:3] = -math.pi + 1e-3
+        ia, ib, DRsq = EtaPhiGrid(B_Eta, B_Phi, B_event).pairs(A_Eta, A_Phi, A_event)
+
+        dense = delta_rsq(A_Eta[:, None], A_Phi[:, None], B_Eta[None, :], B_Phi[None, :])
+        dense[A_event[:, None] != B_event[None, :]] = np.inf
+        close = dense < 0.09
+        self.assertEqual(set(zip(ia.tolist(), ib.tolist())), set(zip(*np.nonzero(close))))
+        assert_almost_equal(isolation(ia, DRsq, A_Pt), np.sum(np.where(close, dense, 0.0), axis=1) / A_Pt)
+
+        matches = nearest(ia, ib, DRsq, len(A_Eta))
+        found = close.any(axis=1)
+        self.assertTrue(((matches >= 0) == found).all())
+        assert_almost_equal(matches[found], np.argmin(dense, axis=1)[found])
+
+    def test_empty(self):
+        grid = EtaPhiGrid(np.zeros(0), np.zeros(0), np.zeros(0, dtype='int64'))
+        ia, ib, DRsq = grid.pairs(np.array([0.1]), np.array([0.1]), np.array([0]))
+        self.assertEqual(len(ia), 0)
+        assert_almost_equal(isolation(ia, DRsq, np.array([2.0])), [0.0])
+        self.assertEqual(nearest(ia, ib, DRsq, 1).tolist(), [-1])
+
+if __name__ == '__main__':
+    unittest.main()
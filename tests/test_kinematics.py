@@ -0,0 +1,48 @@
+import os
+import sys
+import math
+import unittest
+import numpy as np
+from numpy.testing import assert_almost_equal
+
+if __package__ is None:
+    sys.path.append(os.path.realpath("../"))
+    sys.path.append(os.path.realpath("../../"))
+from CMS_Deep_Learning.preprocessing.kinematics import four_momentum, relative_observables, per_entry, \
+    leading, leading_index, segment_sum, benchmark
+
+
+class TestKinematics(unittest.TestCase):
+    def test_four_momentum(self):
+        PT, Eta, Phi, M = np.array([10.0, 3.0]), np.array([0.5, -2.0]), np.array([1.0, -3.0]), np.array([0.1, 4.0])
+        E, Px, Py, Pz = four_momentum(PT, Eta, Phi, M)
+        for i in range(2):
+            px, py, pz = PT[i]*math.cos(Phi[i]), PT[i]*math.sin(Phi[i]), PT[i]*math.sinh(Eta[i])
+            assert_almost_equal([E[i], Px[i], Py[i], Pz[i]], [math.sqrt(px*px+py*py+pz*pz+M[i]*M[i]), px, py, pz])
+
+    def test_relative_observables(self):
+        DeltaEta, DeltaPhi, DeltaR, Kt, AntiKt = relative_observables(np.array([2.0]), np.array([0.0]), np.array([3.0]),
+                                                                      np.array([4.0]), np.array([1.0]), np.array([-3.0]))
+        assert_almost_equal(DeltaEta, [1.0])
+        assert_almost_equal(DeltaPhi, [-6.0 + 2*math.pi])
+        assert_almost_equal(DeltaR, np.sqrt(1.0 + (2*math.pi - 6.0)**2))
+        assert_almost_equal(Kt, 4.0 * DeltaR**2)
+        assert_almost_equal(AntiKt, DeltaR**2 / 16.0)
+
+    def test_leading(self):
+        counts = np.array([3, 0, 2, 1])
+        PT = np.array([1.0, 5.0, 5.0, 2.0, 7.0, 0.0])
+        Eta = np.arange(6, dtype='float64')
+        self.assertEqual(leading_index(PT, counts).tolist(), [1, -1, 4, 5])
+        lPT, lEta, lPhi = leading(PT, Eta, Eta, counts)
+        assert_almost_equal(lPT, [5.0, 0.0, 7.0, 0.0])
+        assert_almost_equal(lEta, [1.0, 0.0, 4.0, 0.0])
+        assert_almost_equal(per_entry(lPT, counts), [5.0, 5.0, 5.0, 7.0, 7.0, 0.0])
+        assert_almost_equal(segment_sum(PT, counts), [11.0, 0.0, 9.0, 0.0])
+
+    def test_benchmark(self):
+        out = benchmark(n_entries=20, mean_multiplicity=10, verbose=0)
+        self.assertEqual(len(out), 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,253 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import h5py
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_almost_equal
+
+if __package__ is None:
+    sys.path.append(os.path.realpath("../"))
+    sys.path.append(os.path.realpath("../../"))
+from CMS_Deep_Learning.preprocessing.pandas_to_numpy import sort_numpy, maxLepPtEtaPhi, SORT_METRICS, PARTICLE_OBSERVS, \
+    HLF_OBSERVS, DEFAULT_RPE, pandas_to_numpy, get_from_pandas, make_datasets, strideFromTargetSize, stream_shards, \
+    parse_megabytes
+from CMS_Deep_Learning.io import read_dataset_manifest, size_from_meta, DataIterator
+
+locs = {t: i for i, t in enumerate(PARTICLE_OBSERVS)}
+
+
+def particles(n_events, n_particles, seed=0):
+    '''Random events with a muon among the first few particles and zero padding at the back'''
+    rand = np.random.RandomState(seed)
+    X = rand.normal(size=(n_events, n_particles, len(PARTICLE_OBSERVS)))
+    X[..., locs["Energy"]] = np.abs(X[..., locs["Energy"]]) + .1
+    X[..., locs["Pt"]] = np.abs(X[..., locs["Pt"]]) + .1
+    X[..., locs["isEle"]] = rand.rand(n_events, n_particles) < .1
+    X[..., locs["isMu"]] = 0
+    X[np.arange(n_events), rand.randint(0, 4, n_events), locs["isMu"]] = 1
+    for x, n in zip(X, rand.randint(5, n_particles - 5, n_events)):
+        x[n:] = 0
+    return X
+
+
+class TestSortNumpy(unittest.TestCase):
+    def test_leading_lepton(self):
+        X = particles(50, 20)
+        pt, eta, phi = maxLepPtEtaPhi(X, locs)
+        self.assertEqual(pt.shape, (50, 1))
+        for x, p in zip(X, pt[:, 0]):
+            first = [r for r in x if r[locs["isEle"]] or r[locs["isMu"]]][0]
+            self.assertEqual(p, first[locs["Pt"]])
+        self.assertEqual(maxLepPtEtaPhi(X[7], locs)[0][0], pt[7, 0])
+        X[3, :, locs["isMu"]] = X[3, :, locs["isEle"]] = 0
+        self.assertRaises(ValueError, maxLepPtEtaPhi, X, locs)
+
+    def test_anti_kt_padding(self):
+        import warnings
+        X = particles(20, 15)
+        pt = maxLepPtEtaPhi(X, locs)[0]
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            anti_kt = SORT_METRICS["MaxLepAntiKt"](X, locs)
+        #The zero padding takes the term of the leading lepton, as if its Pt ** -2 were inf
+        padding = X[..., locs["Pt"]] == 0
+        self.assertTrue(padding.any())
+        delta_r = SORT_METRICS["MaxLepDeltaR"](X, locs)
+        assert_almost_equal(anti_kt[padding], np.broadcast_to(pt ** -2, anti_kt.shape)[padding] * delta_r[padding] ** 2)
+        assert_almost_equal(anti_kt[~padding], np.minimum(X[..., locs["Pt"]][~padding] ** -2,
+                                                          np.broadcast_to(pt ** -2, anti_kt.shape)[~padding]) *
+                            delta_r[~padding] ** 2)
+
+    def test_block_matches_events(self):
+        X = particles(100, 30)
+        for sort_columns in [["Pt"], ["Eta", "Pt"], ["MaxLepKt", "Eta"]] + [[m] for m in SORT_METRICS]:
+            for ascending in (True, False):
+                block = sort_numpy(X.copy(), sort_columns, ascending, PARTICLE_OBSERVS)
+                events = np.array([sort_numpy(x.copy(), sort_columns, ascending, PARTICLE_OBSERVS) for x in X])
+                assert_almost_equal(block, events)
+                if (sort_columns[0] in SORT_METRICS):
+                    #Padding stays at the back
+                    n = np.any(X != 0, axis=-1).sum(axis=1)
+                    self.assertTrue(np.all(np.any(block != 0, axis=-1) == (np.arange(30) < n[:, None])))
+
+        column = sort_numpy(X.copy(), ["Pt"], False, PARTICLE_OBSERVS)[..., locs["Pt"]]
+        self.assertTrue(np.all(np.diff(column, axis=1) <= 0))
+
+        shuffled = sort_numpy(X.copy(), ["shuffle"], True, PARTICLE_OBSERVS)
+        assert_almost_equal(np.sort(shuffled, axis=1), np.sort(X, axis=1))
+
+
+def write_pandas_dir(data_dir, label, sizes):
+    '''Writes pandas files of Particles and HLF tables like those pandas_to_numpy reads. The HT of every event
+        is label*1000 + its number, and so is the Energy of each of its particles.'''
+    os.makedirs(data_dir)
+    rpe = DEFAULT_RPE["Particles"]
+    first = 0
+    for i, n in enumerate(sizes):
+        ids = label * 1000.0 + np.arange(first, first + n)
+        hlf = pd.DataFrame(np.random.random((n, len(HLF_OBSERVS))), columns=HLF_OBSERVS)
+        hlf["HT"] = ids
+        particles = pd.DataFrame(np.random.random((n * rpe, len(PARTICLE_OBSERVS))), columns=PARTICLE_OBSERVS)
+        particles["Energy"] = np.repeat(ids, rpe)
+        store = pd.HDFStore(os.path.join(data_dir, "%03d.h5" % i), mode='w')
+        store.put("HLF", hlf)
+        store.put("Particles", particles)
+        store.close()
+        first += n
+
+
+class TestPandasToNumpy(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.dirs = [os.path.join(self.tmp, name) for name in ("a", "b")]
+        write_pandas_dir(self.dirs[0], 1, [4, 5, 3])
+        write_pandas_dir(self.dirs[1], 2, [7, 6])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_arrays(self):
+        X, Y, HLF = pandas_to_numpy(self.dirs, 2, 8, verbose=0)
+        self.assertEqual((X.dtype, Y.dtype, HLF.dtype), (np.float32, np.int8, np.float32))
+        self.assertEqual(X.shape, (16, DEFAULT_RPE["Particles"], len(PARTICLE_OBSERVS)))
+        self.assertEqual(Y.shape, (16, 2))
+        ids = HLF[:, HLF_OBSERVS.index("HT")]
+        #Every event is read once, and its particles and label are written to the same row
+        self.assertEqual(sorted(ids), [1002.0 + i for i in range(8)] + [2002.0 + i for i in range(8)])
+        assert_almost_equal(X[:, :, PARTICLE_OBSERVS.index("Energy")], np.repeat(ids[:, None], X.shape[1], axis=1))
+        assert_almost_equal(Y[:, 1], ids > 2000)
+        self.assertTrue(np.all(Y.sum(axis=1) == 1))
+
+        X, Y, HLF = pandas_to_numpy(self.dirs, 0, 3, verbose=0, dtype='float64')
+        self.assertEqual(X.dtype, np.float64)
+        self.assertRaises(IOError, pandas_to_numpy, self.dirs, 5, 8, verbose=0)
+
+    def test_get_from_pandas(self):
+        rpe = {"Particles": 3, "HLF": 1}
+        particles = pd.DataFrame({"Pt": np.arange(30.0), "Eta": -np.arange(30.0), "isMu": np.arange(30) % 2})
+        hlf = pd.DataFrame({"HT": np.arange(10.0), "MET": np.ones(10)})
+        observ_types = {"Particles": ["isMu", "Pt"], "HLF": ["MET", "HT"]}
+        for fmt in ("fixed", "table"):
+            f = os.path.join(self.tmp, fmt + ".h5")
+            store = pd.HDFStore(f, mode='w')
+            store.put("Particles", particles, format=fmt)
+            store.put("HLF", hlf, format=fmt)
+            store.close()
+            values = get_from_pandas(f, 2, 5, 10, observ_types=observ_types, rows_per_event=rpe)
+            self.assertEqual(values["Particles"].shape, (5, 3, 2))
+            self.assertTrue(values["Particles"].flags.c_contiguous)
+            assert_almost_equal(values["Particles"].reshape(15, 2), particles[["isMu", "Pt"]].values[6:21])
+            assert_almost_equal(values["HLF"], hlf[["MET", "HT"]].values[2:7])
+
+            values = get_from_pandas(f, 0, 10, 10, observ_types=None, rows_per_event=rpe, dtype='float32')
+            self.assertEqual(values["Particles"].dtype, np.float32)
+            assert_almost_equal(values["Particles"].reshape(30, 3), particles.values)
+        self.assertRaises(KeyError, get_from_pandas, os.path.join(self.tmp, "fixed.h5"), 0, 1,
+                          observ_types={"Particles": ["Phi"], "HLF": ["HT"]}, rows_per_event=rpe)
+
+    def test_make_datasets(self):
+        out = os.path.join(self.tmp, "out")
+        make_datasets(self.dirs, out, 10, size=3, v_split=2, num_processes=2)
+        train = os.path.join(out, "train")
+        self.assertEqual(sorted(os.listdir(train)), ["000.h5", "001.h5", "002.h5", "manifest.json"])
+        self.assertEqual(read_dataset_manifest(train)["shards"]["002.h5"]["samples"], 4)
+        self.assertEqual((read_dataset_manifest(train)["num_shards"], read_dataset_manifest(train)["complete"]), (3, True))
+        self.assertEqual(list(read_dataset_manifest(os.path.join(out, "val"))["shards"]), ["000.h5"])
+
+        #A rerun only builds the shards that are missing
+        os.remove(os.path.join(train, "001.h5"))
+        open(os.path.join(train, "002.h5.tmp"), 'w').close()
+        mtime = os.path.getmtime(os.path.join(train, "000.h5"))
+        make_datasets(self.dirs, out, 10, size=3, v_split=2)
+        self.assertEqual(sorted(os.listdir(train)), ["000.h5", "001.h5", "002.h5", "manifest.json"])
+        self.assertEqual(os.path.getmtime(os.path.join(train, "000.h5")), mtime)
+
+        self.assertRaises(IOError, make_datasets, self.dirs, out, 10, size=4, v_split=2)
+        make_datasets(self.dirs, out, 10, size=4, v_split=2, force=True)
+        self.assertEqual(sorted(read_dataset_manifest(train)["shards"]), ["000.h5", "001.h5"])
+
+    def test_chunked_shards(self):
+        out = os.path.join(self.tmp, "out")
+        make_datasets(self.dirs, out, 10, size=4, v_split=2, batch_size=3, compression="lzf")
+        train = os.path.join(out, "train")
+        manifest = read_dataset_manifest(train)
+        self.assertEqual(manifest["params"]["compression"], "lzf")
+        info = manifest["shards"]["000.h5"]
+        self.assertEqual(info["samples"], 8)
+        self.assertEqual(info["class_counts"], [4, 4])
+        self.assertEqual(info["shapes"]["Particles"], [8, DEFAULT_RPE["Particles"], len(PARTICLE_OBSERVS)])
+        self.assertEqual(info["dtypes"]["HLF"], "float32")
+        with h5py.File(os.path.join(train, "000.h5"), 'r') as f:
+            self.assertEqual(f["Particles"].chunks, (3, DEFAULT_RPE["Particles"], len(PARTICLE_OBSERVS)))
+            self.assertEqual(f["Labels"].compression, "lzf")
+
+        #Readers take the sizes from the manifest
+        self.assertEqual(size_from_meta(os.path.join(train, "001.h5")), 8)
+        self.assertEqual(DataIterator(train, data_keys=["Particles", "Labels"]).length(), 16)
+        self.assertRaises(ValueError, make_datasets, self.dirs, os.path.join(self.tmp, "bad"), 10, size=4,
+                          compression="zip")
+
+    def test_stream(self):
+        def read_shards(folder):
+            shards = sorted(read_dataset_manifest(folder)["shards"])
+            out = []
+            for name in shards:
+                with h5py.File(os.path.join(folder, name), 'r') as f:
+                    order = np.argsort(f["HLF"][:, HLF_OBSERVS.index("HT")])
+                    out.append([f[key][:][order] for key in ("Particles", "Labels", "HLF")])
+            return out
+
+        for sort_on in (None, "Pt"):
+            built = os.path.join(self.tmp, "built_%s" % sort_on)
+            streamed = os.path.join(self.tmp, "streamed_%s" % sort_on)
+            make_datasets(self.dirs, built, 11, size=3, v_split=2, sort_on=sort_on)
+            make_datasets(self.dirs, streamed, 11, size=3, v_split=2, sort_on=sort_on, stream=True, num_processes=2,
+                          block_size=2)
+            for split in ("train", "val"):
+                expected = read_shards(os.path.join(built, split))
+                shards = read_shards(os.path.join(streamed, split))
+                self.assertEqual(len(shards), len(expected))
+                for x, y in zip(shards, expected):
+                    for a, b in zip(x, y):
+                        self.assertEqual(a.dtype, b.dtype)
+                        assert_almost_equal(a, b)
+            self.assertEqual(read_dataset_manifest(os.path.join(streamed, "train"))["shards"]["002.h5"]["samples"], 6)
+
+        #A resumed build only streams the missing shards
+        os.remove(os.path.join(streamed, "train", "001.h5"))
+        make_datasets(self.dirs, streamed, 11, size=3, v_split=2, sort_on="Pt", stream=True)
+        assert_almost_equal(read_shards(os.path.join(streamed, "train"))[1][2], read_shards(os.path.join(built, "train"))[1][2])
+        self.assertRaises(IOError, make_datasets, self.dirs, os.path.join(self.tmp, "x"), 14, stream=True)
+
+    def test_stream_killed(self):
+        import signal, multiprocessing
+        storage = {"batch_size": None, "compression": None, "compression_level": 4}
+        shards = [(os.path.join(self.tmp, "%03d.h5" % i), 2 * i, 2) for i in range(4)]
+
+        def done(dest, info):
+            #The readers cannot start the last two shards before the first one is written
+            for p in multiprocessing.active_children():
+                if (p.name.startswith("stream_reader")): os.kill(p.pid, signal.SIGKILL)
+        self.assertRaises(RuntimeError, stream_shards, self.dirs, shards, storage, done)
+
+    def test_parse_megabytes(self):
+        self.assertEqual(parse_megabytes("500MB"), 500.0)
+        self.assertEqual(parse_megabytes("2GB"), 2000.0)
+        self.assertEqual(parse_megabytes("1.5gb"), 1500.0)
+        self.assertEqual(parse_megabytes(" 0.5 MB"), .5)
+        for size in ("500", "2TB", "MB", "1.5.2GB", "500MB of memory"):
+            self.assertRaises(ValueError, parse_megabytes, size)
+
+    def test_stride(self):
+        rpe = {"Particles": 10, "HLF": 1}
+        observ_types = {"Particles": ["Pt"] * 24, "HLF": ["HT"] * 10}
+        #250 floats or 1KB a sample
+        self.assertEqual(strideFromTargetSize(rpe, observ_types, 2, megabytes=1), 500)
+        self.assertEqual(strideFromTargetSize(rpe, observ_types, 1, megabytes=1, dtype='float64'), 500)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import h5py
+from numpy.testing import assert_almost_equal
+
+if __package__ is None:
+    sys.path.append(os.path.realpath("../"))
+    sys.path.append(os.path.realpath("../../"))
+from CMS_Deep_Learning.preprocessing.delphes_parser import delphes_to_pandas
+from CMS_Deep_Learning.preprocessing.preprocessing import ObjectProfile, JET_PROFILE, _applyParticleCuts, _addColumns, \
+    _padAndSort
+from CMS_Deep_Learning.preprocessing.root_to_tensors import iter_root_to_tensors, root_to_tensors
+from CMS_Deep_Learning.preprocessing.synthetic_delphes import SyntheticTree
+from CMS_Deep_Learning.io import retrieve_data
+
+observ_types = ['PT_ET', 'Eta', 'Phi', 'ChHadIso', 'ObjType']
+object_profiles = [ObjectProfile("EFlowTrack", 30, pre_sort_columns=["PT_ET"], pre_sort_ascending=False,
+                                 sort_columns=["Phi"], addColumns={"ObjType": 1}),
+                   ObjectProfile("Electron", 2, sort_columns=["PT_ET"], sort_ascending=False, addColumns={"ObjType": 2}),
+                   ObjectProfile("EFlowPhoton", 10, pre_sort_columns=["Eta", "PT_ET"], addColumns={"ObjType": 3})]
+
+
+def reference(frames, profiles, observs, single_list=False, sort_columns=None):
+    '''What preprocessFromPandas_label_dir_pairs does entry by entry'''
+    n = len(frames["NumValues"].index)
+    non_add = [o for o in observs if o != "ObjType"]
+    X = [[] for p in profiles]
+    singles, jets = [], []
+    jet_observs = [c for c in frames["Jet"].columns if c != "Entry"]
+    for entry in range(n):
+        cut_tables = []
+        for i, p in enumerate(profiles):
+            df = frames[p.name]
+            x = df[df["Entry"] == entry].values
+            x = _addColumns(_applyParticleCuts(x, list(df.columns), p, len(observs), non_add), p, observs) if len(x) else None
+            cut_tables.append(x)
+            X[i].append(_padAndSort(x, p, len(observs), observs))
+        if(single_list):
+            lst = ObjectProfile("single_list", sum([p.max_size for p in profiles]), sort_columns=sort_columns)
+            singles.append(_padAndSort(np.concatenate([c for c in cut_tables if c is not None], axis=0), lst,
+                                       len(observs), observs))
+        df = frames["Jet"]
+        x = df[df["Entry"] == entry].values
+        x = _applyParticleCuts(x, list(df.columns), JET_PROFILE, len(jet_observs), jet_observs) if len(x) else None
+        jets.append(_padAndSort(x, JET_PROFILE, len(jet_observs), jet_observs))
+    return [np.array(x) for x in X], np.array(singles), np.array(jets)
+
+
+class TestRootToTensors(unittest.TestCase):
+    def test_profiles(self):
+        tree = SyntheticTree(120, seed=6)
+        frames = delphes_to_pandas(tree, verbosity=0)
+        X_ref, single_ref, jets_ref = reference(frames, object_profiles, observ_types, single_list=True,
+                                                sort_columns=["PT_ET"])
+        chunks = list(iter_root_to_tensors(tree, object_profiles, observ_types, chunk_size=25, verbosity=0))
+        self.assertTrue(len(chunks) > 1)
+        for i in range(len(object_profiles)):
+            assert_almost_equal(np.concatenate([c[0][i] for c in chunks]), X_ref[i], decimal=5)
+        assert_almost_equal(np.concatenate([c[1] for c in chunks]), jets_ref, decimal=4)
+        eventChars = np.concatenate([c[2] for c in chunks])
+        assert_almost_equal(eventChars[:, 0], frames["EventChars"].drop(columns="Entry").values, decimal=4)
+
+        single = np.concatenate([c[0] for c in iter_root_to_tensors(tree, object_profiles, observ_types, chunk_size=40,
+                                                                    single_list=True, sort_columns=["PT_ET"],
+                                                                    verbosity=0)])
+        assert_almost_equal(single, single_ref, decimal=5)
+
+    def test_file(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            tree = SyntheticTree(60, seed=7)
+            out_file, pandas_out = os.path.join(tmp, "x.h5"), os.path.join(tmp, "pandas.h5")
+            num = root_to_tensors(tree, out_file, object_profiles, observ_types, label=[0, 1], chunk_size=20,
+                                  pandas_out=pandas_out, verbosity=0)
+            X, Y = retrieve_data(out_file, ["X", "Y"])
+            self.assertEqual([x.shape for x in X], [(num, 30, 5), (num, 2, 5), (num, 10, 5)])
+            assert_almost_equal(Y, np.tile([0, 1], (num, 1)))
+            with h5py.File(out_file, 'r') as h5f:
+                self.assertEqual(h5f["Jets"].shape[:2], (num, JET_PROFILE.max_size))
+            frames = delphes_to_pandas(tree, verbosity=0)
+            import pandas as pd
+            store = pd.HDFStore(pandas_out)
+            assert_almost_equal(store.get("EFlowTrack").values, frames["EFlowTrack"].values)
+            store.close()
+        finally:
+            shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    unittest.main()
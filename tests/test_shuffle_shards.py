@@ -0,0 +1,95 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import h5py
+from numpy.testing import assert_almost_equal
+
+if __package__ is None:
+    sys.path.append(os.path.realpath("../"))
+    sys.path.append(os.path.realpath("../../"))
+from CMS_Deep_Learning.preprocessing.shuffle_shards import shuffle_dataset
+from CMS_Deep_Learning.preprocessing.pandas_to_numpy import _write_shard, _write_manifest, DATASET_VERSION
+from CMS_Deep_Learning.io import read_dataset_manifest, DATASET_FORMAT
+
+
+def read_all(shards):
+    arrays = {}
+    for shard, n in shards:
+        with h5py.File(shard, 'r') as f:
+            for key in f.keys():
+                arrays.setdefault(key, []).append(f[key][:])
+    return {key: np.concatenate(lst) for key, lst in arrays.items()}
+
+
+class TestShuffleShards(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.data = os.path.join(self.tmp, "train")
+        os.makedirs(self.data)
+        #Shards in source order, the first column of HLF numbers the samples and the labels follow the shards
+        manifest = {"format": DATASET_FORMAT, "version": DATASET_VERSION, "params": {"batch_size": 4}, "shards": {}}
+        first = 0
+        for i, n in enumerate([30, 25, 40, 5]):
+            ids = np.arange(first, first + n, dtype='float32')
+            arrays = {"Particles": np.repeat(ids[:, None, None], 3, axis=1) * np.ones((1, 1, 2), dtype='float32'),
+                      "HLF": np.stack([ids, -ids], axis=1),
+                      "Labels": np.eye(2, dtype='int8')[np.full(n, i % 2)]}
+            name = "%03d.h5" % i
+            manifest["shards"][name] = _write_shard(os.path.join(self.data, name), arrays,
+                                                    {"batch_size": 4, "compression": None, "compression_level": 4})
+            first += n
+        _write_manifest(self.data, manifest)
+        self.total = first
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_shuffle(self):
+        out = os.path.join(self.tmp, "a")
+        shards = shuffle_dataset(self.data, out, seed=3, num_buckets=3, verbose=0)
+        self.assertEqual(len(shards), 3)
+        self.assertEqual(sum([n for s, n in shards]), self.total)
+        self.assertFalse([f for f in os.listdir(out) if f.endswith((".part", ".tmp"))])
+        manifest = read_dataset_manifest(out)
+        self.assertEqual(sorted(manifest["shards"]), ["000.h5", "001.h5", "002.h5"])
+        self.assertEqual(manifest["params"]["shuffle"]["seed"], 3)
+
+        x = read_all(shards)
+        ids = x["HLF"][:, 0]
+        #Every sample is written once and stays whole
+        self.assertEqual(sorted(ids.astype(int)), list(range(self.total)))
+        assert_almost_equal(x["HLF"][:, 1], -ids)
+        assert_almost_equal(x["Particles"][:, 2, 1], ids)
+        assert_almost_equal(x["Labels"][:, 1], np.isin(ids, np.r_[30:55, 95:100]))
+        #Samples of every source shard end up in every output shard
+        with h5py.File(shards[0][0], 'r') as f:
+            self.assertEqual(f["HLF"].chunks, (4, 2))
+            self.assertEqual(len(set((f["HLF"][:, 0] >= 30).tolist())), 2)
+        self.assertFalse(np.all(np.diff(ids) > 0))
+
+        #The same seed gives the same shards, however many processes are used
+        again = shuffle_dataset(self.data, os.path.join(self.tmp, "b"), seed=3, num_buckets=3, num_processes=2,
+                                verbose=0)
+        assert_almost_equal(read_all(again)["HLF"], x["HLF"])
+        other = shuffle_dataset(self.data, os.path.join(self.tmp, "c"), seed=4, num_buckets=3, verbose=0)
+        self.assertFalse(np.array_equal(read_all(other)["HLF"], x["HLF"]))
+
+        self.assertRaises(IOError, shuffle_dataset, self.data, out, verbose=0)
+        self.assertRaises(ValueError, shuffle_dataset, self.data, self.data, verbose=0)
+
+    def test_memory(self):
+        #Each sample is 34 bytes, so 1MB holds every sample and one bucket is used
+        shards = shuffle_dataset(self.data, os.path.join(self.tmp, "a"), memory="1MB", verbose=0)
+        self.assertEqual(len(shards), 1)
+        self.assertEqual(sorted(read_all(shards)["HLF"][:, 0].astype(int)), list(range(self.total)))
+        #4KB holds the 3400 bytes of the samples, but not twice, so two buckets are used
+        shards = shuffle_dataset(self.data, os.path.join(self.tmp, "b"), memory=".000004GB", verbose=0)
+        self.assertEqual(len(shards), 2)
+        self.assertRaises(ValueError, shuffle_dataset, self.data, os.path.join(self.tmp, "c"), memory="500", verbose=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import sys
+import unittest
+import numpy as np
+from numpy.testing import assert_almost_equal
+
+if __package__ is None:
+    sys.path.append(os.path.realpath("../"))
+    sys.path.append(os.path.realpath("../../"))
+from CMS_Deep_Learning.preprocessing.delphes_parser import delphes_to_pandas, iter_delphes_tables, OBJECT_TYPES
+from CMS_Deep_Learning.preprocessing.synthetic_delphes import SyntheticTree, TEntryList
+from CMS_Deep_Learning.preprocessing.parser_benchmark import benchmark_stages, STAGES
+
+
+class TestSyntheticDelphes(unittest.TestCase):
+    def test_tree(self):
+        tree = SyntheticTree(20, seed=3)
+        self.assertEqual(tree.GetEntries(), 20)
+        leaf = tree.GetLeaf("EFlowTrack.PT")
+        self.assertEqual(tree.GetLeaf("EFlowTrack.Mass"), None)
+        leaf.GetBranch().GetEntry(5)
+        n = leaf.GetLen()
+        self.assertEqual(n, tree.counts["EFlowTrack"][5])
+        start = tree.offsets["EFlowTrack"][5]
+        assert_almost_equal([leaf.GetValue(i) for i in range(n)], tree.columns["EFlowTrack"]["PT"][start:start+n])
+
+        #Draw reads along the entry list
+        elist = TEntryList("", "", tree)
+        for entry in (2, 7, 9):
+            elist.Enter(entry)
+        tree.SetEntryList(elist)
+        rows = tree.Draw("Jet_size:Jet.PT", "", "goff", 2, 1)
+        self.assertEqual(tree.GetVal(0).tolist(), tree.counts["Jet"][[7, 9]].tolist())
+        self.assertEqual(rows, 2)
+        self.assertEqual(len(tree.GetVal(1)), tree.counts["Jet"][[7, 9]].sum())
+
+    def test_parse(self):
+        tree = SyntheticTree(150, seed=1)
+        frames = delphes_to_pandas(tree, verbosity=0, block_size=40)
+        self.assertTrue(0 < len(frames["NumValues"].index) < 150)
+        for obj in OBJECT_TYPES:
+            self.assertEqual(frames["NumValues"][obj].sum(), len(frames[obj].index))
+
+        #Every path gives the same tables
+        for kwargs in (dict(columnar=False), dict(fan_out=3)):
+            other = delphes_to_pandas(tree, verbosity=0, **kwargs)
+            for key, df in frames.items():
+                self.assertEqual(list(df.columns), list(other[key].columns))
+                assert_almost_equal(df.values.astype('float64'), other[key].values.astype('float64'), decimal=4)
+
+    def test_close(self):
+        #Stopping part way through restores the entry list, so the tree can be parsed again
+        tree = SyntheticTree(120, seed=2)
+        chunks = iter_delphes_tables(tree, chunk_size=20, verbosity=0)
+        next(chunks)
+        self.assertNotEqual(tree.GetEntryList(), None)
+        chunks.close()
+        self.assertEqual(tree.GetEntryList(), None)
+        self.assertTrue(len(delphes_to_pandas(tree, verbosity=0)["NumValues"].index) > 20)
+
+    def test_benchmark(self):
+        out = benchmark_stages(n_entries=100, block_size=30, verbose=0)
+        self.assertEqual(sorted(out.keys()), sorted(STAGES))
+        for stage in STAGES:
+            self.assertTrue(out[stage]["entries/sec"] > 0)
+
+
+if __name__ == '__main__':
+    unittest.main()